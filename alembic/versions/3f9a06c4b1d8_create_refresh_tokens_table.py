@@ -0,0 +1,38 @@
+"""create refresh_tokens table
+
+Revision ID: 3f9a06c4b1d8
+Revises: e52c8a1f6d07
+Create Date: 2026-10-18 11:26:15.904377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a06c4b1d8'
+down_revision = 'e52c8a1f6d07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table("refresh_tokens",
+                    sa.Column("id", sa.Integer(), nullable = False, primary_key = True),
+                    sa.Column("user_id", 
+                              sa.Integer(), 
+                              sa.ForeignKey("users.id", ondelete = "CASCADE"), 
+                              nullable = False),
+                    sa.Column("token_hash", sa.String(), nullable = False, unique = True),
+                    sa.Column("created_at", 
+                              sa.TIMESTAMP(timezone = True), 
+                              server_default = sa.text("now()"), 
+                              nullable = False),
+                    sa.Column("expires_at", sa.TIMESTAMP(timezone = True), nullable = False),
+                    sa.Column("revoked_at", sa.TIMESTAMP(timezone = True), nullable = True))
+    op.create_index("ix_refresh_tokens_user_id", "refresh_tokens", ["user_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_refresh_tokens_user_id", table_name = "refresh_tokens")
+    op.drop_table("refresh_tokens")
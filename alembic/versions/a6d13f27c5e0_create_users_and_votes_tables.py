@@ -0,0 +1,70 @@
+"""create users and votes tables
+
+Revision ID: a6d13f27c5e0
+Revises: 9cbe2ac62829
+Create Date: 2026-10-18 13:02:16.447190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d13f27c5e0'
+down_revision = '9cbe2ac62829'
+branch_labels = None
+depends_on = None
+
+
+# --- Until this revision, users, votes and the rest of the posts columns were only created by create_all when the
+# --- application started, so a database may already have them. Only the parts that are missing are added:
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+    post_columns = [column["name"] for column in inspector.get_columns("posts")]
+    
+    if "published" not in post_columns:
+        op.add_column("posts", sa.Column("published", sa.Boolean(), server_default = "TRUE", nullable = False))
+    
+    if "created_at" not in post_columns:
+        op.add_column("posts", 
+                      sa.Column("created_at", 
+                                sa.TIMESTAMP(timezone = True), 
+                                server_default = sa.text("now()"), 
+                                nullable = False))
+    
+    if "users" not in tables:
+        op.create_table("users",
+                        sa.Column("id", sa.Integer(), nullable = False, primary_key = True),
+                        sa.Column("email", sa.String(), nullable = False, unique = True),
+                        sa.Column("password", sa.String(), nullable = False),
+                        sa.Column("created_at", 
+                                  sa.TIMESTAMP(timezone = True), 
+                                  server_default = sa.text("now()"), 
+                                  nullable = False))
+    
+    if "owner_id" not in post_columns:
+        op.add_column("posts", sa.Column("owner_id", sa.Integer(), nullable = False))
+        op.create_foreign_key("posts_owner_id_fkey", "posts", "users", ["owner_id"], ["id"], ondelete = "CASCADE")
+    
+    if "votes" not in tables:
+        op.create_table("votes",
+                        sa.Column("post_id", 
+                                  sa.Integer(), 
+                                  sa.ForeignKey("posts.id", ondelete = "CASCADE"), 
+                                  nullable = False, 
+                                  primary_key = True),
+                        sa.Column("user_id", 
+                                  sa.Integer(), 
+                                  sa.ForeignKey("users.id", ondelete = "CASCADE"), 
+                                  nullable = False, 
+                                  primary_key = True))
+
+
+def downgrade() -> None:
+    op.drop_table("votes")
+    op.drop_constraint("posts_owner_id_fkey", "posts", type_ = "foreignkey")
+    op.drop_column("posts", "owner_id")
+    op.drop_table("users")
+    op.drop_column("posts", "created_at")
+    op.drop_column("posts", "published")
@@ -0,0 +1,32 @@
+"""add vote_count to posts table
+
+Revision ID: b7d41e2a90c3
+Revises: a6d13f27c5e0
+Create Date: 2026-10-18 09:12:04.118532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d41e2a90c3'
+down_revision = 'a6d13f27c5e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("posts", sa.Column("vote_count", sa.Integer(), server_default = "0", nullable = False))
+    
+    # --- Backfill the counts for the votes that already exist:
+    op.execute("""
+        UPDATE posts
+           SET vote_count = counts.votes
+          FROM (SELECT post_id, count(*) AS votes FROM votes GROUP BY post_id) AS counts
+         WHERE posts.id = counts.post_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column("posts", "vote_count")
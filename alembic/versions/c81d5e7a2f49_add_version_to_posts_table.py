@@ -0,0 +1,24 @@
+"""add version to posts table
+
+Revision ID: c81d5e7a2f49
+Revises: 3f9a06c4b1d8
+Create Date: 2026-10-18 12:08:51.270664
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81d5e7a2f49'
+down_revision = '3f9a06c4b1d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("posts", sa.Column("version", sa.Integer(), server_default = "1", nullable = False))
+
+
+def downgrade() -> None:
+    op.drop_column("posts", "version")
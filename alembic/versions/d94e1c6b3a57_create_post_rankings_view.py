@@ -0,0 +1,39 @@
+"""create post rankings view
+
+Revision ID: d94e1c6b3a57
+Revises: f0b7e94a2d61
+Create Date: 2026-10-18 16:05:12.447190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd94e1c6b3a57'
+down_revision = 'f0b7e94a2d61'
+branch_labels = None
+depends_on = None
+
+
+# --- The rankings behind the hot and top sorts of the post list, as declared in app/models/models.py (with
+# --- HOT_GRAVITY written out, so later changes to the model don't change this revision). The view is filled when it is
+# --- created, and then refreshed by the API or "python -m app.manage refresh-rankings":
+STATEMENTS = ["CREATE MATERIALIZED VIEW IF NOT EXISTS post_rankings AS "
+              "SELECT id AS post_id, vote_count AS votes, "
+              "CAST((vote_count + 1) / power(extract(epoch FROM now() - created_at) / 3600 + 2, 1.8) "
+              "AS double precision) AS hot_score "
+              "FROM posts",
+              "CREATE UNIQUE INDEX IF NOT EXISTS ix_post_rankings_post_id ON post_rankings (post_id)",
+              "CREATE INDEX IF NOT EXISTS ix_post_rankings_hot ON post_rankings (hot_score, post_id)",
+              "CREATE INDEX IF NOT EXISTS ix_post_rankings_top ON post_rankings (votes, post_id)"
+              ]
+
+
+def upgrade() -> None:
+    for statement in STATEMENTS:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    op.execute("DROP MATERIALIZED VIEW IF EXISTS post_rankings")
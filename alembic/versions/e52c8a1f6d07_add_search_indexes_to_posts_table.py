@@ -0,0 +1,39 @@
+"""add search indexes to posts table
+
+Revision ID: e52c8a1f6d07
+Revises: b7d41e2a90c3
+Create Date: 2026-10-18 10:03:47.552190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+
+# revision identifiers, used by Alembic.
+revision = 'e52c8a1f6d07'
+down_revision = 'b7d41e2a90c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # --- Note: adding a stored generated column rewrites the posts table, so run this outside of peak hours:
+    op.add_column("posts", 
+                  sa.Column("search_vector", 
+                            TSVECTOR(), 
+                            sa.Computed("setweight(to_tsvector('english', title), 'A') || "
+                                        "setweight(to_tsvector('english', content), 'B')", 
+                                        persisted = True)))
+    op.create_index("ix_posts_search_vector", "posts", ["search_vector"], postgresql_using = "gin")
+    
+    # --- The trigram index for search_trigram isn't created here, as it needs the pg_trgm extension which not every
+    # --- Postgres has. It is created by "python -m app.manage create-trigram-index" (and by create-schema when
+    # --- search_trigram is switched on).
+
+
+def downgrade() -> None:
+    # --- The trigram index may have been created since, by create-trigram-index:
+    op.execute("DROP INDEX IF EXISTS ix_posts_title_trgm")
+    op.drop_index("ix_posts_search_vector", table_name = "posts")
+    op.drop_column("posts", "search_vector")
@@ -0,0 +1,42 @@
+"""add indexes for hot query paths
+
+Revision ID: f0b7e94a2d61
+Revises: c81d5e7a2f49
+Create Date: 2026-10-18 13:20:41.093518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f0b7e94a2d61'
+down_revision = 'c81d5e7a2f49'
+branch_labels = None
+depends_on = None
+
+
+# --- The indexes declared in the models, with what they serve:
+# --- ix_posts_created_at_id: the newest first feed (GET /post/) and its cursor pages.
+# --- ix_posts_owner_id_created_at_id: a user's own posts, newest first (GET /post/my-posts), and the cascade when a
+# --- user is deleted.
+# --- ix_votes_user_id: the votes of a user. The primary key (post_id, user_id) only serves lookups by post.
+INDEXES = {"ix_posts_created_at_id": "posts (created_at, id)",
+           "ix_posts_owner_id_created_at_id": "posts (owner_id, created_at, id)",
+           "ix_votes_user_id": "votes (user_id)"
+           }
+
+
+def upgrade() -> None:
+    # --- CONCURRENTLY builds each index without blocking writes to the table, so this can run against a live database.
+    # --- It can't run inside a transaction. If a build fails it leaves an INVALID index behind, which has to be
+    # --- dropped before running this again. IF NOT EXISTS skips the indexes create_all has already made:
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES.items():
+            op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {columns}")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name in INDEXES:
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
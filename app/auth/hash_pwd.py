@@ -1,11 +1,31 @@
 # --- This module is used to encrypt the users password when they create an account or update their password.
+# ---
+# --- bcrypt is slow on purpose, taking hundreds of milliseconds of CPU per hash. The routers use the async versions 
+# --- of the functions, which run the hashing in a separate pool of processes so that a burst of logins or sign ups
+# --- can't take the CPU away from every other request in the same worker.
 
 # --- Import the required modules:
+import asyncio
+import multiprocessing
+import threading
+import time
+from app.config import settings
+from app.metrics import PASSWORD_HASH_REJECTED, PASSWORD_HASH_SECONDS
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes = ["bcrypt"], deprecated = "auto")
+# --- Set the encryption type for the passwords to use bcrypt. Changing bcrypt_rounds changes the cost of new hashes,
+# --- and existing hashes are upgraded to it when their user next logs in:
+pwd_context = CryptContext(schemes = ["bcrypt"], deprecated = "auto", bcrypt__rounds = settings.bcrypt_rounds)
+
+# --- The pool of processes the hashing runs in, and the number of hashes waiting for or running in it:
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = 0
+
 
-# --- Set the encryption type for the passwords to use bcrypt:
 def hash_pwd(password: str):
     """This function will take the password the user passed and create a hash oit and return it back hashed.
     Required parameter / argument: password: string.
@@ -27,4 +47,103 @@ def verify_password_hash(plain_password:str, hashed_password:str):
         Boolean: True if hashed passwords match, otherwise False.
     """
     # --- Verify that the passwords match and return true if so or false if not:
-    return pwd_context.verify(plain_password, hashed_password)
\ No newline at end of file
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def verify_and_update_password_hash(plain_password:str, hashed_password:str):
+    """
+    Overview: 
+        The same as verify_password_hash, but also re-hashes the password if the stored hash was made with a
+        different cost (bcrypt_rounds) to the current one.
+
+    Returns:
+        Tuple: True if hashed passwords match, otherwise False, and the new hash to store (or None).
+    """
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+def get_executor():
+    """Return the process pool for hashing, creating it the first time it is needed."""
+    global _executor
+    
+    # --- The hashing processes are started from a clean forkserver process rather than forked from the worker. By the
+    # --- time a worker needs them it is running the threadpool and database threads, and a child forked while one of
+    # --- them holds a lock (logging, the import lock, a connection pool) inherits the lock held and can deadlock:
+    with _executor_lock:
+        if _executor is None:
+            context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                                                  else "spawn")
+            _executor = ProcessPoolExecutor(max_workers = settings.password_hash_workers, mp_context = context)
+        
+        return _executor
+
+
+def _ready():
+    return True
+
+
+def start_executor():
+    """
+    Overview:
+        Create the process pool and start its processes, so the first login or sign up doesn't wait for them to start
+        and import this module. Called when the application starts, from a thread as starting the processes blocks.
+    """
+    if settings.password_hash_workers:
+        executor = get_executor()
+        
+        for _ in range(settings.password_hash_workers):
+            executor.submit(_ready)
+
+
+def shutdown_executor():
+    """Stop the hashing processes. Called when the application shuts down."""
+    global _executor
+    
+    if _executor is not None:
+        _executor.shutdown(wait = False, cancel_futures = True)
+        _executor = None
+
+
+async def run_hash(function, *args):
+    """
+    Overview:
+        Run a hashing function in the process pool (or the threadpool if password_hash_workers is 0).
+        If password_hash_queue_limit hashes are already waiting or running, a 503 is raised straight away rather than
+        queueing more work that the client would probably have given up on by the time it ran.
+    
+    Args:
+        function: One of the hashing functions above. It must be defined at module level so it can be sent to the 
+                  hashing processes.
+        *args: The arguments to call it with.
+        
+    Returns:
+        The result of the function.
+    """
+    global _in_flight
+    
+    if _in_flight >= settings.password_hash_queue_limit:
+        PASSWORD_HASH_REJECTED.inc()
+        raise HTTPException(status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail = "The server is busy. Please try again.",
+                            headers = {"Retry-After": "1"})
+    
+    _in_flight += 1
+    start = time.perf_counter()
+    try:
+        if settings.password_hash_workers:
+            return await asyncio.get_running_loop().run_in_executor(get_executor(), function, *args)
+        
+        return await run_in_threadpool(function, *args)
+    finally:
+        _in_flight -= 1
+        PASSWORD_HASH_SECONDS.labels(function.__name__).observe(time.perf_counter() - start)
+
+
+async def hash_password_async(password: str):
+    """Hash a password without blocking the event loop. See hash_pwd."""
+    return await run_hash(hash_pwd, password)
+
+
+async def verify_password_async(plain_password:str, hashed_password:str):
+    """Verify a password without blocking the event loop. See verify_and_update_password_hash."""
+    return await run_hash(verify_and_update_password_hash, plain_password, hashed_password)
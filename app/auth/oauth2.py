@@ -1,17 +1,32 @@
 # --- Import the required modules / libraries:
 from app import schemas
+from app.auth.user_cache import user_cache
 from app.config import settings
-from app.database import get_db
+from app.database import FOREIGN_KEY_VIOLATION, get_db, violated_constraint
 from app.models.models import User
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from hashlib import sha256
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
+from secrets import token_urlsafe
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl = "login")
 
+# --- The same scheme for the routes that can be called with or without a token. It gives None rather than a 401 when
+# --- there is no token:
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl = "login", auto_error = False)
+
+
+# --- The foreign keys to users that a change made by the logged in user can break. The claims auth mode doesn't look
+# --- the user up, so a token that is still valid after its user was deleted gets as far as the write:
+USER_FOREIGN_KEYS = {"posts_owner_id_fkey", "votes_user_id_fkey"}
+
 
 # --- Three parts are needed:
 # --- The SECRET_KEY can be created using the following terminal command:
@@ -41,6 +56,40 @@ def create_access_token(data: dict):
     return encoded_token
 
 
+def hash_refresh_token(token: str):
+    """Return the SHA-256 hex digest of a refresh token, which is what is stored in and looked up from the database."""
+    return sha256(token.encode()).hexdigest()
+
+
+def create_refresh_token():
+    """
+    Overview:
+        Create a new random refresh token. Unlike the access token it is opaque: it has no meaning on its own and is
+        only valid while there is a matching row in the refresh_tokens table, so it can be revoked.
+
+    Returns:
+        Tuple: The token to give to the client, its hash to store and the time it expires.
+    """
+    token = token_urlsafe(32)
+    expires_at = datetime.now(timezone.utc) + timedelta(days = settings.refresh_token_expire_days)
+    
+    return token, hash_refresh_token(token), expires_at
+
+
+def invalid_credentials():
+    """Return the 401 raised when a request isn't authenticated."""
+    return HTTPException(status_code = status.HTTP_401_UNAUTHORIZED,
+                         detail = "Invalid Credentials",
+                         headers = {"WWW-Authenticate": "Bearer"}
+                         )
+
+
+def raise_for_deleted_user(error: IntegrityError):
+    """Raise the 401 for a change that broke a foreign key to users, as its user has been deleted since logging in."""
+    if error.orig.pgcode == FOREIGN_KEY_VIOLATION and violated_constraint(error) in USER_FOREIGN_KEYS:
+        raise invalid_credentials() from error
+
+
 def verify_access_token(token: str, credentials_exception):
     try: 
         # --- Decode the key
@@ -53,11 +102,11 @@ def verify_access_token(token: str, credentials_exception):
         user_id: str = payload.get("user_id")
 
         # --- If the user_id is null, error:
-        if id is None:
+        if user_id is None:
             raise credentials_exception
         
-        # --- If the user_id is a number, set token_data to the user_id
-        token_data = schemas.TokenData(id = user_id)
+        # --- If the user_id is a number, set token_data to the user_id (and the email, if the token has it):
+        token_data = schemas.TokenData(id = user_id, email = payload.get("email"))
 
     # --- If a JWT related error occurs, raise an error using the credentials_exception variable:
     except JWTError:
@@ -67,20 +116,55 @@ def verify_access_token(token: str, credentials_exception):
     return token_data
 
 
-def get_current_user(token: str = Depends(oauth2_scheme),
-                     db: Session = Depends(get_db)): 
+async def get_current_user(token: str = Depends(oauth2_scheme),
+                           db: AsyncSession = Depends(get_db)): 
     # --- Define a variable that will be used to pass an error if the user is not authenticated:
-    credentials_exception = HTTPException(status_code = status.HTTP_401_UNAUTHORIZED,
-                                          detail = "Invalid Credentials",
-                                          headers = {"WWW-Authenticate": "Bearer"}
-                                          )
+    credentials_exception = invalid_credentials()
     
     # --- Verify the access token:
     token = verify_access_token(token = token, 
                                 credentials_exception = credentials_exception
                                 )
-    user = db.query(User).filter(User.id == token.id).first()
+    user_id = int(token.id)
+    
+    if settings.auth_mode == "claims":
+        # --- The token was signed with the users id and email at login, so there is no need to look the user up:
+        if token.email is not None:
+            return schemas.CurrentUser.construct(id = user_id, email = token.email)
+        
+        # --- Tokens without the email claim fall back to the cache, and then the database:
+        user = user_cache.get(user_id)
+        
+        if user is None:
+            result = await db.execute(select(User.id, User.email).filter(User.id == user_id))
+            row = result.first()
+            
+            if row is None:
+                raise credentials_exception
+            
+            user = schemas.CurrentUser.construct(id = row.id, email = row.email)
+            user_cache.set(user_id, user)
+        
+        return user
     
-    print(user)
+    result = await db.execute(select(User).filter(User.id == user_id))
+    user = result.scalars().first()
+    
+    # --- The token is valid but the user has since been deleted:
+    if user is None:
+        raise credentials_exception
+    
+    return user
+
+
+def get_optional_user_id(token: Optional[str] = Depends(optional_oauth2_scheme)) -> Optional[int]:
+    # --- The id of the logged in user, or None for an anonymous caller. It is read from the signed token without looking
+    # --- the user up, as the routes that use it only read. They can be read without logging in, so a token that is
+    # --- invalid or has expired makes the caller anonymous rather than being rejected:
+    if token is None:
+        return None
     
-    return user
\ No newline at end of file
+    try:
+        return int(verify_access_token(token = token, credentials_exception = invalid_credentials()).id)
+    except HTTPException:
+        return None
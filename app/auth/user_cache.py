@@ -0,0 +1,66 @@
+# --- This module contains the cache of the users that get_current_user has looked up.
+# --- It is used in the claims auth mode for tokens that don't carry the claims the routers need, so the users 
+# --- table is only read once per user every few minutes rather than on every request.
+
+# --- Import the required modules:
+import threading
+import time
+from app.config import settings
+from collections import OrderedDict
+
+
+class UserCache:
+    """
+    Overview:
+        A bounded, thread safe least recently used cache. Entries expire ttl seconds after they were added, so a 
+        change to a user (or its deletion) is picked up within ttl seconds even if the cache is never invalidated.
+    
+    Args:
+        max_size (int): The most users to keep. The least recently used is dropped when it is full.
+        ttl (float): The number of seconds an entry is valid for.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def get(self, user_id: int):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            
+            if entry is None:
+                return None
+            
+            user, expires_at = entry
+            
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            
+            self._entries.move_to_end(user_id)
+            
+            return user
+        
+    def set(self, user_id: int, user):
+        with self._lock:
+            self._entries[user_id] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+    
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self):
+        return len(self._entries)
+
+
+# --- The cache shared by every request in this process:
+user_cache = UserCache(max_size = settings.user_cache_size, ttl = settings.user_cache_ttl_seconds)
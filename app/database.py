@@ -1,31 +1,268 @@
+import logging
+import threading
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy import create_engine
+from sqlalchemy.engine import CursorResult
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from app.config import settings
+from app.pool import TimedAsyncAdaptedQueuePool, TimedQueuePool
+from app.timing import instrument
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
 
 # --- Create a constant that will be used to point to and pass the user details to our database:
-SQLALCHEMY_DATABASE_URL = f"{settings.database_type}://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}"
+def database_url(driver: str = None) -> str:
+    scheme = f"{settings.database_type}+{driver}" if driver else settings.database_type
+    
+    return f"{scheme}://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}"
+
+
+# --- The pool settings shared by both engines:
+def pool_options() -> dict:
+    return {"pool_size": settings.db_pool_size,
+            "max_overflow": settings.db_max_overflow,
+            "pool_timeout": settings.db_pool_timeout,
+            "pool_recycle": settings.db_pool_recycle,
+            "pool_pre_ping": settings.db_pool_pre_ping
+            }
+
+
+# --- The engines and their session factories are created the first time they are used (for the application, by the
+# --- startup hook in app/main.py) rather than when this module is imported. Importing the application then doesn't
+# --- load the database drivers, and a worker can start while the database is unreachable:
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the blocking (psycopg2) engine, creating it on first use."""
+    with _engines_lock:
+        if "engine" not in _engines:
+            engine = create_engine(database_url(), poolclass=TimedQueuePool, **pool_options())
+            instrument(engine)
+            
+            # --- expire_on_commit is off so that objects can still be read after a commit without going back to the database:
+            _engines["session"] = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+            _engines["engine"] = engine
+    
+    return _engines["engine"]
+
 
+def get_async_engine():
+    """Return the asyncpg engine, creating it on first use, or None if database_async is switched off."""
+    if not settings.database_async:
+        return None
+    
+    with _engines_lock:
+        if "async_engine" not in _engines:
+            async_engine = create_async_engine(database_url("asyncpg"), poolclass=TimedAsyncAdaptedQueuePool, 
+                                               **pool_options())
+            instrument(async_engine.sync_engine)
+            
+            _engines["async_session"] = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, 
+                                                     bind=async_engine, class_=AsyncSession)
+            _engines["async_engine"] = async_engine
+    
+    return _engines["async_engine"]
 
-# --- Create an engine to connect to the database:
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
+def get_session_factory():
+    get_engine()
+    
+    return _engines["session"]
 
-# --- Create a session to the database:
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def get_async_session_factory():
+    return _engines["async_session"] if get_async_engine() is not None else None
+
+
+# --- The old module attributes still work, and create the engines when they are first read:
+_LAZY_ATTRIBUTES = {"engine": get_engine,
+                    "SessionLocal": get_session_factory,
+                    "async_engine": get_async_engine,
+                    "AsyncSessionLocal": get_async_session_factory
+                    }
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # --- Define the base that can be used with other callable classes, such as a class to make a Table:
 Base = declarative_base()
 
 
-# --- Execute the connection to the database and close it when finished:
-def get_db():
-    db = SessionLocal()
+class ThreadpoolSession:
+    """
+    Overview:
+        Wraps a blocking Session in the awaitable interface of AsyncSession, running each database call in the
+        threadpool. This lets the async routers use the blocking (psycopg2) engine when database_async is off.
+    
+    Args:
+        sync_session (Session): The blocking session to wrap.
+    """
+    def __init__(self, sync_session: Session):
+        self.sync_session = sync_session
+        
+    def add(self, instance):
+        self.sync_session.add(instance)
+        
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+        
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.buffered_execute, *args, **kwargs)
+    
+    def buffered_execute(self, *args, **kwargs):
+        # --- Fetch the rows in the threadpool as AsyncSession does, along with anything loaded with them (such as
+        # --- selectinload relationships), so nothing is sent to the database from the event loop:
+        result = self.sync_session.execute(*args, **kwargs)
+        
+        if isinstance(result, CursorResult) and not result.returns_rows:
+            return result
+        
+        return result.freeze()()
+    
+    async def stream(self, statement, **kwargs):
+        # --- Read the rows through a server-side cursor, a batch at a time, as AsyncSession.stream does:
+        result = await run_in_threadpool(self.sync_session.execute, statement, 
+                                         execution_options = {"stream_results": True}, **kwargs)
+        
+        return ThreadpoolStreamResult(result)
+    
+    async def scalar(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, *args, **kwargs)
+    
+    async def scalars(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalars, *args, **kwargs)
+    
+    async def get(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, *args, **kwargs)
+    
+    async def refresh(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.refresh, *args, **kwargs)
+    
+    async def delete(self, instance):
+        return await run_in_threadpool(self.sync_session.delete, instance)
+    
+    async def flush(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.flush, *args, **kwargs)
+    
+    async def commit(self):
+        return await run_in_threadpool(self.sync_session.commit)
+    
+    async def rollback(self):
+        return await run_in_threadpool(self.sync_session.rollback)
+    
+    async def close(self):
+        return await run_in_threadpool(self.sync_session.close)
+
+
+class ThreadpoolStreamResult:
+    """
+    Overview:
+        The result of ThreadpoolSession.stream, with the partitions and close of AsyncResult. Each batch of rows is
+        fetched from the server-side cursor in the threadpool.
+    
+    Args:
+        result (Result): The streaming result to wrap.
+    """
+    def __init__(self, result):
+        self.result = result
+    
+    async def partitions(self, size: int):
+        while True:
+            rows = await run_in_threadpool(self.result.fetchmany, size)
+            
+            if not rows:
+                break
+            
+            yield rows
+    
+    async def close(self):
+        return await run_in_threadpool(self.result.close)
+
+
+# --- The engine that serves requests, which is the async engine when it is switched on:
+def request_engine():
+    async_engine = get_async_engine()
+    
+    return async_engine.sync_engine if async_engine is not None else get_engine()
+
+
+async def dispose_engines():
+    """Close the pooled connections of the engines that have been created, when the application shuts down."""
+    if "async_engine" in _engines:
+        await _engines["async_engine"].dispose()
+    
+    if "engine" in _engines:
+        await run_in_threadpool(_engines["engine"].dispose)
+
+
+async def warm_up_pool(connections: int):
+    """
+    Overview:
+        Open connections up front so the first requests after a start don't pay for connecting to the database.
+        It is capped at the pool size, as overflow connections are closed as soon as they are returned.
+        A failure is logged rather than raised so the application can still start while the database is unavailable.
+    
+    Args:
+        connections (int): The number of connections to open.
+    """
+    connections = min(connections, settings.db_pool_size)
+    async_engine = get_async_engine()
     try:
-        yield db
-    finally:
-        db.close()
+        if async_engine is not None:
+            opened = [await async_engine.connect() for _ in range(connections)]
+            for connection in opened:
+                await connection.close()
+        else:
+            def warm_up():
+                opened = [get_engine().connect() for _ in range(connections)]
+                for connection in opened:
+                    connection.close()
+            
+            await run_in_threadpool(warm_up)
+    except Exception as error:
+        logger.warning("Could not warm up the database pool: %s", error)
+
+
+# --- The SQLSTATE Postgres raises when a row refers to a row in another table that doesn't exist:
+FOREIGN_KEY_VIOLATION = "23503"
+
+
+def violated_constraint(error: IntegrityError) -> Optional[str]:
+    """Return the name of the constraint an IntegrityError broke, from psycopg2 (diag) or asyncpg (the cause)."""
+    diag = getattr(error.orig, "diag", None)
+
+    if diag is not None:
+        return diag.constraint_name
+
+    return getattr(error.orig.__cause__, "constraint_name", None)
+
+
+# --- Execute the connection to the database and close it when finished.
+# --- The session has the AsyncSession interface in both modes, so the routers are the same whichever is used:
+async def get_db():
+    async_session_factory = get_async_session_factory()
+    
+    if async_session_factory is not None:
+        async with async_session_factory() as db:
+            yield db
+    else:
+        db = ThreadpoolSession(get_session_factory()())
+        try:
+            yield db
+        finally:
+            await db.close()
 
         
 # --- Old psycopg2 connection method:
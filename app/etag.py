@@ -0,0 +1,45 @@
+# --- This module contains the helpers for the ETag / If-None-Match conditional GETs.
+# --- The ETags are built from the id and version of the rows in a response, so they can be checked as soon as the 
+# --- rows have been read. When the client already has the current version, a 304 with no body is sent and the
+# --- response is never validated or serialised.
+
+# --- Import the required modules:
+from fastapi import Request, Response, status
+from hashlib import blake2b
+
+
+def make_etag(*parts) -> str:
+    """
+    Overview:
+        Build a strong ETag from the values that identify the version of a response.
+
+    Args:
+        *parts: The values, for example the id and version of each post in the response. 
+
+    Returns:
+        String: The quoted ETag.
+    """
+    return f'"{blake2b(repr(parts).encode(), digest_size = 16).hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Return True if the If-None-Match header of the request includes the ETag (or is *)."""
+    header = request.headers.get("if-none-match")
+
+    if not header:
+        return False
+
+    # --- If-None-Match uses the weak comparison, so a W/ prefix added by a proxy is ignored:
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+    return "*" in tags or etag in tags
+
+
+def not_modified(etag: str, vary: str = None) -> Response:
+    """Return a 304 Not Modified response for the ETag, with the Vary header the full response would have."""
+    headers = {"ETag": etag}
+
+    if vary:
+        headers["Vary"] = vary
+
+    return Response(status_code = status.HTTP_304_NOT_MODIFIED, headers = headers)
@@ -1,45 +1,124 @@
 # --- Import the required modules:
+import asyncio
 from app.cors.allow import allowed_origins
-from app.database import engine
-from app.models import models
-from app.routers import auth, post, root, user, vote
+from app.auth.hash_pwd import shutdown_executor, start_executor
+from app.config import settings
+from app.database import dispose_engines, request_engine, warm_up_pool
+from app.metrics import MetricsMiddleware
+from app.rankings import ranking_refresher
+from app.replicas import ReadYourWritesMiddleware, replicas
+from app.routers import auth, internal, metrics, post, root, user, vote
+from app.timing import ServerTimingMiddleware
+from app.vote_buffer import vote_buffer
 
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 
-# --- Build the database engine, along with the tables in the models file:
-models.Base.metadata.create_all(bind = engine)
+# --- Nothing here connects to the database. The tables are created (or migrated) by an explicit step before the
+# --- application is deployed, "alembic upgrade head" or "python -m app.manage create-schema", and the engine is
+# --- created by the startup hook.
+def create_app() -> FastAPI:
+    """
+    Overview:
+        Build the application: its routes, middleware and the startup / shutdown hooks that create and close the
+        database engine. uvicorn can call it with "uvicorn --factory app.main:create_app".
 
+    Returns:
+        FastAPI: The application.
+    """
+    # --- Create an instance of FastAPI
+    app = FastAPI(
+        # --- These details will be shown on the API documentation:
+        title = "Blog Post API Reference",
+        description ="This API is used for interacting with a database containing blog posts and more.",
+        version = "1.0.1",
+        default_response_class = ORJSONResponse if settings.fast_serialization else JSONResponse,
+        servers=[
+            {
+                "url": "http://localhost:8000",
+                "description": "Development Server"
+            }
+            ]
+        )
 
-# --- Create an instance of FastAPI
-app = FastAPI(
-    # --- These details will be shown on the API documentation:
-    title = "Blog Post API Reference",
-    description ="This API is used for interacting with a database containing blog posts and more.",
-    version = "1.0.1",
-    servers=[
-        {
-            "url": "http://localhost:8000",
-            "description": "Development Server"
-        }
-        ]
+
+    # --- Setup FastAPI to use CORS
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=allowed_origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        # --- Let browser clients read the cursor for the next page of a list endpoint, the ETag of a response and its timing:
+        expose_headers=["ETag", "Server-Timing", "X-Next-Cursor"],
     )
 
 
-# --- Setup FastAPI to use CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allowed_origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    # --- Report the SQL statements and database time of each request, when server_timing is switched on:
+    app.add_middleware(ServerTimingMiddleware)
+
+
+    # --- Count and time every request for the metrics at /metrics:
+    app.add_middleware(MetricsMiddleware)
+
+
+    # --- Send the reads of a client that has just changed something to the primary, when there are read replicas:
+    app.add_middleware(ReadYourWritesMiddleware)
+
+
+    # --- Create the database engine, open the database connections up front if asked to, start the password hashing
+    # --- processes, and start writing buffered votes, checking the read replicas and refreshing the post rankings.
+    # --- Creating the engine doesn't connect, so the application still starts while the database is down:
+    @app.on_event("startup")
+    async def startup():
+        request_engine()
+        
+        # --- Starting the processes blocks, so it runs in a thread while the pool warms up. It is awaited before the
+        # --- application starts serving, so a failure to start them stops the startup:
+        executor_started = asyncio.get_running_loop().run_in_executor(None, start_executor)
+        
+        if settings.db_pool_warmup:
+            await warm_up_pool(settings.db_pool_warmup)
+        
+        await executor_started
+            
+        if settings.vote_buffer:
+            vote_buffer.start()
+        
+        if replicas:
+            replicas.start()
+        
+        if settings.rankings_refresh_seconds > 0:
+            ranking_refresher.start()
+
+
+    # --- Write the votes still in the buffer, stop the background tasks and password hashing processes, and close the
+    # --- database connections:
+    @app.on_event("shutdown")
+    async def shutdown():
+        if settings.vote_buffer:
+            await vote_buffer.close()
+        
+        await ranking_refresher.close()
+
+        shutdown_executor()
+        await replicas.close()
+        await dispose_engines()
+
+
+    # --- Reference the files that contain the routes / path operations for the application:
+    app.include_router(auth.router)
+    app.include_router(internal.router)
+    app.include_router(metrics.router)
+    app.include_router(post.router)
+    app.include_router(root.router)
+    app.include_router(user.router)
+    app.include_router(vote.router)
+    
+    return app
 
 
-# --- Reference the files that contain the routes / path operations for the application:
-app.include_router(auth.router)
-app.include_router(post.router)
-app.include_router(root.router)
-app.include_router(user.router)
-app.include_router(vote.router)
+# --- The application for "uvicorn app.main:app":
+app = create_app()
@@ -0,0 +1,240 @@
+# --- This module contains the maintenance commands for the application.
+# --- Run them from the root of the repo, for example:
+# --- python -m app.manage check-vote-counts --repair
+# --- python -m app.manage create-schema
+# --- python -m app.manage create-trigram-index
+# --- python -m app.manage refresh-rankings
+# --- python -m app.manage purge-refresh-tokens
+
+# --- Import the required modules:
+import argparse
+import asyncio
+import os
+import sys
+from alembic import command
+from alembic.config import Config
+from app.config import settings
+from app.database import ThreadpoolSession, get_engine, get_session_factory
+from app.models.models import Post, RefreshToken, Vote
+from app.rankings import refresh_rankings
+from sqlalchemy import func, inspect, or_, select, text
+from sqlalchemy.orm import Session
+
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+
+
+def find_vote_count_drift(db: Session) -> list:
+    """
+    Overview:
+        Find the posts where the denormalised vote_count no longer matches the number of rows in the votes table.
+
+    Args:
+        db (Session): The database session to use.
+
+    Returns:
+        List: A row of (id, vote_count, actual) for each post that has drifted.
+    """
+    actual = func.count(Vote.post_id)
+
+    return db.query(Post.id, Post.vote_count, actual.label("actual"))\
+             .join(Vote, Vote.post_id == Post.id, isouter = True)\
+             .group_by(Post.id)\
+             .having(Post.vote_count != actual)\
+             .all()
+
+
+def repair_vote_count_drift(db: Session, post_ids: list) -> None:
+    """
+    Overview:
+        Recount the votes for the given posts and commit the corrected vote_count.
+        The count is taken in the UPDATE itself so a vote cast since find_vote_count_drift ran is not lost.
+
+    Args:
+        db (Session): The database session to use.
+        post_ids (list): The ids of the posts to repair.
+    """
+    actual = select(func.count()).where(Vote.post_id == Post.id).scalar_subquery()
+
+    db.query(Post).filter(Post.id.in_(post_ids)).update({Post.vote_count: actual}, synchronize_session = False)
+    db.commit()
+
+
+def check_vote_counts(args) -> int:
+    db = get_session_factory()()
+    try:
+        drift = find_vote_count_drift(db)
+
+        for post_id, vote_count, actual in drift:
+            print(f"Post {post_id}: vote_count is {vote_count}, votes table has {actual}.")
+
+        if drift and args.repair:
+            repair_vote_count_drift(db, [row.id for row in drift])
+            print(f"Repaired {len(drift)} post(s).")
+            return 0
+
+        print(f"{len(drift)} post(s) have drifted.")
+
+        # --- A non-zero exit code lets a scheduled check alert when drift is found:
+        return 1 if drift else 0
+    finally:
+        db.close()
+
+
+def purge_refresh_tokens(db: Session) -> int:
+    """
+    Overview:
+        Delete the refresh tokens that can no longer be used, as they have expired or been revoked. Login adds a row
+        each time and nothing else removes them, so this should be run on a schedule to keep the table small.
+
+    Args:
+        db (Session): The database session to use.
+
+    Returns:
+        Integer: The number of refresh tokens deleted.
+    """
+    deleted = db.query(RefreshToken)\
+                .filter(or_(RefreshToken.expires_at <= func.now(), RefreshToken.revoked_at != None))\
+                .delete(synchronize_session = False)
+    db.commit()
+
+    return deleted
+
+
+def purge_refresh_tokens_command(args) -> int:
+    db = get_session_factory()()
+    try:
+        deleted = purge_refresh_tokens(db)
+    finally:
+        db.close()
+
+    print(f"Deleted {deleted} expired or revoked refresh token(s).")
+
+    return 0
+
+
+# --- The revision matching the tables the application created at startup before the schema was migrated by Alembic.
+# --- The revisions after it only add what is missing, so a database created that way can be upgraded from it:
+UNTRACKED_REVISION = "9cbe2ac62829"
+
+
+def untracked_revision(inspector) -> str:
+    """
+    Overview:
+        Find the revision the tables of a database Alembic doesn't track match: the newest revision whose change is
+        already there, or UNTRACKED_REVISION if none is. The tables may have been created by create_all from any
+        version of the models, up to the current one (the benchmark dataset, for example).
+
+    Args:
+        inspector: A SQLAlchemy inspector for the database.
+
+    Returns:
+        String: The revision to stamp the database with.
+    """
+    tables = inspector.get_table_names()
+    post_columns = {column["name"] for column in inspector.get_columns("posts")} if "posts" in tables else set()
+    post_indexes = {index["name"] for index in inspector.get_indexes("posts")} if "posts" in tables else set()
+
+    # --- What each revision added, newest first:
+    changes = [("d94e1c6b3a57", "post_rankings" in inspector.get_view_names(include = ("materialized",))),
+               ("f0b7e94a2d61", "ix_posts_created_at_id" in post_indexes),
+               ("c81d5e7a2f49", "version" in post_columns),
+               ("3f9a06c4b1d8", "refresh_tokens" in tables),
+               ("e52c8a1f6d07", "search_vector" in post_columns),
+               ("b7d41e2a90c3", "vote_count" in post_columns)
+               ]
+
+    return next((revision for revision, present in changes if present), UNTRACKED_REVISION)
+
+
+def create_schema(args) -> int:
+    """
+    Overview:
+        Create the tables, which the application no longer does when it starts. An empty database is built by the
+        Alembic migrations, so it is tracked from the start. A database Alembic already tracks is upgraded to the
+        latest revision. A database whose tables were created by create_all (by an older version of the application at
+        startup, or by the benchmark dataset) is stamped with the revision those tables match, then upgraded, which
+        adds the columns, indexes and tables it is missing.
+    """
+    config = Config(ALEMBIC_INI)
+    config.set_main_option("script_location", os.path.join(os.path.dirname(ALEMBIC_INI), "alembic"))
+    inspector = inspect(get_engine())
+    tables = inspector.get_table_names()
+
+    if tables and "alembic_version" not in tables:
+        revision = untracked_revision(inspector)
+        print(f"Alembic doesn't track this database yet. Stamping it with {revision} before upgrading it.")
+        command.stamp(config, revision)
+
+    command.upgrade(config, "head")
+
+    # --- The trigram index isn't part of the migrations, so it is added here for the databases that use it:
+    if settings.search_trigram:
+        create_trigram_index(args)
+
+    return 0
+
+
+def create_trigram_index(args) -> int:
+    """
+    Overview:
+        Create the pg_trgm extension and the trigram index on posts.title that search_trigram needs. They aren't part
+        of the migrations, as not every Postgres has pg_trgm, so run this before switching search_trigram on. The index
+        is built concurrently, so it can be run against a live database. It does nothing if the index already exists.
+    """
+    with get_engine().connect().execution_options(isolation_level = "AUTOCOMMIT") as connection:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        connection.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_title_trgm "
+                                "ON posts USING gin (title gin_trgm_ops)"))
+
+    print("Created the trigram index on posts.title.")
+
+    return 0
+
+
+def refresh_rankings_command(args) -> int:
+    db = ThreadpoolSession(get_session_factory()())
+    try:
+        refreshed = asyncio.run(refresh_rankings(db))
+    finally:
+        db.sync_session.close()
+
+    print("Refreshed the post rankings." if refreshed else "The post rankings are already being refreshed.")
+
+    return 0
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description = "Maintenance commands for the Blog Post API.")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    check = commands.add_parser("check-vote-counts",
+                                help = "Compare posts.vote_count with the votes table.")
+    check.add_argument("--repair",
+                       action = "store_true",
+                       help = "Recount the votes for every post that has drifted.")
+    check.set_defaults(handler = check_vote_counts)
+
+    schema = commands.add_parser("create-schema",
+                                 help = "Create the tables, or upgrade them to the latest migration.")
+    schema.set_defaults(handler = create_schema)
+
+    trigram = commands.add_parser("create-trigram-index",
+                                  help = "Create the pg_trgm extension and the trigram index search_trigram needs.")
+    trigram.set_defaults(handler = create_trigram_index)
+
+    rankings = commands.add_parser("refresh-rankings",
+                                   help = "Refresh the rankings behind the hot and top sorts of the post list.")
+    rankings.set_defaults(handler = refresh_rankings_command)
+
+    purge = commands.add_parser("purge-refresh-tokens",
+                                help = "Delete the refresh tokens that have expired or been revoked.")
+    purge.set_defaults(handler = purge_refresh_tokens_command)
+
+    args = parser.parse_args(argv)
+
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# --- This module contains the metrics the application exposes at /metrics in the Prometheus text format.
+# ---
+# --- Requests are labelled by the path template of their route (/post/{id} rather than /post/1) so the number of
+# --- series stays fixed. Requests that match no route are counted under "unmatched".
+# ---
+# --- Under gunicorn each worker is a separate process with its own metrics. Set PROMETHEUS_MULTIPROC_DIR to an empty
+# --- directory before gunicorn starts (gunicorn.conf.py clears it and tidies up after workers that exit) and every
+# --- worker writes its metrics there, so whichever worker answers /metrics reports the totals for all of them.
+
+# --- Import the required modules:
+import os
+import time
+
+from app.config import settings
+from app.database import request_engine
+from app.pool import TimedPoolMixin, pool_status
+from app.replicas import replicas
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import generate_latest, multiprocess
+from starlette.routing import Match
+
+
+REQUESTS = Counter("http_requests_total",
+                   "Requests handled, by route and status code.",
+                   ["method", "route", "status"])
+REQUEST_SECONDS = Histogram("http_request_duration_seconds",
+                            "Time taken to handle a request, until its response has been sent.",
+                            ["method", "route"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight",
+                           "Requests being handled.",
+                           ["method", "route"],
+                           multiprocess_mode = "livesum")
+
+PASSWORD_HASH_SECONDS = Histogram("password_hash_seconds",
+                                  "Time taken to hash or verify a password, including waiting for a hashing process.",
+                                  ["function"],
+                                  buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+PASSWORD_HASH_REJECTED = Counter("password_hash_rejected_total",
+                                 "Requests turned away with a 503 as too many password hashes were queued.")
+
+DB_POOL_SIZE = Gauge("db_pool_size", "Connections kept open by the pool.", ["pool"], multiprocess_mode = "livesum")
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections in use.", ["pool"], multiprocess_mode = "livesum")
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow", "Connections open beyond the pool size.", ["pool"],
+                         multiprocess_mode = "livesum")
+DB_POOL_CHECKOUTS = Counter("db_pool_checkouts", "Connections handed out by the pool.", ["pool"])
+DB_POOL_TIMEOUTS = Counter("db_pool_timeouts", "Requests that gave up waiting for a connection.", ["pool"])
+DB_POOL_WAIT_SECONDS = Counter("db_pool_wait_seconds", "Time spent waiting for a connection.", ["pool"])
+
+# --- The pool counters are copied from the pool's own counters (see app/pool.py) at most once a second per worker:
+POOL_UPDATE_SECONDS = 1.0
+_pool_updated_at = 0.0
+_pool_counted = {}
+
+
+def pools() -> dict:
+    """
+    Overview:
+        The connection pools that serve requests: the primary, and each read replica once it has been used. Replicas
+        whose engines were given another kind of pool have no wait counters, so they are left out.
+    """
+    found = {"primary": request_engine().pool}
+
+    for number, replica in enumerate(replicas.replicas):
+        if isinstance(replica.pool, TimedPoolMixin):
+            found[f"replica_{number}"] = replica.pool
+
+    return found
+
+
+def update_pool_metrics(force: bool = False) -> None:
+    global _pool_updated_at
+
+    now = time.monotonic()
+
+    if not force and now - _pool_updated_at < POOL_UPDATE_SECONDS:
+        return
+
+    _pool_updated_at = now
+
+    for name, pool in pools().items():
+        status = pool_status(pool)
+        counted = _pool_counted.setdefault(name, {"checkouts": 0, "timeouts": 0, "wait_seconds_total": 0.0})
+
+        DB_POOL_SIZE.labels(name).set(status["size"])
+        DB_POOL_CHECKED_OUT.labels(name).set(status["checked_out"])
+        DB_POOL_OVERFLOW.labels(name).set(status["overflow"])
+
+        for key, counter in (("checkouts", DB_POOL_CHECKOUTS),
+                             ("timeouts", DB_POOL_TIMEOUTS),
+                             ("wait_seconds_total", DB_POOL_WAIT_SECONDS)):
+            counter.labels(name).inc(max(status[key] - counted[key], 0))
+            counted[key] = status[key]
+
+
+def route_template(scope) -> str:
+    """Return the path template of the route a request will be handled by, or "unmatched"."""
+    partial = "unmatched"
+
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial == "unmatched":
+            partial = route.path
+
+    return partial
+
+
+def render() -> tuple:
+    """
+    Overview:
+        Build the body of the /metrics response. With PROMETHEUS_MULTIPROC_DIR set, the metrics of every worker are
+        read from the directory and added together.
+
+    Returns:
+        Tuple: The body and its content type.
+    """
+    update_pool_metrics(force = True)
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """
+    Overview:
+        Count, time and track in flight every HTTP request, when metrics are switched on. The route is found before
+        the request is handled, so the in flight gauge has its label, and the status code is read as the response
+        starts. A request that fails with an exception is counted as a 500.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.metrics:
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        route = route_template(scope)
+        in_flight = REQUESTS_IN_FLIGHT.labels(method, route)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+
+            await send(message)
+
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_SECONDS.labels(method, route).observe(time.perf_counter() - start)
+            REQUESTS.labels(method, route, str(status_code)).inc()
+            in_flight.dec()
+            update_pool_metrics()
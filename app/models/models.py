@@ -1,9 +1,16 @@
+from app.config import settings
 from app.database import Base
-from sqlalchemy import Column, String, Integer, Boolean, TIMESTAMP, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Computed, DDL, String, Integer, Boolean, TIMESTAMP, ForeignKey, Index, MetaData, Table
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, TSVECTOR
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.sql.expression import null, text
 
 
+# --- The Postgres text search configuration used to build and query posts.search_vector:
+SEARCH_CONFIG = "english"
+
+
 # --- Create a class for a post that is an extension of Base from the database.py file:
 class Post(Base):
     # --- ___tablename___ tells SQLAlchemy which table to use for this model.
@@ -18,7 +25,26 @@ class Post(Base):
     published  = Column(Boolean, server_default = "TRUE", nullable = False)
     created_at = Column(TIMESTAMP(timezone = True), nullable = False, server_default = text("now()"))
     owner_id   = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable = False)
+    # --- The number of rows in votes for this post. It is kept up to date by the vote router in the same transaction
+    # --- as the vote itself, so reads don't have to count the votes table. "python -m app.manage check-vote-counts"
+    # --- will find and repair any drift:
+    vote_count = Column(Integer, server_default = "0", nullable = False)
+    # --- Goes up by one every time the post or its vote count changes. It is used to build the ETag for the post:
+    version    = Column(Integer, server_default = "1", nullable = False)
     owner      = relationship("User")
+    # --- The title (weighted highest) and content as a tsvector, kept up to date by Postgres. It is deferred so it
+    # --- is only loaded if it is asked for, as none of the responses include it:
+    search_vector = deferred(Column(TSVECTOR, Computed(f"setweight(to_tsvector('{SEARCH_CONFIG}', title), 'A') || "
+                                                       f"setweight(to_tsvector('{SEARCH_CONFIG}', content), 'B')",
+                                                       persisted = True)))
+    
+    # --- The list endpoints page newest first on (created_at, id), so they can walk these indexes instead of sorting:
+    # --- all posts for the feed, or the posts of one owner for /post/my-posts (and deleting a user's posts).
+    # --- The GIN index serves the full-text matches for the search parameter.
+    # --- Note: indexes added here also need an Alembic revision (see alembic/versions):
+    __table_args__ = (Index("ix_posts_created_at_id", created_at, id),
+                      Index("ix_posts_owner_id_created_at_id", owner_id, created_at, id),
+                      Index("ix_posts_search_vector", search_vector, postgresql_using = "gin"))
 
 # --- Create a class for a user that is an extension of Base from the database.py file:
 class User(Base):
@@ -39,4 +65,68 @@ class Vote(Base):
      
     # --- Define the columns for this model:
     post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key = True, nullable = False)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key = True, nullable = False)
\ No newline at end of file
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key = True, nullable = False)
+    
+    # --- The primary key starts with post_id, so it can't find the votes of a user (or delete them with the user):
+    __table_args__ = (Index("ix_votes_user_id", user_id),)
+
+
+# --- Create a class that will create a table called refresh_tokens:
+class RefreshToken(Base):
+    # --- specify the table name to use.
+    __tablename__ = "refresh_tokens"
+    
+    # --- Define the columns for this model.
+    # --- Only a SHA-256 hash of each token is stored, so the tokens can't be used by anyone who reads the table:
+    id         = Column(Integer, primary_key = True, nullable = False)
+    user_id    = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable = False, index = True)
+    token_hash = Column(String, nullable = False, unique = True)
+    created_at = Column(TIMESTAMP(timezone = True), nullable = False, server_default = text("now()"))
+    expires_at = Column(TIMESTAMP(timezone = True), nullable = False)
+    revoked_at = Column(TIMESTAMP(timezone = True), nullable = True)
+
+
+# --- The trigram index on posts.title serves the substring (ILIKE) and typo tolerant (<%) title matches for the
+# --- search parameter. It needs the pg_trgm extension, so it isn't part of the migrations: it is created by
+# --- "python -m app.manage create-trigram-index", and along with the tables by create_all when search_trigram is
+# --- switched on:
+def _search_trigram_enabled(*args, **kwargs):
+    return settings.search_trigram
+
+
+event.listen(Post.__table__, "before_create",
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(callable_ = _search_trigram_enabled))
+event.listen(Post.__table__, "after_create",
+             DDL("CREATE INDEX IF NOT EXISTS ix_posts_title_trgm ON posts USING gin (title gin_trgm_ops)")\
+             .execute_if(callable_ = _search_trigram_enabled))
+
+
+# --- The rankings for the hot and top sorts of the post list, as a materialized view refreshed on a schedule (see
+# --- app/rankings.py), so a ranked page is an index range read rather than a sort of every post.
+# --- The hot score is the votes (plus one) divided by the age of the post in hours (plus two) to the power of
+# --- HOT_GRAVITY, so new posts with a few votes rise above old posts with many. The ages are taken when the view is
+# --- refreshed. The unique index on post_id lets the view be refreshed concurrently, without blocking reads:
+HOT_GRAVITY = 1.8
+
+post_rankings_ddl = [
+    DDL("CREATE MATERIALIZED VIEW IF NOT EXISTS post_rankings AS "
+        "SELECT id AS post_id, vote_count AS votes, "
+        f"CAST((vote_count + 1) / power(extract(epoch FROM now() - created_at) / 3600 + 2, {HOT_GRAVITY}) "
+        "AS double precision) AS hot_score "
+        "FROM posts"),
+    DDL("CREATE UNIQUE INDEX IF NOT EXISTS ix_post_rankings_post_id ON post_rankings (post_id)"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_post_rankings_hot ON post_rankings (hot_score, post_id)"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_post_rankings_top ON post_rankings (votes, post_id)")
+]
+
+# --- It isn't part of Base.metadata, so create_all doesn't create it as a table. The view is created along with the
+# --- posts table (and by an Alembic revision), and has to be dropped before it:
+post_rankings = Table("post_rankings", MetaData(),
+                      Column("post_id", Integer, primary_key = True),
+                      Column("votes", Integer),
+                      Column("hot_score", DOUBLE_PRECISION))
+
+for ddl in post_rankings_ddl:
+    event.listen(Post.__table__, "after_create", ddl)
+
+event.listen(Post.__table__, "before_drop", DDL("DROP MATERIALIZED VIEW IF EXISTS post_rankings"))
@@ -0,0 +1,100 @@
+# --- This module contains the helpers used by the list endpoints to page through results with a keyset (cursor)
+# --- rather than LIMIT / OFFSET. OFFSET makes the database read and throw away every row before the requested page,
+# --- whereas a keyset page starts from an index position, so page 1,000 costs the same as page 1.
+
+# --- Import the required modules:
+import base64
+import json
+from datetime import datetime
+from fastapi import HTTPException, status
+from sqlalchemy import tuple_
+
+
+# --- The largest page any list endpoint will return, regardless of the limit the client asks for:
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(values: list) -> str:
+    """
+    Overview:
+        Turn the sort key values of the last row in a page into an opaque, URL safe cursor string.
+
+    Args:
+        values (list): The values of the sort columns for the last row, in the same order as the sort columns.
+
+    Returns:
+        String: The cursor to send back to the client.
+    """
+    raw = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values],
+                     separators = (",", ":"))
+
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns: list) -> list:
+    """
+    Overview:
+        Turn a cursor created by encode_cursor back into the sort key values, using the types of the sort columns.
+
+    Args:
+        cursor (string): The cursor the client sent.
+        columns (list): The sort columns the cursor was created for.
+
+    Returns:
+        List: The sort key values. A 400 is raised if the cursor has been tampered with or is for another sort order.
+    """
+    invalid_cursor = HTTPException(status_code = status.HTTP_400_BAD_REQUEST,
+                                   detail = "Invalid cursor.")
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise invalid_cursor
+
+        return [datetime.fromisoformat(value) if column.type.python_type is datetime else column.type.python_type(value)
+                for column, value in zip(columns, values)]
+
+    except (ValueError, TypeError):
+        raise invalid_cursor
+
+
+def apply_keyset(query, columns: list, cursor: str = None, limit: int = 10):
+    """
+    Overview:
+        Order the query newest first by the sort columns and limit it to one page. One extra row is requested so that
+        next_page can tell if there is a following page without running a second query.
+
+    Args:
+        query: The SQLAlchemy query to page.
+        columns (list): The sort columns. The last one must be unique (normally the primary key) to break ties.
+        cursor (string): The cursor returned with the previous page, if any.
+        limit (int): The number of rows in a page.
+
+    Returns:
+        The query with the keyset filter, ordering and limit applied.
+    """
+    if cursor:
+        query = query.filter(tuple_(*columns) < tuple_(*decode_cursor(cursor, columns)))
+
+    return query.order_by(*[column.desc() for column in columns]).limit(limit + 1)
+
+
+def next_page(rows: list, limit: int, key) -> tuple:
+    """
+    Overview:
+        Trim the extra row requested by apply_keyset and build the cursor for the next page.
+
+    Args:
+        rows (list): The rows returned by the query built by apply_keyset.
+        limit (int): The number of rows in a page.
+        key: A function that returns the sort key values for a row.
+
+    Returns:
+        Tuple: The rows for this page and the cursor for the next page (None on the last page).
+    """
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+
+    return rows, encode_cursor(key(rows[-1]))
@@ -0,0 +1,94 @@
+# --- This module contains the connection pools used by the database engines. They are the standard SQLAlchemy queue
+# --- pools with counters added for how long requests wait for a connection, so the pool can be sized against the
+# --- database from the numbers reported at /metrics and /internal/pool (when internal_routes is switched on).
+
+# --- Import the required modules:
+import threading
+import time
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+class PoolWaitStats:
+    """Counters for the time spent waiting for a connection from a pool. They are shared by every thread using it."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, seconds: float, timed_out: bool = False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+
+class TimedPoolMixin:
+    """
+    Overview:
+        Times every checkout from the pool. The time includes opening a new connection when the pool has to
+        (overflow connections and the first use of each pooled one), as that is also time a request waits.
+    """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            self.wait_stats.record(time.perf_counter() - start, timed_out = True)
+            raise
+        self.wait_stats.record(time.perf_counter() - start)
+
+        return connection
+
+    @property
+    def wait_stats(self) -> PoolWaitStats:
+        if "_wait_stats" not in self.__dict__:
+            self._wait_stats = PoolWaitStats()
+
+        return self._wait_stats
+
+    def recreate(self):
+        # --- Keep the counters when the pool is replaced, for example by engine.dispose():
+        pool = super().recreate()
+        pool._wait_stats = self.wait_stats
+
+        return pool
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_status(pool) -> dict:
+    """
+    Overview:
+        Report the current state of a pool along with its wait counters.
+
+    Args:
+        pool: The pool of an engine (engine.pool).
+
+    Returns:
+        Dictionary: The pool size and connection counts, and the wait counters (in seconds).
+    """
+    stats = pool.wait_stats
+
+    with stats.lock:
+        return {"size": pool.size(),
+                "max_overflow": pool._max_overflow,
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": max(pool.overflow(), 0),
+                "checkouts": stats.checkouts,
+                "timeouts": stats.timeouts,
+                "wait_seconds_total": round(stats.wait_seconds, 6),
+                "wait_seconds_max": round(stats.max_wait_seconds, 6)
+                }
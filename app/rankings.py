@@ -0,0 +1,79 @@
+# --- This module refreshes the post_rankings materialized view behind the hot and top sorts of the post list (see
+# --- app/models/models.py) every rankings_refresh_seconds, or on demand with "python -m app.manage refresh-rankings".
+# ---
+# --- The view is refreshed concurrently, so the ranked pages keep being served from the old rankings while the new ones
+# --- are built. Every worker runs the schedule, but they take an advisory lock first and skip the refresh if another
+# --- worker is already running one. Posts created since the last refresh aren't in the hot and top sorts yet, and the
+# --- vote counts they rank by are as they were at the last refresh.
+
+# --- Import the required modules:
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from app.config import settings
+from app.database import get_db
+from sqlalchemy import func, select, text
+
+
+logger = logging.getLogger(__name__)
+
+# --- The advisory lock held while refreshing, so only one worker refreshes at a time:
+REFRESH_LOCK = 72_046_001
+
+
+async def refresh_rankings(db) -> bool:
+    """
+    Overview:
+        Refresh the post_rankings view, unless another worker is refreshing it already.
+
+    Args:
+        db: The database session to refresh with. Its transaction is committed.
+
+    Returns:
+        Bool: Whether the view was refreshed.
+    """
+    if not (await db.execute(select(func.pg_try_advisory_xact_lock(REFRESH_LOCK)))).scalar():
+        await db.rollback()
+        return False
+
+    await db.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY post_rankings"))
+    await db.commit()
+
+    return True
+
+
+class RankingRefresher:
+    """
+    Overview:
+        Refreshes the post rankings in the background every rankings_refresh_seconds.
+    """
+    def __init__(self):
+        self.session_factory = asynccontextmanager(get_db)
+        self.task = None
+
+    async def refresh(self) -> bool:
+        try:
+            async with self.session_factory() as db:
+                return await refresh_rankings(db)
+        except Exception:
+            logger.exception("Could not refresh the post rankings.")
+            return False
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.rankings_refresh_seconds)
+            await self.refresh()
+
+    def start(self) -> None:
+        """Start refreshing the rankings in the background."""
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+
+# --- Create the refresher. It is only started when rankings_refresh_seconds is above 0:
+ranking_refresher = RankingRefresher()
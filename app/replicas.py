@@ -0,0 +1,253 @@
+# --- This module routes the read-only routes to read replicas of the database, when database_replica_urls is set.
+# ---
+# --- Each replica is checked every replica_check_seconds in the background: it is used while it answers and is no more
+# --- than replica_max_lag_seconds behind the primary, and the healthy replicas take turns. Until the first check
+# --- passes, and whenever no replica is healthy, the reads go to the primary.
+# ---
+# --- A replica may not have a change yet right after it was made, so a client that has just changed something reads
+# --- from the primary until a replica is known to have caught up: its lag at the last check, plus the time since that
+# --- check, has to be shorter than the time since the change. Clients are told apart by their Authorization header.
+# --- The changes are remembered by each worker process, so with several workers a read can still reach a replica
+# --- that is behind if it is handled by another worker than the change.
+
+# --- Import the required modules:
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from app.config import settings
+from app.database import ThreadpoolSession, get_db, pool_options
+from app.pool import TimedAsyncAdaptedQueuePool, TimedQueuePool
+from app.timing import instrument
+from fastapi import Depends, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+
+logger = logging.getLogger(__name__)
+
+# --- How far behind the primary a replica is, in seconds. A replica that has replayed everything it has received
+# --- counts as up to date, as the time of the last replayed transaction only grows while the primary is idle:
+LAG_QUERY = text("SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+                 "THEN 0 ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END")
+
+# --- The methods that don't change anything, so don't make a client read from the primary:
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class Replica:
+    """
+    Overview:
+        One read replica, with its engine (created on first use) and the result of its last health check.
+
+    Args:
+        url (string): The SQLAlchemy URL of the replica, without a driver.
+        engine_options (dict): Options for the engine, in place of the pool settings shared with the primary.
+    """
+    def __init__(self, url: str, **engine_options):
+        self.url = make_url(url)
+        self.engine_options = engine_options
+        self.engine = None
+        self.session_factory = None
+        self.healthy = False
+        self.lag_seconds = 0.0
+        self.checked_at = 0.0
+
+    def connect(self):
+        """Return the engine for the replica, creating it on first use."""
+        if self.engine is None:
+            if settings.database_async:
+                self.engine = create_async_engine(self.url.set(drivername = f"{self.url.get_backend_name()}+asyncpg"),
+                                                  **(self.engine_options or {"poolclass": TimedAsyncAdaptedQueuePool,
+                                                                             **pool_options()}))
+                instrument(self.engine.sync_engine)
+                self.session_factory = sessionmaker(autocommit = False, autoflush = False, expire_on_commit = False,
+                                                    bind = self.engine, class_ = AsyncSession)
+            else:
+                self.engine = create_engine(self.url, **(self.engine_options or {"poolclass": TimedQueuePool,
+                                                                                  **pool_options()}))
+                instrument(self.engine)
+                self.session_factory = sessionmaker(autocommit = False, autoflush = False, expire_on_commit = False,
+                                                    bind = self.engine)
+
+        return self.engine
+
+    @property
+    def pool(self):
+        """The connection pool of the replica, or None until its engine is created."""
+        return getattr(self.engine, "sync_engine", self.engine).pool if self.engine is not None else None
+
+    def lag_bound(self, now: float) -> float:
+        """The most the replica can be behind now: its lag at the last check, plus the time since."""
+        return self.lag_seconds + now - self.checked_at
+
+    async def check(self) -> None:
+        engine = self.connect()
+        try:
+            if settings.database_async:
+                async with engine.connect() as connection:
+                    lag = (await connection.execute(LAG_QUERY)).scalar()
+            else:
+                def read_lag():
+                    with engine.connect() as connection:
+                        return connection.execute(LAG_QUERY).scalar()
+
+                lag = await run_in_threadpool(read_lag)
+        except Exception as error:
+            if self.healthy:
+                logger.warning("Read replica %s failed its health check: %s", self.url.host, error)
+            self.healthy = False
+            return
+
+        self.lag_seconds = float(lag or 0)
+        self.checked_at = time.monotonic()
+        healthy = self.lag_seconds <= settings.replica_max_lag_seconds
+
+        if healthy != self.healthy:
+            logger.warning("Read replica %s is %s (%.1fs behind).", self.url.host,
+                           "in use" if healthy else "out of use", self.lag_seconds)
+        self.healthy = healthy
+
+    async def close(self) -> None:
+        if self.engine is not None:
+            if settings.database_async:
+                await self.engine.dispose()
+            else:
+                await run_in_threadpool(self.engine.dispose)
+
+
+class ReplicaSet:
+    """
+    Overview:
+        The read replicas, the background health checks and the record of which clients have just changed something.
+
+    Args:
+        urls (list): The SQLAlchemy URLs of the replicas. Read from database_replica_urls on first use if not given.
+        engine_options (dict): Options for the replica engines, in place of the pool settings.
+    """
+    def __init__(self, urls: list = None, **engine_options):
+        self._urls = urls
+        self.engine_options = engine_options
+        self._replicas = None
+        self.turn = 0
+        self.writes = {}
+        self.task = None
+
+    @property
+    def replicas(self) -> list:
+        if self._replicas is None:
+            urls = settings.database_replica_urls if self._urls is None else self._urls
+            self._replicas = [Replica(url, **self.engine_options) for url in urls]
+
+        return self._replicas
+
+    def __bool__(self) -> bool:
+        return bool(self.replicas)
+
+    def record_write(self, client: str) -> None:
+        now = time.monotonic()
+        self.writes[client] = now
+
+        # --- Forget the changes no replica can still be behind on, so the record doesn't grow without end:
+        if len(self.writes) > 10000:
+            window = settings.replica_max_lag_seconds + settings.replica_check_seconds
+            self.writes = {key: written for key, written in self.writes.items() if now - written < window}
+
+    def pick(self, client: str = None) -> Optional[Replica]:
+        """
+        Overview:
+            Choose the replica to read from, taking turns between the healthy ones.
+
+        Args:
+            client (string): The Authorization header of the request, if it has one.
+
+        Returns:
+            Replica: The replica to read from, or None to read from the primary.
+        """
+        now = time.monotonic()
+        written = self.writes.get(client) if client else None
+        candidates = [replica for replica in self.replicas
+                      if replica.healthy and (written is None or replica.lag_bound(now) < now - written)]
+
+        if not candidates:
+            return None
+
+        self.turn += 1
+
+        return candidates[self.turn % len(candidates)]
+
+    async def check(self) -> None:
+        """Check every replica once."""
+        await asyncio.gather(*[replica.check() for replica in self.replicas])
+
+    async def run(self) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(settings.replica_check_seconds)
+
+    def start(self) -> None:
+        """Start checking the replicas in the background."""
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self) -> None:
+        """Stop the checks and close the replica connections."""
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+        for replica in self.replicas:
+            await replica.close()
+
+
+# --- Create the replica set. The replicas are read from the settings the first time it is used:
+replicas = ReplicaSet()
+
+
+# --- The session for a read-only route: a replica when one can be used, otherwise the primary session from get_db.
+# --- Sessions don't connect until they are first used, so the primary session costs nothing when it isn't:
+async def get_read_db(request: Request, db = Depends(get_db)):
+    replica = replicas.pick(request.headers.get("authorization")) if replicas else None
+
+    if replica is None:
+        yield db
+        return
+
+    replica.connect()
+
+    if settings.database_async:
+        async with replica.session_factory() as replica_db:
+            yield replica_db
+    else:
+        replica_db = ThreadpoolSession(replica.session_factory())
+        try:
+            yield replica_db
+        finally:
+            await replica_db.close()
+
+
+class ReadYourWritesMiddleware:
+    """
+    Overview:
+        Remember the clients that have just changed something (a request other than GET, HEAD or OPTIONS that
+        succeeded), so get_read_db sends their reads to the primary until a replica has caught up.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS or not replicas:
+            return await self.app(scope, receive, send)
+
+        client = dict(scope["headers"]).get(b"authorization")
+
+        async def send_and_record(message):
+            if message["type"] == "http.response.start" and client and message["status"] < 400:
+                replicas.record_write(client.decode("latin-1"))
+
+            await send(message)
+
+        await self.app(scope, receive, send_and_record)
@@ -1,12 +1,14 @@
 # --- Import the required modules:
 from fastapi import APIRouter, Depends, status, HTTPException, Response
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
-from app.models.models import User
-from app.schemas import Token
-from app.auth.oauth2 import create_access_token
-from app.auth.hash_pwd import verify_password_hash
+from app.models.models import RefreshToken, User
+from app.schemas import RefreshTokenRequest, Token
+from app.auth.oauth2 import create_access_token, create_refresh_token, get_current_user, hash_refresh_token
+from app.auth.hash_pwd import verify_password_async
+from app.auth.user_cache import user_cache
 
 
 router = APIRouter(tags = ["Authentication"])
@@ -15,11 +17,12 @@ router = APIRouter(tags = ["Authentication"])
 @router.post("/login", response_model = Token)
 # --- Note: OAuth2PasswordRequestForm requires the credentials to be sent as a form rather than JSON body.
 # --- It requires a "username" and a "password" to be sent in the form.
-def login(user_credentials: OAuth2PasswordRequestForm = Depends(), 
-          db: Session = Depends(get_db)):
+async def login(user_credentials: OAuth2PasswordRequestForm = Depends(), 
+                db: AsyncSession = Depends(get_db)):
     
     # --- Query the database to find the user account by their email address:
-    user = db.query(User).filter(User.email == user_credentials.username).first()
+    result = await db.execute(select(User).filter(User.email == user_credentials.username))
+    user = result.scalars().first()
     
     # --- If the user cannot be found, raise a 404:
     if user == None:
@@ -27,19 +30,78 @@ def login(user_credentials: OAuth2PasswordRequestForm = Depends(),
                             detail= "Invalid Credentials. Please Try Again.")
 
     
-    # --- Check the password entered by the user matches the hashed password in the users table for that user:
-    check_hash = verify_password_hash(plain_password = user_credentials.password, 
-                                      hashed_password = user.password)
+    # --- Check the password entered by the user matches the hashed password in the users table for that user.
+    # --- bcrypt is slow on purpose, so it is run in the hashing processes:
+    check_hash, new_hash = await verify_password_async(user_credentials.password, user.password)
     
     # --- If check_has is false, raise a 404:
     if not check_hash:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, 
                             detail= "Invalid Credentials. Please Try Again.")
     
+    # --- If the stored hash was made with a different bcrypt cost to the current one, replace it:
+    if new_hash:
+        await db.execute(update(User).where(User.id == user.id).values(password = new_hash))
+    
+    # --- Issue a refresh token, so the client can get new access tokens from /token/refresh without sending the
+    # --- password (and paying for bcrypt) again:
+    refresh_token, token_hash, expires_at = create_refresh_token()
+    db.add(RefreshToken(user_id = user.id, 
+                        token_hash = token_hash, 
+                        expires_at = expires_at))
+    await db.commit()
+    
     # --- If the users password matches, generate a JWT bearer token:
-    access_token = create_access_token(data = {"user_id": user.id})
+    # --- The email is included so that get_current_user doesn't need to look the user up in the claims auth mode:
+    access_token = create_access_token(data = {"user_id": user.id, 
+                                               "email": user.email})
     
     # --- Return the token details to the user:
+    return {"access_token": access_token,
+            "token_type": "bearer",
+            "refresh_token": refresh_token
+            }
+
+
+@router.post("/token/refresh", response_model = Token)
+async def refresh_access_token(request: RefreshTokenRequest,
+                               db: AsyncSession = Depends(get_db)):
+    
+    # --- Find the user for the refresh token. This is a single lookup on the unique token_hash index:
+    result = await db.execute(select(User.id, User.email)
+                              .join(RefreshToken, RefreshToken.user_id == User.id)
+                              .filter(RefreshToken.token_hash == hash_refresh_token(request.refresh_token),
+                                      RefreshToken.revoked_at == None,
+                                      RefreshToken.expires_at > func.now()))
+    user = result.first()
+    
+    # --- If the token doesn't exist, has expired or has been revoked, raise a 401:
+    if user == None:
+        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED,
+                            detail = "Invalid or expired refresh token.",
+                            headers = {"WWW-Authenticate": "Bearer"})
+    
+    access_token = create_access_token(data = {"user_id": user.id, 
+                                               "email": user.email})
+    
     return {"access_token": access_token,
             "token_type": "bearer"
-            }
\ No newline at end of file
+            }
+
+
+@router.post("/token/revoke-all", status_code = status.HTTP_204_NO_CONTENT)
+# --- Revoke every refresh token the logged in user has, for example after a password change or a lost device.
+# --- Access tokens that have already been issued stay valid until they expire:
+async def revoke_refresh_tokens(db: AsyncSession = Depends(get_db),
+                                current_user: int = Depends(get_current_user)):
+    
+    await db.execute(update(RefreshToken)
+                     .where(RefreshToken.user_id == current_user.id, 
+                            RefreshToken.revoked_at == None)
+                     .values(revoked_at = func.now())
+                     .execution_options(synchronize_session = False))
+    await db.commit()
+    
+    user_cache.invalidate(current_user.id)
+    
+    return Response(status_code = status.HTTP_204_NO_CONTENT)
\ No newline at end of file
@@ -0,0 +1,31 @@
+# --- Import the required modules:
+from app.config import settings
+from app.metrics import pools
+from app.pool import pool_status
+from fastapi import APIRouter, Depends, HTTPException, status
+
+
+# --- The routes answer 404, as if they didn't exist, unless internal_routes is switched on:
+def internal_routes_enabled():
+    if not settings.internal_routes:
+        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND, detail = "Not Found")
+
+
+# --- Create a router variable that uses the APIRouter class.
+# --- These routes are for operating the API rather than for clients, so they are left out of the documentation:
+router = APIRouter(
+    prefix = "/internal",
+    tags = ["Internal"],
+    include_in_schema = False,
+    dependencies = [Depends(internal_routes_enabled)]
+    )
+
+
+# --- Report the state of the database connection pools that serve requests:
+@router.get("/pool", 
+            name = "Database Pool Statistics.", 
+            summary = "Returns the connection counts and wait counters of the database connection pools."
+            )
+
+async def get_pool_status():
+    return {name: pool_status(pool) for name, pool in pools().items()}
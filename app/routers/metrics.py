@@ -0,0 +1,31 @@
+# --- Import the required modules:
+from app.config import settings
+from app.metrics import render
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+
+
+# --- The metrics answer 404, as if they didn't exist, when metrics is switched off:
+def metrics_enabled():
+    if not settings.metrics:
+        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND, detail = "Not Found")
+
+
+# --- Create a router variable that uses the APIRouter class.
+# --- The metrics are for Prometheus to scrape rather than for clients, so they are left out of the documentation:
+router = APIRouter(
+    tags = ["Internal"],
+    include_in_schema = False,
+    dependencies = [Depends(metrics_enabled)]
+    )
+
+
+# --- Report the application metrics in the Prometheus text format:
+@router.get("/metrics", 
+            name = "Application Metrics.", 
+            summary = "Returns the request, database pool and password hashing metrics for Prometheus."
+            )
+
+async def get_metrics():
+    body, content_type = render()
+    
+    return Response(content = body, media_type = content_type)
@@ -1,13 +1,24 @@
 # --- Import the required modules:
 from app.models import models
-from app.auth.oauth2 import get_current_user
+from app.auth.oauth2 import get_current_user, get_optional_user_id, raise_for_deleted_user
+from app.config import settings
 from app.database import get_db
-from app.schemas import PostCreate, PostResponse, AllPostsResponseVotes
-from fastapi import status, HTTPException, Depends, APIRouter, Response
+from app.etag import etag_matches, make_etag, not_modified
+from app.pagination import MAX_PAGE_SIZE, apply_keyset, next_page
+from app.replicas import get_read_db
+from app.search import post_search
+from app.serializers import fast_response, post_dict, post_votes_dict
+from app.schemas import PostBatchCreate, PostBatchResponse, PostCreate, PostResponse, AllPostsResponseVotes
+from datetime import datetime
+from fastapi import status, HTTPException, Depends, APIRouter, Request, Response
 from fastapi.param_functions import Query
-from typing import List, Optional
-from sqlalchemy import func
-from sqlalchemy.orm import Session
+from fastapi.responses import StreamingResponse
+import orjson
+from typing import List, Literal, Optional
+from sqlalchemy import delete, exists, insert, null, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, contains_eager, joinedload, selectinload
 
 
 # --- Create a router variable that uses the APIRouter class:
@@ -19,6 +30,42 @@ router = APIRouter(
     )
 
 
+# --- Every post response includes the owner of the post, so the owners are loaded along with the posts rather than
+# --- with a query per owner while the response is being built (which an AsyncSession can't do at all). A join is one
+# --- query. selectin adds a second query for the distinct owners of the page, which sends less data back when a few
+# --- users own most of the posts:
+def load_owner():
+    if settings.owner_loading == "selectin":
+        return selectinload(models.Post.owner)
+    
+    return joinedload(models.Post.owner)
+
+
+# --- Whether the logged in user has voted for each post, as a column of the same query: an EXISTS on the votes primary
+# --- key (post_id, user_id) for each post in the result, rather than a query per post. It is NULL when there is no
+# --- user. With vote_buffer switched on, a vote only counts once the buffer has been written:
+def voted_by_me(user_id: Optional[int]):
+    if user_id is None:
+        return null().label("voted_by_me")
+    
+    return exists().where(models.Vote.post_id == models.Post.id, models.Vote.user_id == user_id)\
+                   .label("voted_by_me")
+
+
+# --- The responses with voted_by_me depend on who is asking, so shared caches have to keep them apart:
+VARY = "Authorization"
+
+
+# --- Load a single post along with its owner:
+async def load_post(db: AsyncSession, id: int):
+    result = await db.execute(select(models.Post)
+                              .options(load_owner())
+                              .filter(models.Post.id == id)
+                              .execution_options(populate_existing = True))
+    
+    return result.scalars().first()
+
+
 # --- Get all posts:
 @router.get("/", 
             name = "Get All Posts.", 
@@ -26,22 +73,72 @@ router = APIRouter(
             response_model = List[AllPostsResponseVotes]
             )
 
-def get_all_posts(db: Session = Depends(get_db),
-                  limit: int = 10,
-                  skip: int = 0,
-                  search: Optional[str] = ""
-                  ):
+async def get_all_posts(request: Request,
+                        response: Response,
+                        db: AsyncSession = Depends(get_read_db),
+                        user_id: Optional[int] = Depends(get_optional_user_id),
+                        limit: int = Query(10, ge = 1, le = MAX_PAGE_SIZE),
+                        cursor: Optional[str] = Query(None, description = "The X-Next-Cursor value returned with the previous page."),
+                        skip: int = Query(0, ge = 0, deprecated = True, description = "Use cursor instead. Ignored when a cursor is sent."),
+                        search: Optional[str] = "",
+                        sort: Literal["new", "hot", "top"] = Query("new", description = "new: newest first. hot: most votes for their age first. top: most votes first.")
+                        ):
     
-    # --- Get all the posts from the table.
+    # --- Get a page of posts from the table, newest first.
+    # --- The next page starts after the (created_at, id) of the last post in this one, which is sent back in the
+    # --- X-Next-Cursor header. skip is only kept for older clients as OFFSET gets slower the deeper the page is.
     # --- 
-    # --- Note: if you remove .all(), the result will be the actual SQL query that SQLAlchemy translates the ORM request to:
-    results = db.query(models.Post, func.count(models.Vote.post_id).label("votes"))\
-                       .join(models.Vote, models.Vote.post_id == models.Post.id, isouter = True)\
-                       .group_by(models.Post.id)\
-                       .filter(models.Post.title.contains(search))\
-                       .limit(limit = limit)\
-                       .offset(offset = skip)\
-                       .all()
+    # --- Note: query only describes the SQL. Nothing is sent to the database until it is passed to db.execute():
+    query = select(models.Post, models.Post.vote_count.label("votes"), voted_by_me(user_id))\
+              .options(load_owner())
+    sort_columns = [models.Post.created_at, models.Post.id]
+    
+    # --- The hot and top sorts read the posts in the order of the post_rankings view, with the score in the cursor.
+    # --- Posts created since the view was last refreshed aren't included until the next refresh:
+    if sort != "new":
+        score = models.post_rankings.c.hot_score if sort == "hot" else models.post_rankings.c.votes
+        query = query.join(models.post_rankings, models.post_rankings.c.post_id == models.Post.id)\
+                     .add_columns(score.label("score"))
+        sort_columns = [score, models.post_rankings.c.post_id]
+    
+    # --- When searching the newest posts, the most relevant posts come first and the rank becomes part of the cursor:
+    if search:
+        match, rank = post_search(search)
+        query = query.filter(match)
+        
+        if sort == "new":
+            query = query.add_columns(rank.label("rank"))
+            sort_columns = [rank] + sort_columns
+    
+    query = apply_keyset(query, sort_columns, cursor = cursor, limit = limit)
+    
+    if skip and not cursor:
+        query = query.offset(offset = skip)
+    
+    def sort_key(row) -> list:
+        if sort != "new":
+            return [row.score, row.Post.id]
+        
+        return ([row.rank] if search else []) + [row.Post.created_at, row.Post.id]
+    
+    result = await db.execute(query)
+    results, next_cursor = next_page(result.all(), limit, key = sort_key)
+    
+    # --- There is no cursor on the last page:
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    
+    # --- The ETag changes if a post on the page is added, removed or changed (including its votes):
+    etag = make_etag(next_cursor, *[(row.Post.id, row.Post.version, row.voted_by_me) for row in results])
+    response.headers["Vary"] = VARY
+    
+    if etag_matches(request, etag):
+        return not_modified(etag, vary = VARY)
+    
+    response.headers["ETag"] = etag
+    
+    if settings.fast_serialization:
+        return fast_response([post_votes_dict(row) for row in results], response)
     
     return results
 
@@ -53,18 +150,77 @@ def get_all_posts(db: Session = Depends(get_db),
             response_model = List[PostResponse]
             )
 
-def get_my_posts(db: Session = Depends(get_db), 
-                  current_user: int = Depends(get_current_user)
-                  ):
-    # --- Get all the posts from the table.
-    # --- Note: if you remove .all(), the result will be the actual SQL query that SQLAlchemy translates the ORM request to:
-    posts = db.query(models.Post)\
-           .filter(models.Post.owner_id == current_user.id)\
-           .all()
+async def get_my_posts(response: Response,
+                       db: AsyncSession = Depends(get_db), 
+                       current_user: int = Depends(get_current_user),
+                       limit: int = Query(10, ge = 1, le = MAX_PAGE_SIZE),
+                       cursor: Optional[str] = Query(None, description = "The X-Next-Cursor value returned with the previous page.")
+                       ):
+    # --- Get a page of the users posts from the table, newest first:
+    # --- Note: query only describes the SQL. Nothing is sent to the database until it is passed to db.execute():
+    query = select(models.Post)\
+              .options(load_owner())\
+              .filter(models.Post.owner_id == current_user.id)
+    
+    query = apply_keyset(query, [models.Post.created_at, models.Post.id], cursor = cursor, limit = limit)
+    
+    result = await db.execute(query)
+    posts, next_cursor = next_page(result.scalars().all(), limit, key = lambda post: [post.created_at, post.id])
+    
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    
+    if settings.fast_serialization:
+        return fast_response([post_dict(post) for post in posts], response)
         
     return posts
 
 
+# --- The number of posts fetched from the database cursor, and sent to the client, at a time by the export:
+EXPORT_BATCH_SIZE = 1000
+
+
+# --- Export posts. It is declared before /{id} so "export" isn't taken for a post id:
+@router.get("/export",
+            name = "Export Posts.",
+            summary = "Streams every post, oldest first, as newline delimited JSON (one post per line).",
+            response_class = StreamingResponse,
+            responses = {200: {"content": {"application/x-ndjson": {}}}}
+            )
+
+async def export_posts(db: AsyncSession = Depends(get_read_db),
+                       current_user: int = Depends(get_current_user),
+                       owner_id: Optional[int] = Query(None, description = "Only export the posts of this user."),
+                       created_after: Optional[datetime] = Query(None, description = "Only export the posts created at or after this time."),
+                       created_before: Optional[datetime] = Query(None, description = "Only export the posts created before this time.")
+                       ):
+    
+    # --- The rows are read through a server-side cursor and sent a batch at a time as they arrive, so the memory used
+    # --- doesn't grow with the number of posts. The session (and its connection) stays open until the last batch has
+    # --- been sent, as the dependencies are closed after the response:
+    query = select(models.Post.id, models.Post.title, models.Post.content, models.Post.published, 
+                   models.Post.created_at, models.Post.owner_id, models.Post.vote_count.label("votes"))\
+              .order_by(models.Post.id)
+    
+    if owner_id is not None:
+        query = query.filter(models.Post.owner_id == owner_id)
+    if created_after is not None:
+        query = query.filter(models.Post.created_at >= created_after)
+    if created_before is not None:
+        query = query.filter(models.Post.created_at < created_before)
+    
+    result = await db.stream(query)
+    
+    async def lines():
+        try:
+            async for rows in result.partitions(EXPORT_BATCH_SIZE):
+                yield b"".join(orjson.dumps(dict(row._mapping)) + b"\n" for row in rows)
+        finally:
+            await result.close()
+    
+    return StreamingResponse(lines(), media_type = "application/x-ndjson")
+
+
 # --- Get one post record based on its id (path parameter):
 @router.get("/{id}",
             name = "Get A Single Posts.", 
@@ -72,17 +228,20 @@ def get_my_posts(db: Session = Depends(get_db),
             response_model = AllPostsResponseVotes
             )
 
-def get_one_post(id: int = Query(..., description = "The ID number of the post you wish to return.", title="Post ID"),
-                 db: Session = Depends(get_db)
-                 ):
+async def get_one_post(request: Request,
+                       response: Response,
+                       id: int = Query(..., description = "The ID number of the post you wish to return.", title="Post ID"),
+                       db: AsyncSession = Depends(get_read_db),
+                       user_id: Optional[int] = Depends(get_optional_user_id)
+                       ):
     
     
     #post = db.query(models.Post).filter(models.Post.id == id).first()
 
-    result = db.query(models.Post, func.count(models.Vote.post_id)\
-             .label("votes")).join(models.Vote, models.Vote.post_id == models.Post.id, isouter = True)\
-             .group_by(models.Post.id).where(models.Post.id == id)\
-             .first()
+    result = await db.execute(select(models.Post, models.Post.vote_count.label("votes"), voted_by_me(user_id))
+                              .options(load_owner())
+                              .filter(models.Post.id == id))
+    result = result.first()
     
     
     if result == None:
@@ -90,15 +249,27 @@ def get_one_post(id: int = Query(..., description = "The ID number of the post y
                             detail = f"Post ID {id} not found"
                             )
     
+    # --- If the client already has this version of the post, don't send it again:
+    etag = make_etag(result.Post.id, result.Post.version, result.voted_by_me)
+    response.headers["Vary"] = VARY
+    
+    if etag_matches(request, etag):
+        return not_modified(etag, vary = VARY)
+    
+    response.headers["ETag"] = etag
+    
+    if settings.fast_serialization:
+        return fast_response(post_votes_dict(result), response)
+    
     return result
 
 
 # --- Create a post:
 @router.post("/", status_code = status.HTTP_201_CREATED, response_model = PostResponse)
-def new_post(post: PostCreate, 
-             db: Session = Depends(get_db), 
-             current_user: int = Depends(get_current_user)
-             ):
+async def new_post(post: PostCreate, 
+                   db: AsyncSession = Depends(get_db), 
+                   current_user: int = Depends(get_current_user)
+                   ):
     
     # print(f"Current User ID: {current_user.id}")
     
@@ -106,10 +277,15 @@ def new_post(post: PostCreate,
     
     # --- Add the post to the table. You must use commit to write the post tot the table:
     db.add(new_post)
-    db.commit()
+    try:
+        await db.commit()
+    except IntegrityError as error:
+        await db.rollback()
+        raise_for_deleted_user(error)
+        raise
     
-    # --- Use refresh to update new_post with the details of the newly written post:
-    db.refresh(new_post)
+    # --- Load new_post again to get the details of the newly written post, along with its owner:
+    new_post = await load_post(db, new_post.id)
     
     # --- If the post cannot be created, show an error:
     if not new_post:
@@ -120,58 +296,96 @@ def new_post(post: PostCreate,
     return new_post
 
 
-# --- Delete a post:
-@router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_post(id: int, 
-                db: Session = Depends(get_db), 
-                current_user: int = Depends(get_current_user)
-                ):
+# --- Create a batch of posts:
+@router.post("/batch", status_code = status.HTTP_201_CREATED, response_model = List[PostBatchResponse])
+async def new_posts(posts: PostBatchCreate, 
+                    db: AsyncSession = Depends(get_db), 
+                    current_user: int = Depends(get_current_user)
+                    ):
+    """
+    Overview:
+        Create up to MAX_BATCH_SIZE posts with one multi-row INSERT and a single commit, rather than a commit and a
+        reload per post. The batch is all or nothing: if any post fails validation, the 422 lists every failing post by
+        its index in the batch and nothing is written.
+
+    Returns:
+        List: The id and created_at of each new post, in the order the posts were sent.
+    """
+    try:
+        result = await db.execute(insert(models.Post)
+                                  .values([{"owner_id": current_user.id, **post.dict()} for post in posts])
+                                  .returning(models.Post.id, models.Post.created_at))
+    except IntegrityError as error:
+        await db.rollback()
+        raise_for_deleted_user(error)
+        raise
     
-    post = db.query(models.Post).filter(models.Post.id == id).first()
+    # --- Read the returned rows before the commit closes the cursor. Postgres hands out the ids in the order of the 
+    # --- VALUES list, so sorting by id puts them back in that order:
+    created = sorted(result.all(), key = lambda row: row.id)
+    await db.commit()
     
-    # print(post.id)
-    # print(current_user.id)
-    # print(post.owner_id)
+    return created
+
+
+# --- Find out why a change to a post matched nothing. This only runs when the change wasn't made:
+async def post_not_changed(db: AsyncSession, id: int):
+    owner_id = (await db.execute(select(models.Post.owner_id).filter(models.Post.id == id))).scalar()
     
-    if post == None:
+    if owner_id is None:
         raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
-                            detail = f"Post ID {id} not found")    
+                            detail = f"Post {id} not found.")
     
-    if post.owner_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-        
-    db.delete(post)
-    db.commit()
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+
+
+# --- Delete a post:
+@router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_post(id: int, 
+                      db: AsyncSession = Depends(get_db), 
+                      current_user: int = Depends(get_current_user)
+                      ):
+    
+    # --- Only delete the post if it belongs to the user, in the same statement:
+    result = await db.execute(delete(models.Post)
+                              .where(models.Post.id == id, models.Post.owner_id == current_user.id)
+                              .returning(models.Post.id)
+                              .execution_options(synchronize_session = False))
+    deleted = result.first()
+    await db.commit()
+    
+    if not deleted:
+        await post_not_changed(db, id)
                 
     return Response(status_code = status.HTTP_204_NO_CONTENT)
 
 
 # --- Update a post:   
 @router.put("/{id}", response_model=PostResponse)
-def update_post(id: int, 
-                updated_post: PostCreate, 
-                db: Session = Depends(get_db), 
-                current_user: int = Depends(get_current_user)
-                ):
-    
-    print(current_user.id)
-                    
-    post_query = db.query(models.Post).filter(models.Post.id == id)
-    post = post_query.first()
-        
-    
-    # --- If the post cannot be created, show an error:
-    if post == None:
-        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
-                            detail = f"Post {id} not found.")   
+async def update_post(id: int, 
+                      updated_post: PostCreate, 
+                      db: AsyncSession = Depends(get_db), 
+                      current_user: int = Depends(get_current_user)
+                      ):
     
-    if post.owner_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    # --- Only update the post if it belongs to the user, and read it back along with its owner in the same statement.
+    # --- The search vector is left out as the response doesn't include it:
+    updated = update(models.Post)\
+              .where(models.Post.id == id, models.Post.owner_id == current_user.id)\
+              .values(**updated_post.dict(), version = models.Post.version + 1)\
+              .returning(*[column for column in models.Post.__table__.columns if column.key != "search_vector"])\
+              .cte("updated_post")
+    post = aliased(models.Post, updated)
     
-    print(updated_post.dict())
+    result = await db.execute(select(post)
+                              .join(post.owner)
+                              .options(contains_eager(post.owner))
+                              .execution_options(populate_existing = True))
+    updated_post = result.scalars().first()
+    await db.commit()
     
-    post_query.update(updated_post.dict(), synchronize_session=False)
-    db.commit()
+    if not updated_post:
+        await post_not_changed(db, id)
     
     # --- Return the value of the post:
-    return post_query.first()
\ No newline at end of file
+    return updated_post
@@ -1,11 +1,13 @@
 # --- Import the required modules:
 from app.models import models
-from app.auth.hash_pwd import hash_pwd
+from app.auth.hash_pwd import hash_password_async
 from app.auth.oauth2 import get_current_user
 from app.database import get_db
+from app.etag import etag_matches, make_etag, not_modified
+from app.replicas import get_read_db
 from app.schemas import UserCreate, UserCreateResponse, UserDetailsResponse
-from fastapi import status, HTTPException, Depends, APIRouter
-from sqlalchemy.orm import Session
+from fastapi import status, HTTPException, Depends, APIRouter, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 # --- Create a router variable that uses the APIRouter class:
@@ -21,21 +23,21 @@ router = APIRouter(
 @router.post("/", status_code = status.HTTP_201_CREATED, 
              response_model = UserCreateResponse)
 
-def new_user(user: UserCreate, 
-             db: Session = Depends(get_db)):
+async def new_user(user: UserCreate, 
+                   db: AsyncSession = Depends(get_db)):
     
-    # --- Hash the users password:
-    user.password = hash_pwd(user.password)
+    # --- Hash the users password. bcrypt is slow on purpose, so it is run in the hashing processes:
+    user.password = await hash_password_async(user.password)
 
     # --- Define a variable to create a user object / model:
     new_user = models.User( **user.dict() )
 
     # --- Add the post to the table. You must use commit to write the post tot the table:
     db.add(new_user)
-    db.commit()
+    await db.commit()
     
     # --- Use refresh to update new_post with the details of the newly written post:
-    db.refresh(new_user)
+    await db.refresh(new_user)
 
     # --- Return the value of the post:
     return new_user
@@ -44,16 +46,24 @@ def new_user(user: UserCreate,
 @router.get("/{id}", 
             response_model=UserDetailsResponse)
 
-def get_user(id: int, 
-             db: Session = Depends(get_db),
-             current_user: int = Depends(get_current_user)):
+async def get_user(request: Request,
+                   response: Response,
+                   id: int, 
+                   db: AsyncSession = Depends(get_read_db),
+                   current_user: int = Depends(get_current_user)):
 
-    print(current_user.email)
-    
-    user = db.query(models.User).filter(models.User.id == id).first()
+    user = await db.get(models.User, id)
     
     if user == None:
         raise HTTPException(status_code = status.HTTP_404_NOT_FOUND,
                             detail = f"User ID {id} not found")
     
+    # --- Users can't be changed, so the ETag only needs to identify the user:
+    etag = make_etag(user.id, user.email, user.created_at)
+    
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    response.headers["ETag"] = etag
+    
     return user
\ No newline at end of file
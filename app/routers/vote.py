@@ -1,13 +1,18 @@
 # --- Import the required modules:
-from app.auth.oauth2 import get_current_user
-from app.database import get_db
+from app.auth.oauth2 import get_current_user, raise_for_deleted_user
+from app.config import settings
+from app.database import FOREIGN_KEY_VIOLATION, get_db, violated_constraint
 from app.models.models import Post, Vote
 from app.schemas import Voting
+from app.vote_buffer import vote_buffer
 
 from fastapi import status, HTTPException, Depends, APIRouter, Response
 from fastapi.param_functions import Query
 from typing import List, Optional
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 # --- Create a router variable that uses the APIRouter class:
@@ -18,39 +23,93 @@ router = APIRouter(
     tags = ["Votes"]
     )
 
+
+# --- The foreign key a vote breaks when its post doesn't exist:
+POST_FOREIGN_KEY = "votes_post_id_fkey"
+
 @router.post("/",            
              name = "Submit a like or Unlike for a post.", 
              summary = "Creates / removes an entry in the votes table to indicate if a post is liked or note",
              status_code = status.HTTP_201_CREATED)
 
-def vote(vote: Voting, 
-         db: Session = Depends(get_db), 
-         current_user: int = Depends(get_current_user)):
+async def vote(vote: Voting, 
+               db: AsyncSession = Depends(get_db), 
+               current_user: int = Depends(get_current_user)):
     
-    post = db.query(Post).filter(Post.id == vote.post_id).first()
-    if not post:
-        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND, 
-                            detail = f"Post does not exist.")
+    if settings.vote_buffer:
+        return await buffered_vote(vote, db, current_user)
     
-    vote_query = db.query(Vote).filter(Vote.post_id == vote.post_id, Vote.user_id == current_user.id)
-    found_vote = vote_query.first()
+    # --- Each direction is one statement: the vote is inserted or deleted in a CTE, and the posts vote count and 
+    # --- version (for its ETag) are only changed if it was. Two identical votes racing each other can't both succeed,
+    # --- as the second one waits on the first one's row and then does nothing:
+    if vote.dir == 1:
+        changed = insert(Vote)\
+                  .values(post_id = vote.post_id, user_id = current_user.id)\
+                  .on_conflict_do_nothing()\
+                  .returning(Vote.post_id)\
+                  .cte("added_vote")
+        change = 1
+    else:
+        changed = delete(Vote)\
+                  .where(Vote.post_id == vote.post_id, Vote.user_id == current_user.id)\
+                  .returning(Vote.post_id)\
+                  .cte("removed_vote")
+        change = -1
     
+    try:
+        result = await db.execute(update(Post)
+                                  .where(Post.id == changed.c.post_id)
+                                  .values(vote_count = Post.vote_count + change, version = Post.version + 1)
+                                  .returning(Post.id)
+                                  .execution_options(synchronize_session = False))
+        updated = result.first()
+        await db.commit()
+    except IntegrityError as error:
+        await db.rollback()
+        raise_for_deleted_user(error)
+        
+        if error.orig.pgcode != FOREIGN_KEY_VIOLATION or violated_constraint(error) != POST_FOREIGN_KEY:
+            raise
+        updated = None
+        
     if vote.dir == 1:
-        if found_vote:
+        if updated:
+            return {"detail": "vote added successfully."}
+        
+        # --- The vote was already there, or the insert broke the foreign key to the post: 
+        if await db.get(Post, vote.post_id):
             raise HTTPException(status_code = status.HTTP_409_CONFLICT, 
                                 detail = f"User has already voted on post {vote.post_id}.")
-        new_vote = Vote(post_id = vote.post_id, 
-                        user_id = current_user.id)
-        
-        db.add(new_vote)
-        db.commit()
-        return {"detail": "vote added successfully."}
-        
     else:
-        if not found_vote:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail = "vote does not exist.")
-        
-        vote_query.delete(synchronize_session = False)
-        db.commit()
+        if updated:
+            return {"detail": "vote removed successfully."}
         
-        return {"detail": "vote removed successfully."}
\ No newline at end of file
+        if await db.get(Post, vote.post_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail = "vote does not exist.")
+    
+    raise HTTPException(status_code = status.HTTP_404_NOT_FOUND, 
+                        detail = f"Post does not exist.")
+
+
+# --- Check a vote against the database and the vote buffer, then leave it in the buffer to be written in a batch.
+# --- The responses are the same as when the vote is written straight away:
+async def buffered_vote(vote: Voting, db: AsyncSession, current_user):
+    state = await vote_buffer.check(db, vote.post_id, current_user.id)
+    
+    if state is None:
+        raise HTTPException(status_code = status.HTTP_404_NOT_FOUND, 
+                            detail = f"Post does not exist.")
+    
+    if vote.dir == 1 and state.wanted:
+        raise HTTPException(status_code = status.HTTP_409_CONFLICT, 
+                            detail = f"User has already voted on post {vote.post_id}.")
+    
+    if vote.dir != 1 and not state.wanted:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail = "vote does not exist.")
+    
+    vote_buffer.record(vote.post_id, current_user.id, state, vote.dir == 1)
+    
+    if vote_buffer.full:
+        await vote_buffer.flush()
+    
+    return {"detail": "vote added successfully." if vote.dir == 1 else "vote removed successfully."}
@@ -1,5 +1,5 @@
 # --- Import the required modules / libraries:
-from pydantic import BaseModel, EmailStr, conint
+from pydantic import BaseModel, EmailStr, conint, conlist
 from datetime import datetime
 from typing import Optional
 
@@ -18,6 +18,12 @@ class PostCreate(Post):
     pass
 
 
+# --- The posts for POST /post/batch. They are inserted with a single statement, which caps the size of a batch:
+MAX_BATCH_SIZE = 1000
+
+PostBatchCreate = conlist(PostCreate, min_items = 1, max_items = MAX_BATCH_SIZE)
+
+
 class User(BaseModel):
     email: EmailStr
     password: str
@@ -34,10 +40,16 @@ class UserLogin(User):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    
+    
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
     
     
 class TokenData(BaseModel):
     id: Optional[str] = None
+    email: Optional[str] = None
     
 
 class Voting(BaseModel):
@@ -87,9 +99,29 @@ class AllPostResponse(Post):
 class AllPostsResponseVotes(BaseModel):
     Post: PostResponse
     votes: int
+    # --- Whether the logged in user has voted for the post. It is null when the request has no token:
+    voted_by_me: Optional[bool] = None
     # --- This class will allow the pydantic library to return back a dictionary format:
     class Config:
         orm_mode = True    
         
 class UserDetailsResponse(UserCreateResponse):
-    pass
\ No newline at end of file
+    pass
+
+
+class PostBatchResponse(BaseModel):
+    id: int
+    created_at: datetime
+    # --- This class will allow the pydantic library to return back a dictionary format:
+    class Config:
+        orm_mode = True
+
+
+
+######## --- Internal --- ########
+
+# --- The user returned by get_current_user in the claims auth mode. It only has what the routers use, and is built
+# --- with construct() as the values come from a signed token or the users table and don't need validating again:
+class CurrentUser(BaseModel):
+    id: int
+    email: str
\ No newline at end of file
@@ -0,0 +1,47 @@
+# --- This module builds the SQL used by the search parameter on the post list endpoint.
+# --- Every part of the match can be served by an index (see the Post model), so a search only reads the posts that
+# --- match rather than scanning the whole table.
+
+# --- Import the required modules:
+from app.config import settings
+from app.models.models import Post, SEARCH_CONFIG
+from sqlalchemy import Float, String, cast, func, literal, literal_column
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+
+def _escape_like(term: str) -> str:
+    """Escape the LIKE wildcards in the search term so they are matched literally."""
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def post_search(term: str) -> tuple:
+    """
+    Overview:
+        Build the filter and relevance rank for a post search. A post matches when the term matches its title or
+        content as a full-text query, or (with search_trigram switched on) its title contains the term or a word that
+        is a close misspelling of the term.
+
+    Args:
+        term (string): The search term the user sent.
+
+    Returns:
+        Tuple: The filter to add to the query and the relevance rank to order the results by (highest first).
+    """
+    # --- The configuration is written into the SQL as a regconfig, as asyncpg would otherwise send it as a varchar
+    # --- and Postgres wouldn't be able to pick the function:
+    ts_query = func.websearch_to_tsquery(literal_column(f"'{SEARCH_CONFIG}'::regconfig"), term)
+    rank = func.ts_rank_cd(Post.search_vector, ts_query, type_ = Float)
+
+    match = Post.search_vector.op("@@")(ts_query)
+
+    # --- The substring and misspelling matches on the title are only served by the trigram index. Without it, OR'ing
+    # --- them in would make every search read the whole posts table:
+    if settings.search_trigram:
+        match = match | Post.title.ilike(f"%{_escape_like(term)}%", escape = "\\")
+        term = literal(term, String)
+        match = match | term.op("<%")(Post.title)
+        rank = func.greatest(rank, func.word_similarity(term, Post.title), type_ = Float)
+
+    # --- The ranks are real (float4) values. Widen them to double precision so the rank sent back in a cursor compares
+    # --- equal to the rank it was read from:
+    return match, cast(rank, DOUBLE_PRECISION)
@@ -0,0 +1,96 @@
+# --- This module measures how many SQL statements each request runs and how long it spends in the database, and
+# --- sends the numbers back in a Server-Timing header (shown in the network panel of browser developer tools) and to
+# --- the log, when server_timing is switched on.
+# ---
+# --- The engines report every statement through their cursor events, which add it to the timing of the current
+# --- request. The timing is found through a context variable, which follows the request into the threadpool.
+
+# --- Import the required modules:
+import logging
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from app.config import settings
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTiming:
+    """The statement count and time spent in the database for one request."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+
+    def header(self) -> str:
+        total = (time.perf_counter() - self.start) * 1000
+
+        return f'db;dur={self.db_seconds * 1000:.2f};desc="{self.statements} statements", total;dur={total:.2f}'
+
+
+# --- The timing of the request being handled, if server_timing is switched on:
+request_timing: ContextVar[Optional[RequestTiming]] = ContextVar("request_timing", default = None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if request_timing.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timing = request_timing.get()
+
+    if timing is not None and conn.info.get("query_start"):
+        timing.statements += 1
+        timing.db_seconds += time.perf_counter() - conn.info["query_start"].pop()
+
+
+def instrument(engine) -> None:
+    """
+    Overview:
+        Report the statements run by an engine to the timing of the current request.
+
+    Args:
+        engine (Engine): The engine to instrument. For an AsyncEngine, pass its sync_engine.
+    """
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+class ServerTimingMiddleware:
+    """
+    Overview:
+        Time each request and add the Server-Timing header to its response. The header holds the statements run up to
+        the point the response starts. The log line is written once the response has been sent, so it includes the
+        statements run while streaming a response.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.server_timing:
+            return await self.app(scope, receive, send)
+
+        timing = RequestTiming()
+        token = request_timing.set(timing)
+        status_code = None
+
+        async def send_with_timing(message):
+            nonlocal status_code
+
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"server-timing", timing.header().encode())]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timing.reset(token)
+            logger.info("%s %s %s: %s statements, %.2fms in the database, %.2fms in total",
+                        scope["method"], scope["path"], status_code, timing.statements, timing.db_seconds * 1000,
+                        (time.perf_counter() - timing.start) * 1000)
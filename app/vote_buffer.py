@@ -0,0 +1,230 @@
+# --- This module contains the write-behind buffer for votes, used when vote_buffer is switched on.
+# --- Rather than each vote running its own INSERT / DELETE, UPDATE and commit, the vote router checks the vote against
+# --- the database and the buffer, then records it here. The buffer keeps only the latest state for each user and post,
+# --- so a user toggling a vote on and off is written once (or not at all), and the pending votes are written in one
+# --- transaction once max_size of them are waiting or every flush_seconds.
+# ---
+# --- The buffer lives in the worker process. Each uvicorn / gunicorn worker has its own, and the votes still waiting in
+# --- a worker are lost if it is killed rather than shut down. The vote counts (and ETags) of posts lag behind by up to
+# --- flush_seconds.
+
+# --- Import the required modules:
+import asyncio
+import logging
+from contextlib import asynccontextmanager, suppress
+from typing import NamedTuple, Optional
+
+from app.auth.oauth2 import invalid_credentials
+from app.config import settings
+from app.database import get_db
+from app.models.models import Post, User, Vote
+from sqlalchemy import Integer, column, delete, select, tuple_, update, values
+from sqlalchemy.dialects.postgresql import insert
+
+
+logger = logging.getLogger(__name__)
+
+
+class PendingVote(NamedTuple):
+    # --- Whether the vote exists in the database, and whether it should once the buffer has been written:
+    stored: bool
+    wanted: bool
+
+
+class VoteBuffer:
+    """
+    Overview:
+        Collects votes and writes them to the database in batches.
+        Everything that reads or changes the pending votes runs on the event loop without awaiting in between, so the
+        check for a 409 / 404 and the recording of the vote can't interleave with another request for the same vote.
+
+    Args:
+        max_size (int): The number of pending votes that triggers a flush.
+        flush_seconds (float): How often the pending votes are flushed in the background.
+    """
+    def __init__(self, max_size: int = 1000, flush_seconds: float = 0.5):
+        self.max_size = max_size
+        self.flush_seconds = flush_seconds
+        self.session_factory = asynccontextmanager(get_db)
+        self.pending = {}
+        self.flushing = {}
+        self.task = None
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    async def check(self, db, post_id: int, user_id: int) -> Optional[PendingVote]:
+        """
+        Overview:
+            Find whether the user has voted on the post, from the database and the buffer.
+
+        Args:
+            db: The database session of the request.
+            post_id (int): The post voted on.
+            user_id (int): The user voting.
+
+        Returns:
+            PendingVote: Whether the vote will be in the database once the running flush is written (stored), and
+                         whether the user has voted (wanted). None if the post doesn't exist.
+
+        Raises:
+            HTTPException: The 401 for a user deleted since logging in, as the claims auth mode doesn't look them up.
+        """
+        key = (post_id, user_id)
+        post_exists = select(Post.id).where(Post.id == post_id).exists()
+        user_exists = select(User.id).where(User.id == user_id).exists()
+        voted = select(Vote.post_id).where(Vote.post_id == post_id, Vote.user_id == user_id).exists()
+
+        # --- Read again if a flush was written while reading, as the buffer no longer holds the votes it wrote:
+        while True:
+            generation = self.generation
+            row = (await db.execute(select(post_exists.label("post_exists"),
+                                           user_exists.label("user_exists"),
+                                           voted.label("voted")))).one()
+
+            if generation == self.generation:
+                break
+
+        if not row.user_exists:
+            raise invalid_credentials()
+
+        if not row.post_exists:
+            return None
+
+        stored = self.flushing[key].wanted if key in self.flushing else row.voted
+        pending = self.pending.get(key)
+
+        return PendingVote(stored, pending.wanted if pending else stored)
+
+    def record(self, post_id: int, user_id: int, state: PendingVote, wanted: bool) -> None:
+        """
+        Overview:
+            Record a vote being added (wanted = True) or removed, using the state returned by check. It must be called
+            without awaiting anything after check. A vote put back to the state that will be in the database cancels
+            out and is dropped.
+        """
+        key = (post_id, user_id)
+
+        if wanted == state.stored:
+            self.pending.pop(key, None)
+        else:
+            self.pending[key] = PendingVote(state.stored, wanted)
+
+    @property
+    def full(self) -> bool:
+        return len(self.pending) >= self.max_size
+
+    async def flush(self) -> int:
+        """
+        Overview:
+            Write the pending votes in one transaction: a single INSERT for the new votes, a single DELETE for the
+            removed ones and a single UPDATE of the vote counts. Nothing happens if a flush is already running.
+            If the write fails, or the flush is cancelled while writing, the votes are put back to be tried again on
+            the next flush. Writing them twice is harmless, as a vote already written is skipped and not counted.
+
+        Returns:
+            Int: The number of votes written.
+        """
+        if self.flushing or not self.pending:
+            return 0
+
+        self.flushing, self.pending = self.pending, {}
+
+        try:
+            async with self.session_factory() as db:
+                await self.write(db, self.flushing)
+        except Exception:
+            logger.exception("Could not flush %s buffered votes, they will be retried.", len(self.flushing))
+            self.requeue()
+            return 0
+        except BaseException:
+            # --- Cancelled (by close) while writing. CancelledError isn't an Exception, but the votes still have to be
+            # --- put back for close to write them:
+            self.requeue()
+            raise
+
+        written = len(self.flushing)
+        self.flushing = {}
+        self.generation += 1
+
+        return written
+
+    def requeue(self) -> None:
+        for key, vote in self.flushing.items():
+            newer = self.pending.get(key)
+
+            if newer is None:
+                self.pending[key] = vote
+            elif newer.wanted == vote.stored:
+                del self.pending[key]
+            else:
+                self.pending[key] = PendingVote(vote.stored, newer.wanted)
+
+        self.flushing = {}
+
+    @staticmethod
+    async def write(db, votes: dict) -> None:
+        added = [key for key, vote in votes.items() if vote.wanted]
+        removed = [key for key, vote in votes.items() if not vote.wanted]
+        counts = {}
+
+        # --- The posts and users are joined so a vote on a post (or by a user) deleted since it was buffered is skipped
+        # --- rather than failing the whole batch, and a vote another worker has already written is ignored. The counts
+        # --- are taken from the rows actually changed:
+        if added:
+            rows = values(column("post_id", Integer), column("user_id", Integer), name = "buffered_votes").data(added)
+            result = await db.execute(insert(Vote)
+                                      .from_select(["post_id", "user_id"],
+                                                   select(rows.c.post_id, rows.c.user_id)
+                                                   .join(Post, Post.id == rows.c.post_id)
+                                                   .join(User, User.id == rows.c.user_id))
+                                      .on_conflict_do_nothing()
+                                      .returning(Vote.post_id))
+            for post_id in result.scalars().all():
+                counts[post_id] = counts.get(post_id, 0) + 1
+
+        if removed:
+            result = await db.execute(delete(Vote)
+                                      .where(tuple_(Vote.post_id, Vote.user_id).in_(removed))
+                                      .returning(Vote.post_id))
+            for post_id in result.scalars().all():
+                counts[post_id] = counts.get(post_id, 0) - 1
+
+        if counts:
+            changes = values(column("post_id", Integer), column("change", Integer),
+                             name = "vote_changes").data(list(counts.items()))
+            await db.execute(update(Post)
+                             .where(Post.id == changes.c.post_id)
+                             .values(vote_count = Post.vote_count + changes.c.change, version = Post.version + 1)
+                             .execution_options(synchronize_session = False))
+
+        await db.commit()
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    def start(self) -> None:
+        """Start flushing every flush_seconds in the background."""
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self) -> None:
+        """Stop the background flushing and write every vote still pending."""
+        # --- Wait for the background task to stop, so a flush it was running has put its votes back first:
+        if self.task:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+
+        while self.pending or self.flushing:
+            if self.flushing:
+                await asyncio.sleep(0.01)
+            elif not await self.flush():
+                break
+
+
+# --- Create the buffer. It is only used when vote_buffer is switched on:
+vote_buffer = VoteBuffer(settings.vote_buffer_max_size, settings.vote_buffer_flush_seconds)
@@ -0,0 +1,43 @@
+# --- Compare the throughput of the read endpoints with database_async switched off (psycopg2 sessions in the
+# --- threadpool) and on (asyncpg with AsyncSession) as the number of concurrent clients grows.
+# ---
+# --- The API is started against the database in your .env / environment, so point it at a database with some posts
+# --- in it first. Run it from the root of the repo:
+# --- python -m benchmarks.async_vs_sync --concurrency 50 200 500 --duration 15
+
+# --- Import the required modules:
+import argparse
+import asyncio
+import json
+
+from benchmarks.load import drive, run_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare sync and async database throughput.")
+    parser.add_argument("--concurrency", type = int, nargs = "+", default = [50, 200, 500],
+                        help = "The numbers of concurrent clients to test with.")
+    parser.add_argument("--duration", type = float, default = 15, help = "Seconds to run each test for.")
+    parser.add_argument("--port", type = int, default = 8100, help = "The port to start the API on.")
+    parser.add_argument("--post-id", type = int, default = 1, help = "A post that exists, for GET /post/{id}.")
+    args = parser.parse_args()
+
+    requests = [lambda client: client.get("/post/"),
+                lambda client: client.get(f"/post/{args.post_id}")]
+    results = []
+
+    for mode in ("false", "true"):
+        with run_server(args.port, env = {"DATABASE_ASYNC": mode}) as base_url:
+            for concurrency in args.concurrency:
+                report = asyncio.run(drive(base_url, requests, concurrency, args.duration))
+                results.append({"database_async": mode == "true", "concurrency": concurrency, **report})
+                print(json.dumps(results[-1]))
+
+    print(f"\n{'mode':<6} {'clients':>8} {'rps':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for result in results:
+        print(f"{'async' if result['database_async'] else 'sync':<6} {result['concurrency']:>8} {result['rps']:>9} "
+              f"{result['p50_ms']:>9} {result['p99_ms']:>9} {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# --- Measure how many posts per second can be created through POST /post/ one at a time, against POST /post/batch
+# --- with a range of batch sizes.
+# ---
+# --- The API is started against the database in your .env / environment and a user is created to own the posts.
+# --- Every run creates real posts, so point it at a scratch database. Run it from the root of the repo:
+# --- python -m benchmarks.batch_insert --batch-sizes 10 100 1000 --duration 10
+
+# --- Import the required modules:
+import argparse
+import asyncio
+import json
+import uuid
+
+import httpx
+
+from benchmarks.load import drive, run_server
+
+
+def login(base_url: str) -> dict:
+    """Create a user for the run and return the headers to send its token with."""
+    email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+    httpx.post(f"{base_url}/user/", json = {"email": email, "password": "benchmark-password"}).raise_for_status()
+
+    res = httpx.post(f"{base_url}/login", data = {"username": email, "password": "benchmark-password"})
+    res.raise_for_status()
+
+    return {"Authorization": f"Bearer {res.json()['access_token']}"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare single and batch post creation throughput.")
+    parser.add_argument("--batch-sizes", type = int, nargs = "+", default = [10, 100, 1000],
+                        help = "The numbers of posts to send in each batch request.")
+    parser.add_argument("--concurrency", type = int, default = 8, help = "Concurrent clients creating posts.")
+    parser.add_argument("--duration", type = float, default = 10, help = "Seconds to run each test for.")
+    parser.add_argument("--port", type = int, default = 8100, help = "The port to start the API on.")
+    args = parser.parse_args()
+
+    post = {"title": "Benchmark post", "content": "A post created by benchmarks/batch_insert.py."}
+    results = []
+
+    with run_server(args.port) as base_url:
+        headers = login(base_url)
+
+        report = asyncio.run(drive(base_url, [lambda client: client.post("/post/", json = post)],
+                                   args.concurrency, args.duration, headers))
+        results.append({"endpoint": "/post/", "batch_size": 1, "posts_per_second": report["rps"], **report})
+        print(json.dumps(results[-1]))
+
+        for batch_size in args.batch_sizes:
+            batch = [post] * batch_size
+            report = asyncio.run(drive(base_url, [lambda client: client.post("/post/batch", json = batch)],
+                                       args.concurrency, args.duration, headers))
+            results.append({"endpoint": "/post/batch", "batch_size": batch_size,
+                            "posts_per_second": round(report["rps"] * batch_size, 1), **report})
+            print(json.dumps(results[-1]))
+
+    print(f"\n{'endpoint':<12} {'batch':>6} {'posts/s':>10} {'requests/s':>11} {'p50 ms':>9} {'p99 ms':>9}")
+    for result in results:
+        print(f"{result['endpoint']:<12} {result['batch_size']:>6} {result['posts_per_second']:>10} "
+              f"{result['rps']:>11} {result['p50_ms']:>9} {result['p99_ms']:>9}")
+
+
+if __name__ == "__main__":
+    main()
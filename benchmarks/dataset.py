@@ -0,0 +1,312 @@
+# --- This module generates synthetic users, posts and votes at scale and loads them with COPY, for the benchmark suite
+# --- and for trying the API against a realistic amount of data. Run it from the root of the repo, for example:
+# --- python -m benchmarks.dataset --database fastapi_bench --users 100000 --posts 1000000 --votes 10000000
+# ---
+# --- The data is skewed the way real data is: a few prolific users write most of the posts, votes follow a power law
+# --- (a handful of posts get most of them) and post lengths follow a log-normal distribution with a long tail. The same
+# --- seed always generates exactly the same rows, so results from different runs are comparable.
+# ---
+# --- Every user is given the same password (BENCHMARK_PASSWORD), hashed once, so the benchmarks can log in as any of
+# --- them and seeding doesn't spend hours in bcrypt.
+
+# --- Import the required modules:
+import argparse
+import os
+import sys
+import time
+
+import numpy
+import psycopg2
+from psycopg2 import sql
+
+
+BENCHMARK_PASSWORD = "benchmark-password"
+
+# --- Rows are generated and sent to COPY this many at a time, so memory use doesn't grow with the dataset (apart from
+# --- the votes, which are deduplicated in one go):
+CHUNK_ROWS = 50000
+
+# --- The rows are dated across the two years before this, with the ids in date order as they would be in real data:
+LAST_CREATED_AT = numpy.datetime64("2022-06-01T00:00:00")
+CREATED_SPAN_SECONDS = 2 * 365 * 24 * 3600
+
+# --- The shape of the data. Higher exponents concentrate the posts / votes on fewer users / posts:
+AUTHOR_EXPONENT = 1.1
+POPULARITY_EXPONENT = 1.0
+VOTER_EXPONENT = 0.6
+CONTENT_MEDIAN_CHARACTERS = 900
+CONTENT_SIGMA = 0.9
+CONTENT_LIMIT_CHARACTERS = 20000
+PUBLISHED_SHARE = 0.95
+
+
+def email(number: int) -> str:
+    """The email of the generated user with the given id."""
+    return f"user{number}@example.com"
+
+
+def create_database(name: str) -> None:
+    """
+    Overview:
+        Create the database if it doesn't exist yet, using the connection details in the environment / .env.
+
+    Args:
+        name (string): The name of the database.
+    """
+    from app.config import settings
+
+    connection = psycopg2.connect(host = settings.database_hostname, port = settings.database_port,
+                                  user = settings.database_username, password = settings.database_password,
+                                  dbname = "postgres")
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+            if cursor.fetchone() is None:
+                cursor.execute(sql.SQL("CREATE DATABASE {} ENCODING 'UTF8' TEMPLATE template0")
+                                  .format(sql.Identifier(name)))
+    finally:
+        connection.close()
+
+
+class CopySource:
+    """A file-like object that COPY reads from, which pulls the text of the rows from a generator as it goes."""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b""
+        self.offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if self.offset >= len(self.chunk):
+            self.chunk = next(self.chunks, "").encode()
+            self.offset = 0
+
+        if size < 0:
+            size = len(self.chunk)
+
+        data = self.chunk[self.offset:self.offset + size]
+        self.offset += len(data)
+
+        return data
+
+
+def power_law(generator, count: int, exponent: float):
+    """
+    Overview:
+        Build the probabilities of picking each of count rows, where the n-th most popular row is picked in proportion
+        to 1 / n ** exponent. The popularity is shuffled across the ids, so the popular rows aren't just the first ones.
+    """
+    weights = 1.0 / numpy.arange(1, count + 1) ** exponent
+    generator.shuffle(weights)
+
+    return weights / weights.sum()
+
+
+def timestamps(generator, first_id: int, count: int, total: int) -> list:
+    """The created_at of count rows starting from first_id, spread evenly (with jitter) in id order."""
+    seconds = (numpy.arange(first_id, first_id + count) - total) * (CREATED_SPAN_SECONDS / max(total, 1))
+    seconds = seconds + generator.uniform(0, CREATED_SPAN_SECONDS / max(total, 1), count)
+
+    return numpy.datetime_as_string(LAST_CREATED_AT + seconds.astype(numpy.int64).astype("timedelta64[s]"),
+                                    unit = "s").tolist()
+
+
+def vocabulary(generator, words: int = 5000) -> numpy.ndarray:
+    """Made up, pronounceable words, so full-text search has a realistic spread of common and rare terms."""
+    syllables = numpy.array(["ba", "ce", "di", "fo", "gu", "ha", "je", "ki", "lo", "mu", "na", "pe", "qui", "ro", "su",
+                             "ta", "ve", "wi", "xo", "yu", "za", "an", "er", "in", "on", "us", "ly", "ing", "tion"])
+    lengths = generator.integers(1, 5, words)
+
+    return numpy.array(["".join(generator.choice(syllables, length)) for length in lengths])
+
+
+def generate_votes(generator, users: int, posts: int, votes: int) -> tuple:
+    """
+    Overview:
+        Pick votes distinct (post, user) pairs, with the posts picked by a power law and the users by a gentler one.
+
+    Returns:
+        Tuple: The post ids and user ids, sorted by post and then user (the order of the primary key).
+    """
+    votes = min(votes, users * posts)
+    post_weights = power_law(generator, posts, POPULARITY_EXPONENT)
+    user_weights = power_law(generator, users, VOTER_EXPONENT)
+    keys = numpy.empty(0, dtype = numpy.int64)
+
+    # --- Popular posts draw the same voter more than once, so keep drawing until there are enough distinct pairs.
+    # --- Once the popular posts are saturated, fill up with uniformly picked pairs so this always finishes:
+    for attempt in range(20):
+        if len(keys) >= votes:
+            break
+
+        missing = votes - len(keys)
+        if attempt < 10:
+            post_ids = generator.choice(posts, missing + missing // 10 + 100, p = post_weights) + 1
+            user_ids = generator.choice(users, len(post_ids), p = user_weights) + 1
+        else:
+            post_ids = generator.integers(1, posts + 1, missing * 2 + 100)
+            user_ids = generator.integers(1, users + 1, len(post_ids))
+
+        keys = numpy.union1d(keys, post_ids.astype(numpy.int64) * (users + 1) + user_ids)
+
+    keys = numpy.sort(generator.permutation(keys)[:votes])
+
+    return keys // (users + 1), keys % (users + 1)
+
+
+def user_rows(generator, users: int, password: str):
+    for first_id in range(1, users + 1, CHUNK_ROWS):
+        count = min(CHUNK_ROWS, users + 1 - first_id)
+        created = timestamps(generator, first_id, count, users)
+
+        yield "".join(f"{user_id}\t{email(user_id)}\t{password}\t{created_at}+00\n"
+                      for user_id, created_at in zip(range(first_id, first_id + count), created))
+
+
+def post_rows(generator, users: int, posts: int, vote_counts):
+    words = vocabulary(generator)
+    word_weights = power_law(generator, len(words), 1.0)
+    author_weights = power_law(generator, users, AUTHOR_EXPONENT)
+
+    # --- The content of each post is a slice of one long text, which is much faster than building millions of them:
+    paragraphs = [" ".join(generator.choice(words, generator.integers(30, 120), p = word_weights)).capitalize() + "."
+                  for _ in range(4000)]
+    corpus = "\\n\\n".join(paragraphs)
+
+    for first_id in range(1, posts + 1, CHUNK_ROWS):
+        count = min(CHUNK_ROWS, posts + 1 - first_id)
+        ids = range(first_id, first_id + count)
+        created = timestamps(generator, first_id, count, posts)
+        owners = (generator.choice(users, count, p = author_weights) + 1).tolist()
+        published = (generator.random(count) < PUBLISHED_SHARE).tolist()
+        title_words = generator.choice(words, (count, 10), p = word_weights).tolist()
+        title_lengths = generator.integers(3, 11, count).tolist()
+        lengths = numpy.clip(generator.lognormal(numpy.log(CONTENT_MEDIAN_CHARACTERS), CONTENT_SIGMA, count),
+                             40, CONTENT_LIMIT_CHARACTERS).astype(int).tolist()
+        starts = generator.integers(0, len(corpus) - 2 * CONTENT_LIMIT_CHARACTERS, count).tolist()
+
+        rows = []
+        for index, post_id in enumerate(ids):
+            title = " ".join(title_words[index][:title_lengths[index]]).capitalize()
+            # --- Start and end on the spaces between words. The escaped paragraph breaks have no spaces in them, so
+            # --- they are never split:
+            start = corpus.find(" ", starts[index]) + 1
+            end = corpus.rfind(" ", start, start + lengths[index])
+            content = corpus[start:end if end > start else corpus.find(" ", start + lengths[index])]
+
+            rows.append(f"{post_id}\t{title}\t{content}\t{'t' if published[index] else 'f'}\t{created[index]}+00\t"
+                        f"{owners[index]}\t{vote_counts[post_id]}\n")
+
+        yield "".join(rows)
+
+
+def vote_rows(post_ids, user_ids):
+    for start in range(0, len(post_ids), CHUNK_ROWS * 4):
+        end = start + CHUNK_ROWS * 4
+        yield "".join(f"{post_id}\t{user_id}\n" for post_id, user_id in zip(post_ids[start:end].tolist(),
+                                                                           user_ids[start:end].tolist()))
+
+
+def generate(users: int, posts: int, votes: int, seed: int = 0, log = None) -> dict:
+    """
+    Overview:
+        Empty the tables of the application database and fill them with generated rows through COPY. The ids start
+        from 1, so user ids run from 1 to users and post ids from 1 to posts. The vote counts of the posts are written
+        with the posts, so they match the votes table without a recount.
+
+    Args:
+        users (int): The number of users.
+        posts (int): The number of posts.
+        votes (int): The number of votes. Capped at one per user per post.
+        seed (int): Seeds the generator.
+        log: A function to report progress to, if any.
+
+    Returns:
+        Dictionary: The number of rows in each table.
+    """
+    from app.auth.hash_pwd import hash_pwd
+    from app.database import Base, get_engine
+    from app.manage import create_schema
+    from app.models import models  # noqa: F401 - registers the tables on Base.metadata
+    from sqlalchemy import text
+
+    log = log or (lambda message: None)
+    engine = get_engine()
+    generator = numpy.random.default_rng(seed)
+    password = hash_pwd(BENCHMARK_PASSWORD)
+
+    start = time.perf_counter()
+    post_ids, user_ids = generate_votes(generator, users, posts, votes)
+    vote_counts = numpy.bincount(post_ids, minlength = posts + 1)
+    log(f"Picked {len(post_ids)} votes in {time.perf_counter() - start:.1f}s.")
+
+    # --- The schema is built by the migrations, like a production database, so the seeded database stays tracked by
+    # --- Alembic and can be upgraded later:
+    create_schema(None)
+
+    with engine.begin() as connection:
+        cursor = connection.connection.cursor()
+        tables = ", ".join(table.name for table in Base.metadata.sorted_tables)
+        cursor.execute(f"TRUNCATE {tables} RESTART IDENTITY CASCADE")
+
+        # --- Building an index in one go is faster than adding millions of rows to it one at a time, so the indexes that
+        # --- don't back a constraint are dropped for the load and rebuilt afterwards:
+        cursor.execute("SELECT indexname, indexdef FROM pg_indexes "
+                       "WHERE schemaname = current_schema() AND tablename IN ('posts', 'votes') "
+                       "AND indexname NOT IN (SELECT conname FROM pg_constraint)")
+        indexes = cursor.fetchall()
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX "{name}"')
+
+        for table, columns, rows in (("users", "id, email, password, created_at",
+                                      user_rows(generator, users, password)),
+                                     ("posts", "id, title, content, published, created_at, owner_id, vote_count",
+                                      post_rows(generator, users, posts, vote_counts)),
+                                     ("votes", "post_id, user_id",
+                                      vote_rows(post_ids, user_ids))):
+            start = time.perf_counter()
+            cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN", CopySource(rows), size = 1 << 20)
+            log(f"Loaded {table} in {time.perf_counter() - start:.1f}s.")
+
+        start = time.perf_counter()
+        cursor.execute("SET LOCAL maintenance_work_mem = '512MB'")
+        for _, definition in indexes:
+            cursor.execute(definition)
+        log(f"Rebuilt {len(indexes)} indexes in {time.perf_counter() - start:.1f}s.")
+
+        # --- The ids were written explicitly, so move the sequences past them:
+        for table in ("users", "posts"):
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                           f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)")
+
+    # --- Update the planner statistics, so the first queries against the new data get sensible plans:
+    with engine.connect().execution_options(isolation_level = "AUTOCOMMIT") as analyze:
+        analyze.execute(text("ANALYZE"))
+
+    return {"users": users, "posts": posts, "votes": int(len(post_ids))}
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description = "Generate users, posts and votes and load them with COPY.")
+    parser.add_argument("--database", default = "fastapi_bench",
+                        help = "The database to create and fill. Its tables are emptied first.")
+    parser.add_argument("--users", type = int, default = 100000, help = "The number of users.")
+    parser.add_argument("--posts", type = int, default = 1000000, help = "The number of posts.")
+    parser.add_argument("--votes", type = int, default = 5000000, help = "The number of votes.")
+    parser.add_argument("--seed", type = int, default = 1, help = "Seeds the generator.")
+    args = parser.parse_args(argv)
+
+    # --- The database has to be chosen before the application settings are first read:
+    os.environ["DATABASE_NAME"] = args.database
+
+    start = time.perf_counter()
+    create_database(args.database)
+    counts = generate(args.users, args.posts, args.votes, args.seed,
+                      log = lambda message: print(message, file = sys.stderr))
+    print(f"Generated {counts} in {args.database} in {time.perf_counter() - start:.1f}s.", file = sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# --- This module contains the shared pieces of the benchmarks: starting the API in a separate process and driving
+# --- concurrent HTTP load at it.
+
+# --- Import the required modules:
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import httpx
+
+
+def percentile(values: list, percent: float) -> float:
+    """Return the value below which the given percentage of the sorted values fall."""
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+
+    return values[index]
+
+
+def summarise(latencies: list, errors: int, elapsed: float) -> dict:
+    """
+    Overview:
+        Build the report for a single load run.
+
+    Args:
+        latencies (list): The latency of every successful request, in seconds.
+        errors (int): The number of requests that failed or returned a 5xx.
+        elapsed (float): The length of the run, in seconds.
+
+    Returns:
+        Dictionary: The request count, requests per second and latency percentiles (in milliseconds).
+    """
+    return {"requests": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2)
+            }
+
+
+@contextmanager
+def run_server(port: int, env: dict = None, workers: int = 1):
+    """
+    Overview:
+        Start the API with uvicorn in a child process and wait until it answers, then stop it on exit.
+
+    Args:
+        port (int): The port to listen on.
+        env (dict): Environment variables to set for the server on top of the current environment.
+        workers (int): The number of uvicorn worker processes.
+    """
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app",
+                               "--port", str(port),
+                               "--workers", str(workers),
+                               "--no-access-log",
+                               "--log-level", "warning"],
+                              env = {**os.environ, **(env or {})})
+    try:
+        deadline = time.monotonic() + 30
+
+        while True:
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/", timeout = 1)
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError("The API did not start.")
+                time.sleep(0.1)
+
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def drive(base_url: str, requests: list, concurrency: int, duration: float, headers: dict = None) -> dict:
+    """
+    Overview:
+        Send requests from a number of concurrent clients for a fixed length of time.
+
+    Args:
+        base_url (string): The URL the API is listening on.
+        requests (list): A function per kind of request. Each is called with the client and returns a response
+                         awaitable. The clients cycle through them in order.
+        concurrency (int): The number of requests in flight at any one time.
+        duration (float): The length of the run, in seconds.
+        headers (dict): Headers to send with every request.
+
+    Returns:
+        Dictionary: The report built by summarise.
+    """
+    latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections = concurrency, max_keepalive_connections = concurrency)
+
+    async with httpx.AsyncClient(base_url = base_url, headers = headers, limits = limits, timeout = 60) as client:
+        stop_at = time.perf_counter() + duration
+
+        async def worker(offset: int):
+            nonlocal errors
+            count = offset
+
+            while time.perf_counter() < stop_at:
+                make_request = requests[count % len(requests)]
+                count += 1
+                start = time.perf_counter()
+                try:
+                    res = await make_request(client)
+                    if res.status_code >= 500:
+                        errors += 1
+                        continue
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(offset) for offset in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    return summarise(latencies, errors, elapsed)
+
+
+async def drive_mix(base_url: str, workload: dict, concurrency: int, duration: float, seed: int = 0,
+                    headers: list = None) -> dict:
+    """
+    Overview:
+        Send a weighted mix of requests from a number of concurrent clients for a fixed length of time, and report
+        each kind of request separately as well as all of them together.
+
+    Args:
+        base_url (string): The URL the API is listening on.
+        workload (dict): The kinds of request, by name. Each is a tuple of its weight and a function that is called
+                         with the client and a random.Random and returns a response awaitable.
+        concurrency (int): The number of requests in flight at any one time.
+        duration (float): The length of the run, in seconds.
+        seed (int): Seeds the choices each client makes, so runs send the same mix of requests.
+        headers (list): Headers for each client to send with every request (such as the token of a different user
+                        per client). The clients cycle through them.
+
+    Returns:
+        Dictionary: The report built by summarise for all the requests ("overall") and for each kind ("endpoints").
+    """
+    names = list(workload)
+    weights = [workload[name][0] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    limits = httpx.Limits(max_connections = concurrency, max_keepalive_connections = concurrency)
+
+    async with httpx.AsyncClient(base_url = base_url, limits = limits, timeout = 60) as client:
+        stop_at = time.perf_counter() + duration
+
+        async def worker(offset: int):
+            choices = random.Random(seed * 100003 + offset)
+            worker_headers = headers[offset % len(headers)] if headers else None
+
+            while time.perf_counter() < stop_at:
+                name = choices.choices(names, weights)[0]
+                start = time.perf_counter()
+                try:
+                    res = await workload[name][1](client, choices, worker_headers)
+                    if res.status_code >= 500:
+                        errors[name] += 1
+                        continue
+                except httpx.HTTPError:
+                    errors[name] += 1
+                    continue
+                latencies[name].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(offset) for offset in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    return {"overall": summarise([latency for name in names for latency in latencies[name]],
+                                 sum(errors.values()), elapsed),
+            "endpoints": {name: summarise(latencies[name], errors[name], elapsed) for name in names}
+            }
@@ -0,0 +1,65 @@
+# --- Measure how a burst of logins affects the latency of the other endpoints in the same worker, with the bcrypt
+# --- hashing in the threadpool (password_hash_workers = 0) and in the hashing processes.
+# ---
+# --- For each mode the API is started, a user is created and then two loads run side by side: clients logging in
+# --- as fast as they can and clients reading posts. The reads are also run on their own first as a baseline.
+# --- Run it from the root of the repo against the database in your .env / environment:
+# --- python -m benchmarks.login_mixed_load --workers 0 2 4 --duration 15
+
+# --- Import the required modules:
+import argparse
+import asyncio
+import json
+import uuid
+
+import httpx
+
+from benchmarks.load import drive, run_server
+
+
+async def mixed_load(base_url: str, args) -> dict:
+    email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+    httpx.post(f"{base_url}/user/", json = {"email": email, "password": "benchmark-password"}).raise_for_status()
+
+    logins = [lambda client: client.post("/login", data = {"username": email, "password": "benchmark-password"})]
+    reads = [lambda client: client.get("/post/"),
+             lambda client: client.get(f"/post/{args.post_id}")]
+
+    baseline = await drive(base_url, reads, args.read_clients, args.duration)
+    login_report, read_report = await asyncio.gather(drive(base_url, logins, args.login_clients, args.duration),
+                                                     drive(base_url, reads, args.read_clients, args.duration))
+
+    return {"reads_alone": baseline, "logins": login_report, "reads_with_logins": read_report}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Measure login throughput against the latency of other endpoints.")
+    parser.add_argument("--workers", type = int, nargs = "+", default = [0, 2],
+                        help = "The password_hash_workers values to test. 0 hashes in the threadpool.")
+    parser.add_argument("--login-clients", type = int, default = 16, help = "Concurrent clients logging in.")
+    parser.add_argument("--read-clients", type = int, default = 16, help = "Concurrent clients reading posts.")
+    parser.add_argument("--duration", type = float, default = 15, help = "Seconds to run each load for.")
+    parser.add_argument("--port", type = int, default = 8100, help = "The port to start the API on.")
+    parser.add_argument("--post-id", type = int, default = 1, help = "A post that exists, for GET /post/{id}.")
+    args = parser.parse_args()
+
+    results = []
+
+    for workers in args.workers:
+        # --- The queue limit is raised so the comparison measures latency rather than how many logins get a 503:
+        env = {"PASSWORD_HASH_WORKERS": str(workers), "PASSWORD_HASH_QUEUE_LIMIT": "100000"}
+
+        with run_server(args.port, env = env) as base_url:
+            results.append({"password_hash_workers": workers, **asyncio.run(mixed_load(base_url, args))})
+            print(json.dumps(results[-1]))
+
+    print(f"\n{'hash workers':>12} {'login rps':>10} {'read p50 alone':>15} {'read p50 mixed':>15} "
+          f"{'read p99 alone':>15} {'read p99 mixed':>15}")
+    for result in results:
+        print(f"{result['password_hash_workers']:>12} {result['logins']['rps']:>10} "
+              f"{result['reads_alone']['p50_ms']:>15} {result['reads_with_logins']['p50_ms']:>15} "
+              f"{result['reads_alone']['p99_ms']:>15} {result['reads_with_logins']['p99_ms']:>15}")
+
+
+if __name__ == "__main__":
+    main()
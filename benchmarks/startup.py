@@ -0,0 +1,164 @@
+# --- Measure how long the API takes to start: where the time goes while importing it, and how long a new process takes
+# --- to answer its first request. Run it from the root of the repo:
+# --- python -m benchmarks.startup imports --top 15
+# --- python -m benchmarks.startup first-request --runs 5 --target-ms 1500
+# ---
+# --- first-request exits with 1 when the median time is over --target-ms, so it can gate a change in CI. Pass
+# --- --path /post/ to include opening the first database connection in the time.
+
+# --- Import the required modules:
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+
+# --- The time a new container should take from starting the process to answering its first request:
+TARGET_FIRST_REQUEST_MS = 1500
+
+
+def import_times(module: str = "app.main") -> list:
+    """
+    Overview:
+        Import a module in a new interpreter with -X importtime and read back the time spent on each import.
+
+    Args:
+        module (string): The module to import.
+
+    Returns:
+        List: A dictionary per imported module, with its own time, the time including its imports (cumulative) and
+              how deeply it was nested, in microseconds, in import order.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output = True, text = True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        own, cumulative, name = line[len("import time:"):].split("|")
+        imports.append({"module": name.strip(),
+                        "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+                        "self_us": int(own),
+                        "cumulative_us": int(cumulative)
+                        })
+
+    return imports
+
+
+def imports(args) -> int:
+    times = import_times(args.module)
+    total = next(item for item in reversed(times) if item["module"] == args.module)["cumulative_us"]
+
+    # --- The time spent in each top level package, wherever it was imported from:
+    packages = {}
+    for item in times:
+        package = item["module"].split(".")[0]
+        packages[package] = packages.get(package, 0) + item["self_us"]
+
+    print(f"Importing {args.module} took {total / 1000:.1f}ms.")
+    print(f"\n{'package':<28} {'ms':>8} {'share':>7}")
+    for package, micros in sorted(packages.items(), key = lambda item: -item[1])[:args.top]:
+        print(f"{package:<28} {micros / 1000:>8.1f} {micros / total:>7.1%}")
+
+    print(f"\n{'application module':<28} {'ms':>8} {'self ms':>8}")
+    for item in sorted((item for item in times if item["module"].startswith("app")),
+                       key = lambda item: -item["cumulative_us"])[:args.top]:
+        print(f"{item['module']:<28} {item['cumulative_us'] / 1000:>8.1f} {item['self_us'] / 1000:>8.1f}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"module": args.module, "total_us": total, "imports": times}, output, indent = 2)
+
+    return 0
+
+
+def first_request_ms(port: int, path: str, env: dict = None, timeout: float = 30) -> float:
+    """
+    Overview:
+        Start the API with uvicorn in a new process and time it until it answers a request for path with a 2xx.
+
+    Args:
+        port (int): The port to listen on.
+        path (string): The path to request.
+        env (dict): Environment variables to set for the server on top of the current environment.
+        timeout (float): Seconds to wait for an answer before giving up.
+
+    Returns:
+        Float: The time from starting the process to the first answer, in milliseconds.
+    """
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app",
+                               "--port", str(port),
+                               "--no-access-log",
+                               "--log-level", "warning"],
+                              env = {**os.environ, **(env or {})})
+    try:
+        with httpx.Client(timeout = 1) as client:
+            while True:
+                try:
+                    if client.get(f"http://127.0.0.1:{port}{path}").is_success:
+                        return (time.perf_counter() - start) * 1000
+                except httpx.TransportError:
+                    pass
+
+                if time.perf_counter() - start > timeout or server.poll() is not None:
+                    raise RuntimeError("The API did not answer.")
+                time.sleep(0.005)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def first_request(args) -> int:
+    env = dict(item.split("=", 1) for item in args.env)
+    times = [first_request_ms(args.port, args.path, env) for _ in range(args.runs)]
+    median = statistics.median(times)
+
+    print(f"First answer to GET {args.path} over {args.runs} starts: min {min(times):.0f}ms, "
+          f"median {median:.0f}ms, max {max(times):.0f}ms (target {args.target_ms:.0f}ms).")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"path": args.path, "env": env, "target_ms": args.target_ms, "times_ms": times,
+                       "median_ms": median}, output, indent = 2)
+
+    return 1 if median > args.target_ms else 0
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description = "Measure how long the API takes to import and to start.")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    imports_parser = commands.add_parser("imports", help = "Report the time spent importing each package.")
+    imports_parser.add_argument("--module", default = "app.main", help = "The module to import.")
+    imports_parser.add_argument("--top", type = int, default = 15, help = "The number of rows in each table.")
+    imports_parser.add_argument("--output", help = "A file to save every import time to as JSON.")
+    imports_parser.set_defaults(handler = imports)
+
+    first_parser = commands.add_parser("first-request", help = "Time new processes until they answer a request.")
+    first_parser.add_argument("--path", default = "/", help = "The path to request.")
+    first_parser.add_argument("--runs", type = int, default = 5, help = "The number of times to start the API.")
+    first_parser.add_argument("--target-ms", type = float, default = TARGET_FIRST_REQUEST_MS,
+                              help = "The median time (in milliseconds) beyond which the run fails.")
+    first_parser.add_argument("--env", action = "append", default = [], metavar = "NAME=VALUE",
+                              help = "A setting for the API, for example DATABASE_ASYNC=true. Can be repeated.")
+    first_parser.add_argument("--port", type = int, default = 8100, help = "The port to start the API on.")
+    first_parser.add_argument("--output", help = "A file to save the times to as JSON.")
+    first_parser.set_defaults(handler = first_request)
+
+    args = parser.parse_args(argv)
+
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+# --- Run a mixed workload across the main endpoints and save the latency percentiles and throughput as JSON, or compare
+# --- two saved runs to see whether a change made things faster or slower.
+# ---
+# --- A run creates (or empties) the database named by --database, seeds it with the given dataset size and starts the
+# --- API against it, so it never touches the database in your .env. Run it from the root of the repo:
+# --- python -m benchmarks.suite run --posts 10000 --concurrency 16 64 --output before.json
+# --- python -m benchmarks.suite run --posts 10000 --concurrency 16 64 --output after.json
+# --- python -m benchmarks.suite compare before.json after.json --threshold 10
+# ---
+# --- Settings can be changed for the API with --env, for example --env DATABASE_ASYNC=true.
+
+# --- Import the required modules:
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import httpx
+
+from benchmarks.dataset import BENCHMARK_PASSWORD, create_database, email, generate
+from benchmarks.load import drive_mix, run_server
+
+
+# --- The metrics compared between runs, and whether a higher value is better:
+COMPARED = {"rps": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+
+def workload(users: int, posts: int) -> dict:
+    """The kinds of request sent by a run, with their weights (roughly the mix seen in production)."""
+    def login(client, choices, headers):
+        return client.post("/login", data = {"username": email(choices.randint(1, users)),
+                                             "password": BENCHMARK_PASSWORD})
+
+    def list_posts(client, choices, headers):
+        return client.get("/post/", headers = headers)
+
+    def get_post(client, choices, headers):
+        return client.get(f"/post/{choices.randint(1, posts)}", headers = headers)
+
+    def vote(client, choices, headers):
+        return client.post("/vote/", json = {"post_id": choices.randint(1, posts), "dir": choices.randint(0, 1)},
+                           headers = headers)
+
+    def get_user(client, choices, headers):
+        return client.get(f"/user/{choices.randint(1, users)}", headers = headers)
+
+    return {"login": (2, login),
+            "list_posts": (40, list_posts),
+            "get_post": (30, get_post),
+            "vote": (18, vote),
+            "get_user": (10, get_user)
+            }
+
+
+def log_in(base_url: str, count: int) -> list:
+    """Log in as the first seeded users and return the headers to send their tokens with."""
+    headers = []
+
+    for number in range(1, count + 1):
+        res = httpx.post(f"{base_url}/login", data = {"username": email(number), "password": BENCHMARK_PASSWORD},
+                         timeout = 60)
+        res.raise_for_status()
+        headers.append({"Authorization": f"Bearer {res.json()['access_token']}"})
+
+    return headers
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+                              check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> int:
+    # --- The database has to be chosen before the application settings are first read:
+    os.environ["DATABASE_NAME"] = args.database
+    env = dict(item.split("=", 1) for item in args.env)
+
+    if args.no_seed:
+        dataset = {"users": args.users, "posts": args.posts, "votes": None}
+    else:
+        create_database(args.database)
+        dataset = generate(args.users, args.posts, args.votes, args.seed)
+        print(f"Seeded {args.database}: {dataset}", file = sys.stderr)
+
+    results = []
+
+    with run_server(args.port, env = {**env, "DATABASE_NAME": args.database}, workers = args.workers) as base_url:
+        headers = log_in(base_url, min(args.users, max(args.concurrency)))
+        requests = workload(args.users, args.posts)
+
+        # --- A short run first, so the first measurements don't include connecting to the database:
+        asyncio.run(drive_mix(base_url, requests, min(args.concurrency), args.warmup, args.seed, headers))
+
+        for concurrency in args.concurrency:
+            report = asyncio.run(drive_mix(base_url, requests, concurrency, args.duration, args.seed, headers))
+            results.append({"concurrency": concurrency, **report})
+            print(f"{concurrency} clients: {json.dumps(report['overall'])}", file = sys.stderr)
+
+    artifact = {"meta": {"commit": git_commit(),
+                         "created_at": datetime.now(timezone.utc).isoformat(),
+                         "python": platform.python_version(),
+                         "dataset": dataset,
+                         "seed": args.seed,
+                         "duration": args.duration,
+                         "workers": args.workers,
+                         "env": env
+                         },
+                "runs": results
+                }
+
+    with open(args.output, "w") as output:
+        json.dump(artifact, output, indent = 2)
+
+    print(f"Saved {args.output}", file = sys.stderr)
+
+    return 0
+
+
+def change(before: float, after: float) -> float:
+    """The change from before to after, as a percentage of before."""
+    if not before:
+        return 0.0
+
+    return round((after - before) / before * 100, 1)
+
+
+def compare(args) -> int:
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+
+    before_runs = {run["concurrency"]: run for run in before["runs"]}
+    rows = []
+
+    for after_run in after["runs"]:
+        before_run = before_runs.get(after_run["concurrency"])
+        if before_run is None:
+            continue
+
+        for endpoint in ["overall", *after_run["endpoints"]]:
+            old = before_run["overall"] if endpoint == "overall" else before_run["endpoints"].get(endpoint)
+            new = after_run["overall"] if endpoint == "overall" else after_run["endpoints"][endpoint]
+            if old is None:
+                continue
+
+            for metric, higher_is_better in COMPARED.items():
+                percent = change(old[metric], new[metric])
+                worse = -percent if higher_is_better else percent
+
+                rows.append({"concurrency": after_run["concurrency"], "endpoint": endpoint, "metric": metric,
+                             "before": old[metric], "after": new[metric], "change_percent": percent,
+                             "regression": worse > args.threshold})
+
+    print(f"Comparing {before['meta']['commit']} ({args.before}) with {after['meta']['commit']} ({args.after})")
+    print(f"\n{'clients':>7} {'endpoint':<11} {'metric':<7} {'before':>10} {'after':>10} {'change':>8}")
+    for row in rows:
+        print(f"{row['concurrency']:>7} {row['endpoint']:<11} {row['metric']:<7} {row['before']:>10} "
+              f"{row['after']:>10} {row['change_percent']:>+7.1f}%{'  REGRESSION' if row['regression'] else ''}")
+
+    regressions = [row for row in rows if row["regression"]]
+    print(f"\n{len(regressions)} regression(s) beyond {args.threshold}%.")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"before": before["meta"], "after": after["meta"], "threshold": args.threshold,
+                       "rows": rows}, output, indent = 2)
+
+    # --- A non-zero exit code lets a CI job fail on a regression:
+    return 1 if regressions else 0
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description = "Benchmark the API with a mixed workload, or compare two runs.")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    run_parser = commands.add_parser("run", help = "Seed a database, run the workload and save the results.")
+    run_parser.add_argument("--database", default = "fastapi_bench",
+                            help = "The database to create and seed. Its tables are emptied first.")
+    run_parser.add_argument("--users", type = int, default = 1000, help = "The number of users to seed.")
+    run_parser.add_argument("--posts", type = int, default = 10000, help = "The number of posts to seed.")
+    run_parser.add_argument("--votes", type = int, default = 50000, help = "The number of votes to seed.")
+    run_parser.add_argument("--seed", type = int, default = 1, help = "Seeds the dataset and the request mix.")
+    run_parser.add_argument("--no-seed", action = "store_true",
+                            help = "Use the data already in the database. --users and --posts must match it.")
+    run_parser.add_argument("--concurrency", type = int, nargs = "+", default = [16, 64],
+                            help = "The numbers of concurrent clients to test with.")
+    run_parser.add_argument("--duration", type = float, default = 20, help = "Seconds to run each test for.")
+    run_parser.add_argument("--warmup", type = float, default = 3, help = "Seconds to run before measuring.")
+    run_parser.add_argument("--workers", type = int, default = 1, help = "The number of uvicorn workers.")
+    run_parser.add_argument("--env", action = "append", default = [], metavar = "NAME=VALUE",
+                            help = "A setting for the API, for example DATABASE_ASYNC=true. Can be repeated.")
+    run_parser.add_argument("--port", type = int, default = 8100, help = "The port to start the API on.")
+    run_parser.add_argument("--output", default = "benchmark.json", help = "The file to save the results to.")
+    run_parser.set_defaults(handler = run)
+
+    compare_parser = commands.add_parser("compare", help = "Compare two saved runs.")
+    compare_parser.add_argument("before", help = "The results of the run to compare against.")
+    compare_parser.add_argument("after", help = "The results of the run with the change.")
+    compare_parser.add_argument("--threshold", type = float, default = 10,
+                                help = "The change (in percent) beyond which a metric counts as a regression.")
+    compare_parser.add_argument("--output", help = "A file to save the comparison to as JSON.")
+    compare_parser.set_defaults(handler = compare)
+
+    args = parser.parse_args(argv)
+
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+# --- gunicorn reads this file from the directory it is started in, for example:
+# --- PROMETHEUS_MULTIPROC_DIR=/tmp/metrics gunicorn app.main:app -k uvicorn.workers.UvicornWorker -w 4
+# ---
+# --- With PROMETHEUS_MULTIPROC_DIR set, each worker writes its metrics to files in that directory so /metrics can
+# --- report the totals for every worker (see app/metrics.py).
+
+# --- Import the required modules:
+import glob
+import os
+
+
+# --- Start with an empty metrics directory, so the numbers from a previous run aren't added in:
+def on_starting(server):
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(path)
+
+
+# --- Stop counting the in flight requests and pool connections of a worker that has exited:
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
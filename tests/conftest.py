@@ -5,13 +5,16 @@
 # --- Import the required modules:
 from app.auth.oauth2 import create_access_token
 from app.config import settings
-from app.database import get_db, Base
+from app.database import get_db, Base, ThreadpoolSession
 from app.main import app
+from app.timing import instrument
 from app.models import models
 from fastapi.testclient import TestClient
 from pytest import fixture
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
 
 # --- Create a constant that will be used to point to and pass the user details to our database:
@@ -20,10 +23,21 @@ print(SQLALCHEMY_DATABASE_URL)
 
 # --- Create an engine to connect to the database:
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
+instrument(engine)
 
 
 # --- Create a session to the database:
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+
+# --- When database_async is switched on, the requests in the tests go through asyncpg sessions instead.
+# --- The test client runs each request in a new event loop and asyncpg connections can't be shared between loops, 
+# --- so the connections aren't pooled:
+if settings.database_async:
+    async_engine = create_async_engine(SQLALCHEMY_DATABASE_URL.replace("://", "+asyncpg://", 1), poolclass = NullPool)
+    instrument(async_engine.sync_engine)
+    AsyncTestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, 
+                                            bind=async_engine, class_=AsyncSession)
 
 # @fixture(scope="module")
 # --- All of the will run before any of the tests and anything after the yields will run once the tests are completed:
@@ -54,15 +68,20 @@ def session():
 @fixture()
 def fastapi_client(session):
     # --- Run before any of the tests
-    # --- Basically returns a pytest client to interact with
-    def override_get_db():
+    # --- Basically returns a pytest client to interact with.
+    # --- The routers are async, so the test session is wrapped to give it the same awaitable interface as get_db:
+    async def override_get_db():
         try:
-            yield session
+            yield ThreadpoolSession(session)
         finally:
             session.close()
+            
+    async def override_get_async_db():
+        async with AsyncTestingSessionLocal() as db:
+            yield db
     
     # --- This will override the get_db variable with the override_get_db to use a testing DB instead.
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_db] = override_get_async_db if settings.database_async else override_get_db
     
     # --- Return a new FastAPI test client
     yield TestClient(app)
@@ -98,6 +117,37 @@ def authorised_client(fastapi_client, token):
     return fastapi_client
 
 
+# --- Collect the SQL statements sent to the test database while a test runs:
+@fixture
+def query_counter(session):
+    target = async_engine.sync_engine if settings.database_async else engine
+    statements = []
+    
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    event.listen(target, "before_cursor_execute", count)
+    yield statements
+    event.remove(target, "before_cursor_execute", count)
+
+
+# --- Requests from this client each get their own database session (and connection), so requests sent from several
+# --- threads at once run in separate transactions, as they would against the real application:
+@fixture
+def concurrent_client(authorised_client):
+    async def override_get_db():
+        db = TestingSessionLocal()
+        try:
+            yield ThreadpoolSession(db)
+        finally:
+            db.close()
+    
+    if not settings.database_async:
+        app.dependency_overrides[get_db] = override_get_db
+    
+    return authorised_client
+
+
 @fixture
 def test_posts(test_user, session):
     # --- Define a variable with a list of dictionaries that 
@@ -0,0 +1,223 @@
+# --- Import the required modules:
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from app.config import settings
+from app.database import get_db, Base, ThreadpoolSession
+from app.main import app
+from app.models import models
+from pytest import fixture, mark
+from sqlalchemy import event, select, text
+from tests.conftest import engine, TestingSessionLocal
+import os
+import subprocess
+import sys
+
+
+ALEMBIC_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic")
+
+
+# --- Fill the tables with enough rows that Postgres only picks an index when it is the cheaper plan, then update the
+# --- planner statistics. test_user (id 1) owns about one post in 2,000:
+@fixture
+def seeded_database(session, test_posts):
+    session.execute(text("INSERT INTO users (email, password) "
+                         "SELECT 'user' || n || '@example.com', 'password' FROM generate_series(1, 2000) AS n"))
+    session.execute(text("INSERT INTO posts (title, content, owner_id, created_at) "
+                         "SELECT 'Post ' || n, 'Content for post ' || n, n % 2001 + 1, now() - n * interval '1 minute' "
+                         "FROM generate_series(1, 20000) AS n"))
+    session.execute(text("INSERT INTO votes (post_id, user_id) "
+                         "SELECT n, n * 7 % 2001 + 1 FROM generate_series(4, 20000) AS n"))
+    session.execute(text("UPDATE posts SET vote_count = n.votes FROM (SELECT post_id, count(*) AS votes FROM votes "
+                         "GROUP BY post_id) AS n WHERE posts.id = n.post_id"))
+    # --- Move the rows waiting in the pending list of the full-text index into the index, as autovacuum would. The
+    # --- planner avoids an index with a long pending list:
+    session.execute(text("SELECT gin_clean_pending_list('ix_posts_search_vector')"))
+    session.execute(text("ANALYZE users, posts, votes"))
+    session.execute(text("REFRESH MATERIALIZED VIEW post_rankings"))
+    session.execute(text("ANALYZE post_rankings"))
+    session.commit()
+
+
+# --- Collect the statements (and their parameters) the routers send, through a session per request on the sync
+# --- engine in both database modes, so each statement can be explained with psycopg2 afterwards:
+@fixture
+def explained_client(authorised_client, seeded_database):
+    async def override_get_db():
+        db = TestingSessionLocal()
+        try:
+            yield ThreadpoolSession(db)
+        finally:
+            db.close()
+
+    statements = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    app.dependency_overrides[get_db] = override_get_db
+    event.listen(engine, "before_cursor_execute", collect)
+    yield authorised_client, statements
+    event.remove(engine, "before_cursor_execute", collect)
+
+
+def config() -> Config:
+    config = Config()
+    config.set_main_option("script_location", ALEMBIC_DIRECTORY)
+    
+    return config
+
+
+def explain(statement: str, parameters = None) -> str:
+    with engine.connect() as connection:
+        return "\n".join(connection.exec_driver_sql(f"EXPLAIN {statement}", parameters or {}).scalars())
+
+
+# --- Define a test to check the migrations build the same schema as the models.
+# --- Upgrading an empty database to head, finding no differences with the models and downgrading again is expected
+# --- to pass the test:
+def test_migrations_match_models(session):
+    Base.metadata.drop_all(bind = engine)
+
+    command.upgrade(config(), "head")
+    with engine.connect() as connection:
+        # --- The generated search_vector expression is reported as changed however it is written, so it is ignored:
+        differences = [difference for difference in compare_metadata(MigrationContext.configure(connection),
+                                                                      Base.metadata)
+                       if difference[0][0] != "modify_default"]
+    command.downgrade(config(), "base")
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE alembic_version"))
+
+    assert differences == []
+
+
+# --- Define a test to check the migrations build the same schema whatever search_trigram is set to, so a database
+# --- doesn't depend on the setting at the time it was migrated. No trigram index (or pg_trgm) is expected to pass:
+def test_migrations_ignore_search_trigram(session, monkeypatch):
+    monkeypatch.setattr(settings, "search_trigram", True)
+    Base.metadata.drop_all(bind = engine)
+
+    command.upgrade(config(), "head")
+    with engine.connect() as connection:
+        indexes = connection.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = 'posts'")).scalars().all()
+    command.downgrade(config(), "base")
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE alembic_version"))
+
+    assert "ix_posts_search_vector" in indexes
+    assert "ix_posts_title_trgm" not in indexes
+
+
+# --- Define a test to check the trigram index is created on demand, for a database that has pg_trgm.
+# --- The index on posts.title is expected to pass the test:
+@mark.skipif(not settings.search_trigram, reason = "search_trigram is switched off.")
+def test_create_trigram_index(session):
+    session.execute(text("DROP INDEX IF EXISTS ix_posts_title_trgm"))
+    session.commit()
+
+    subprocess.run([sys.executable, "-m", "app.manage", "create-trigram-index"], check = True,
+                   cwd = os.path.dirname(ALEMBIC_DIRECTORY))
+
+    assert session.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_posts_title_trgm'")).scalar()
+
+
+# --- The tables the original application created at startup, before the schema was migrated by Alembic:
+ORIGINAL_TABLES = ["CREATE TABLE users (id serial PRIMARY KEY, email varchar NOT NULL UNIQUE, "
+                   "password varchar NOT NULL, created_at timestamptz NOT NULL DEFAULT now())",
+                   "CREATE TABLE posts (id serial PRIMARY KEY, title varchar NOT NULL, content varchar NOT NULL, "
+                   "published boolean NOT NULL DEFAULT TRUE, created_at timestamptz NOT NULL DEFAULT now(), "
+                   "owner_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE)",
+                   "CREATE TABLE votes (post_id integer REFERENCES posts (id) ON DELETE CASCADE, "
+                   "user_id integer REFERENCES users (id) ON DELETE CASCADE, PRIMARY KEY (post_id, user_id))"]
+
+# --- The current models without the indexes and view of the last two revisions, as create_all made them in between:
+EARLIER_MODELS = ["DROP MATERIALIZED VIEW post_rankings",
+                  "DROP INDEX ix_posts_created_at_id, ix_posts_owner_id_created_at_id, ix_votes_user_id"]
+
+
+# --- Define a test to check a database Alembic doesn't track is brought up to the models by create-schema, whichever
+# --- version of the application created its tables: the original one, one from before the latest revisions, or the
+# --- current models (as the benchmark dataset did).
+# --- No differences with the models, and the latest revision stamped, are expected to pass the test:
+@mark.parametrize("models_version", ["original", "earlier", "current"])
+def test_create_schema_upgrades_untracked_database(session, models_version):
+    Base.metadata.drop_all(bind = engine)
+    
+    if models_version != "original":
+        Base.metadata.create_all(bind = engine)
+    
+    with engine.begin() as connection:
+        for statement in {"original": ORIGINAL_TABLES, "earlier": EARLIER_MODELS, "current": []}[models_version]:
+            connection.execute(text(statement))
+    
+    # --- It runs in its own process, as it would before starting the API. Loading alembic.ini switches off the
+    # --- application loggers the other tests read:
+    subprocess.run([sys.executable, "-m", "app.manage", "create-schema"], check = True,
+                   cwd = os.path.dirname(ALEMBIC_DIRECTORY))
+    
+    with engine.connect() as connection:
+        differences = [difference for difference in compare_metadata(MigrationContext.configure(connection),
+                                                                      Base.metadata)
+                       if difference[0][0] != "modify_default"]
+        revision = MigrationContext.configure(connection).get_current_revision()
+    
+    Base.metadata.drop_all(bind = engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE alembic_version"))
+    
+    assert differences == []
+    assert revision == ScriptDirectory.from_config(config()).get_current_head()
+
+
+# --- Define a test to check every statement sent by the hot read and vote paths uses an index rather than reading a
+# --- whole table. No sequential scan in any of their plans is expected to pass the test:
+@mark.parametrize("method, path, body", [
+    ("get", "/post/", None),
+    ("get", "/post/?cursor=next", None),
+    ("get", "/post/?search=zebra", None),
+    ("get", "/post/?sort=hot", None),
+    ("get", "/post/?sort=hot&cursor=next", None),
+    ("get", "/post/?sort=top&cursor=next", None),
+    ("get", "/post/my-posts", None),
+    ("get", "/post/my-posts?limit=1&cursor=next", None),
+    ("get", "/post/10000", None),
+    ("get", "/user/1000", None),
+    ("post", "/vote/", {"post_id": 2, "dir": 1}),
+    ("post", "/vote/", {"post_id": 2001, "dir": 0}),
+])
+def test_router_queries_use_indexes(explained_client, method, path, body):
+    client, statements = explained_client
+
+    # --- Start from the cursor of the first page, so the keyset condition is explained too:
+    if "cursor=next" in path:
+        first_page = client.get(path.replace("cursor=next", "").rstrip("?&"))
+        path = path.replace("next", first_page.headers["X-Next-Cursor"])
+        statements.clear()
+
+    res = getattr(client, method)(path, json = body) if body else getattr(client, method)(path)
+
+    sent = list(statements)
+
+    assert res.status_code < 300
+    assert sent
+    # --- A search can match more posts than a page, and joins their owners by hashing the (small) users table rather
+    # --- than looking each one up, so only the posts have to be read through an index:
+    scan = "Seq Scan on posts" if "search=" in path else "Seq Scan"
+    for statement, parameters in sent:
+        plan = explain(statement, parameters)
+
+        assert scan not in plan, f"{statement}\n{plan}"
+
+
+# --- Define a test to check the votes of a user can be found without reading every vote.
+# --- A scan of ix_votes_user_id is expected to pass the test:
+def test_votes_by_user_use_index(seeded_database):
+    statement = select(models.Vote.post_id).where(models.Vote.user_id == 1000)
+
+    assert "ix_votes_user_id" in explain(str(statement.compile(engine, compile_kwargs = {"literal_binds": True})))
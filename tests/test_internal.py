@@ -0,0 +1,35 @@
+# --- Import the required modules:
+from app.config import settings
+from app.database import engine
+from app.pool import pool_status
+
+
+# --- Define a test to check the pool statistics are reported.
+# --- HTTP 200 is expected to pass the test:
+def test_get_pool_status(fastapi_client, monkeypatch):
+    monkeypatch.setattr(settings, "internal_routes", True)
+    res = fastapi_client.get("/internal/pool")
+    
+    assert {"checked_out", "overflow", "checkouts", "timeouts", "wait_seconds_total"} <= set(res.json()["primary"])
+    assert res.status_code == 200
+
+
+# --- Define a test to check the internal routes can't be reached unless they are switched on.
+# --- HTTP 404 is expected to pass the test:
+def test_internal_routes_off_by_default(fastapi_client):
+    assert fastapi_client.get("/internal/pool").status_code == 404
+
+
+# --- Define a test to check the pool statistics follow a connection being checked out and returned.
+# --- The checked out count going up by one and back again is expected to pass the test:
+def test_pool_status_counts_checkouts():
+    before = pool_status(engine.pool)
+    
+    with engine.connect():
+        during = pool_status(engine.pool)
+    
+    after = pool_status(engine.pool)
+    
+    assert during["checked_out"] == before["checked_out"] + 1
+    assert after["checked_out"] == before["checked_out"]
+    assert after["checkouts"] == before["checkouts"] + 1
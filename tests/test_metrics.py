@@ -0,0 +1,54 @@
+# --- Import the required modules:
+from app.config import settings
+from prometheus_client import REGISTRY
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+# --- Define a test to check requests are counted by route template and status code, and exposed at /metrics.
+# --- The counts going up under /post/{id} (rather than the raw paths) and unmatched is expected to pass the test:
+def test_request_metrics(fastapi_client, test_posts):
+    found = sample("http_requests_total", method = "GET", route = "/post/{id}", status = "200")
+    missing = sample("http_requests_total", method = "GET", route = "/post/{id}", status = "404")
+    timed = sample("http_request_duration_seconds_count", method = "GET", route = "/post/{id}")
+    unmatched = sample("http_requests_total", method = "GET", route = "unmatched", status = "404")
+    
+    fastapi_client.get("/post/1")
+    fastapi_client.get("/post/2")
+    fastapi_client.get("/post/100")
+    fastapi_client.get("/no-such-page")
+    
+    assert sample("http_requests_total", method = "GET", route = "/post/{id}", status = "200") == found + 2
+    assert sample("http_requests_total", method = "GET", route = "/post/{id}", status = "404") == missing + 1
+    assert sample("http_request_duration_seconds_count", method = "GET", route = "/post/{id}") == timed + 3
+    assert sample("http_requests_total", method = "GET", route = "unmatched", status = "404") == unmatched + 1
+    assert sample("http_requests_in_flight", method = "GET", route = "/post/{id}") == 0
+    
+    res = fastapi_client.get("/metrics")
+    
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/post/{id}",status="404"}' in res.text
+    assert 'db_pool_checked_out{pool="primary"}' in res.text
+    assert "/post/100" not in res.text
+
+
+# --- Define a test to check the password hashing is timed.
+# --- One more hash timing after creating a user is expected to pass the test:
+def test_password_hash_metrics(fastapi_client):
+    before = sample("password_hash_seconds_count", function = "hash_pwd")
+    
+    fastapi_client.post("/user/", json = {"email": "metrics@sam.sam", "password": "metrics-password"})
+    
+    assert sample("password_hash_seconds_count", function = "hash_pwd") == before + 1
+
+
+# --- Define a test to check the metrics can't be reached when they are switched off.
+# --- HTTP 404 is expected to pass the test:
+def test_metrics_off(fastapi_client, monkeypatch):
+    monkeypatch.setattr(settings, "metrics", False)
+    res = fastapi_client.get("/metrics")
+    
+    assert res.status_code == 404
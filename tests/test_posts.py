@@ -1,5 +1,15 @@
+from app.auth.oauth2 import create_access_token
+from app.config import settings
+from app.database import ThreadpoolSession
+from app.models import models
+from app.rankings import refresh_rankings
+from app.routers import post as post_router
 from app.schemas import PostResponse
-from pytest import mark
+from datetime import datetime, timedelta, timezone
+from pytest import fixture, mark
+from tests.conftest import TestingSessionLocal
+import asyncio
+import json
 
 
 # --- Define a function to get all of the posts
@@ -85,6 +95,102 @@ def test_create_post_unauthorised(fastapi_client, test_posts):
     assert res.status_code == 401
 
 
+# --- Define a test to check that the owners of the posts are loaded without a query per owner.
+# --- The same number of queries for a page of 2 and a page of 12 posts, each by a different owner, is expected to pass:
+@mark.parametrize("owner_loading, queries", [("joined", 1), ("selectin", 2)])
+def test_get_all_posts_query_count(authorised_client, test_posts, session, query_counter, monkeypatch, 
+                                   owner_loading, queries):
+    monkeypatch.setattr(settings, "owner_loading", owner_loading)
+    
+    for number in range(12):
+        owner = models.User(email = f"owner{number}@sam.sam", password = "not-a-hash")
+        session.add(models.Post(title = f"Owned {number}", content = "Content.", owner = owner))
+    session.commit()
+    
+    for limit in (2, 12):
+        query_counter.clear()
+        res = authorised_client.get("/post/", params = {"limit": limit})
+        
+        assert len({post["Post"]["owner"]["email"] for post in res.json()}) == limit
+        assert len(query_counter) == queries
+    
+    # --- My posts also looks up the logged in user:
+    for limit in (1, 3):
+        query_counter.clear()
+        authorised_client.get("/post/my-posts", params = {"limit": limit})
+        
+        assert len(query_counter) == queries + 1
+
+
+# --- Define a test to check that the owner of a post can update it.
+# --- HTTP 200 with the new content and the owner is expected to pass the test:
+def test_update_post(authorised_client, test_posts, test_user):
+    res = authorised_client.put("/post/1", json = {"title": "Updated", "content": "Updated content.", "published": False})
+    
+    updated_post = PostResponse(**res.json())
+    
+    assert res.status_code == 200
+    assert (updated_post.id, updated_post.title, updated_post.published) == (1, "Updated", False)
+    assert updated_post.owner.email == test_user["email"]
+    assert authorised_client.get("/post/1").json()["Post"]["title"] == "Updated"
+
+
+# --- Define a test to check that a post can't be changed by another user, or when it doesn't exist.
+# --- HTTP 403 for another user's post and 404 for a missing one, with the post unchanged, are expected to pass the test:
+def test_update_and_delete_post_other_user(fastapi_client, test_posts):
+    res = fastapi_client.post("/user/", json = {"email": "other@sam.sam", "password": "other-password"})
+    token = create_access_token({"user_id": res.json()["id"]})
+    fastapi_client.headers = {**fastapi_client.headers, "authorization": f"Bearer {token}"}
+    post = {"title": "Not mine", "content": "Not my content."}
+    
+    assert fastapi_client.put("/post/1", json = post).status_code == 403
+    assert fastapi_client.delete("/post/1").status_code == 403
+    assert fastapi_client.put("/post/100", json = post).status_code == 404
+    assert fastapi_client.delete("/post/100").status_code == 404
+    assert fastapi_client.get("/post/1").json()["Post"]["title"] == "One"
+
+
+# --- Define a test to check that a batch of posts is created in one request.
+# --- HTTP 201 with the new ids in the order sent, and each post readable afterwards, are expected to pass the test:
+def test_create_post_batch(authorised_client, test_posts, test_user):
+    batch = [{"title": f"Batch {number}", "content": f"Batch content {number}."} for number in range(5)]
+    res = authorised_client.post("/post/batch", json = batch)
+    
+    assert res.status_code == 201
+    
+    created = res.json()
+    ids = [post["id"] for post in created]
+    
+    assert ids == sorted(ids) and len(ids) == 5
+    assert all("created_at" in post for post in created)
+    
+    for post_id, post in zip(ids, batch):
+        read = authorised_client.get(f"/post/{post_id}").json()["Post"]
+        assert read["title"] == post["title"]
+        assert read["owner_id"] == test_user["id"]
+
+
+# --- Define a test to check that a batch with an invalid post is rejected as a whole.
+# --- HTTP 422 pointing at the failing post, and no new posts, are expected to pass the test:
+def test_create_post_batch_invalid(authorised_client, test_posts):
+    batch = [{"title": "Valid", "content": "Valid content."}, {"content": "No title."}]
+    res = authorised_client.post("/post/batch", json = batch)
+    
+    assert res.status_code == 422
+    assert res.json()["detail"][0]["loc"] == ["body", 1, "title"]
+    assert len(authorised_client.get("/post/").json()) == len(test_posts)
+    
+    assert authorised_client.post("/post/batch", json = []).status_code == 422
+
+
+# --- Define a test to check that an unauthorised user can't create a batch of posts.
+# --- HTTP 401 is expected to pass the test:
+def test_create_post_batch_unauthorised(fastapi_client, test_posts):
+    res = fastapi_client.post("/post/batch", json = [{"title": "Not authorised", "content": "Not authorised."}])
+    
+    assert res.status_code == 401
+
+
 # --- Define a test to check if an authorised user can delete a single posts.
 # --- HTTP 204, followed by 404 are expected to pass the test:
 def test_delete_post_authorised_user(authorised_client, test_posts):
@@ -113,4 +219,296 @@ def test_delete_post_not_exist_authorised_user(authorised_client, test_posts):
     url = "/post/100"
     delete_post = authorised_client.delete(url)
     
-    assert delete_post.status_code == 404
\ No newline at end of file
+    assert delete_post.status_code == 404
+
+# --- Define a test to check that the posts can be paged through with the cursor.
+# --- Every post should be returned once, newest first, and the last page should not have a cursor:
+def test_get_all_posts_cursor_pages(authorised_client, test_posts):
+    first_page = authorised_client.get("/post/", params = {"limit": 2})
+    cursor = first_page.headers["X-Next-Cursor"]
+    second_page = authorised_client.get("/post/", params = {"limit": 2, "cursor": cursor})
+    
+    ids = [post["Post"]["id"] for post in first_page.json() + second_page.json()]
+    
+    assert len(first_page.json()) == 2
+    assert "X-Next-Cursor" not in second_page.headers
+    assert ids == sorted([post.id for post in test_posts], reverse = True)
+
+
+# --- Define a test to check that a bad cursor is rejected.
+# --- HTTP 400 is expected to pass the test:
+def test_get_all_posts_invalid_cursor(authorised_client, test_posts):
+    res = authorised_client.get("/post/", params = {"cursor": "not-a-cursor"})
+    
+    assert res.json()["detail"] == "Invalid cursor."
+    assert res.status_code == 400
+
+
+# --- Define a test to check that the page size is capped.
+# --- HTTP 422 is expected to pass the test:
+def test_get_all_posts_limit_capped(authorised_client, test_posts):
+    res = authorised_client.get("/post/", params = {"limit": 1000})
+    
+    assert res.status_code == 422
+
+
+# --- Define a test to check that the users own posts can be paged through with the cursor.
+# --- HTTP 200 is expected to pass the test:
+def test_get_my_posts_cursor_pages(authorised_client, test_posts):
+    first_page = authorised_client.get("/post/my-posts", params = {"limit": 2})
+    second_page = authorised_client.get("/post/my-posts", params = {"limit": 2,
+                                                                     "cursor": first_page.headers["X-Next-Cursor"]})
+    
+    assert len(first_page.json()) + len(second_page.json()) == len(test_posts)
+    assert second_page.status_code == 200
+
+
+# --- Define a test to check that a search matches the words in the title and content of a post.
+# --- Only the post with "Two" in it is expected to pass the test:
+def test_search_posts_full_text(authorised_client, test_posts):
+    res = authorised_client.get("/post/", params = {"search": "two"})
+    
+    assert [post["Post"]["title"] for post in res.json()] == ["Two"]
+    assert res.status_code == 200
+
+
+# --- Define a test to check that a search matches part of a title, as the old LIKE search did, when trigram search is
+# --- switched on. Only the post with "hre" in the title is expected to pass the test:
+@mark.skipif(not settings.search_trigram, reason = "search_trigram is switched off.")
+def test_search_posts_title_substring(authorised_client, test_posts):
+    res = authorised_client.get("/post/", params = {"search": "hre"})
+    
+    assert [post["Post"]["title"] for post in res.json()] == ["Three"]
+
+
+# --- Define a test to check that the best match comes first.
+# --- "Two" is expected first as the term is in its title as well as its content, with the cursor following the rank:
+def test_search_posts_ranked(authorised_client, test_posts, session):
+    session.add(models.Post(title = "Unrelated", content = "This post mentions two once.", owner_id = test_posts[0].owner_id))
+    session.commit()
+    
+    first_page = authorised_client.get("/post/", params = {"search": "two", "limit": 1})
+    second_page = authorised_client.get("/post/", params = {"search": "two", "limit": 1, 
+                                                             "cursor": first_page.headers["X-Next-Cursor"]})
+    
+    assert [post["Post"]["title"] for post in first_page.json() + second_page.json()] == ["Two", "Unrelated"]
+
+
+# --- Define a test to check that a misspelt title still matches when trigram search is switched on:
+@mark.skipif(not settings.search_trigram, reason = "search_trigram is switched off.")
+def test_search_posts_typo(authorised_client, test_posts):
+    res = authorised_client.get("/post/", params = {"search": "Three"})
+    
+    assert "Three" in [post["Post"]["title"] for post in res.json()]
+
+
+# --- Define a test to check that a post is only sent again once it has changed.
+# --- HTTP 304 while it is unchanged, then 200 with a new ETag after a vote are expected to pass the test:
+def test_get_one_post_etag(authorised_client, test_posts):
+    res = authorised_client.get("/post/1")
+    etag = res.headers["ETag"]
+    
+    not_modified = authorised_client.get("/post/1", headers = {"If-None-Match": etag})
+    
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    
+    authorised_client.post("/vote/", json = {"post_id": 1, "dir": 1})
+    modified = authorised_client.get("/post/1", headers = {"If-None-Match": etag})
+    
+    assert modified.status_code == 200
+    assert modified.headers["ETag"] != etag
+
+
+# --- Define a test to check that the list of posts is only sent again once a post on the page has changed.
+# --- HTTP 304 while it is unchanged, then 200 after an update are expected to pass the test:
+def test_get_all_posts_etag(authorised_client, test_posts):
+    etag = authorised_client.get("/post/").headers["ETag"]
+    
+    assert authorised_client.get("/post/", headers = {"If-None-Match": etag}).status_code == 304
+    
+    authorised_client.put("/post/1", json = {"title": "Updated", "content": "Updated content."})
+    
+    assert authorised_client.get("/post/", headers = {"If-None-Match": etag}).status_code == 200
+
+
+# --- Define a test to check the posts say whether the logged in user has voted for them.
+# --- True for the voted post and False for the others, for the voter only, is expected to pass the test:
+def test_voted_by_me(authorised_client, test_posts, session):
+    authorised_client.post("/vote/", json = {"post_id": 2, "dir": 1})
+    
+    other_user = models.User(email = "other@sam.sam", password = "not-a-hash")
+    session.add(other_user)
+    session.commit()
+    other_token = create_access_token({"user_id": other_user.id})
+    
+    posts = authorised_client.get("/post/").json()
+    other_posts = authorised_client.get("/post/", headers = {"authorization": f"Bearer {other_token}"}).json()
+    
+    assert {post["Post"]["id"]: post["voted_by_me"] for post in posts} == {1: False, 2: True, 3: False}
+    assert {post["voted_by_me"] for post in other_posts} == {False}
+    assert authorised_client.get("/post/2").json()["voted_by_me"] is True
+    assert authorised_client.get("/post/1").json()["voted_by_me"] is False
+
+
+# --- Define a test to check voted_by_me is null without a token, or with one that is invalid or has expired.
+# --- null on both serialisation paths for each caller is expected to pass the test:
+@mark.parametrize("fast_serialization", [False, True])
+def test_voted_by_me_anonymous(fastapi_client, test_posts, test_user, monkeypatch, fast_serialization):
+    monkeypatch.setattr(settings, "fast_serialization", fast_serialization)
+    monkeypatch.setattr("app.auth.oauth2.ACCESS_TOKEN_EXPIRE_MINUTES", -1)
+    expired_token = create_access_token({"user_id": test_user["id"]})
+    
+    for authorization in ("", "Bearer not-a-token", f"Bearer {expired_token}"):
+        headers = {"authorization": authorization}
+        res = fastapi_client.get("/post/", headers = headers)
+        
+        assert res.status_code == 200
+        assert {post["voted_by_me"] for post in res.json()} == {None}
+        assert fastapi_client.get("/post/1", headers = headers).json()["voted_by_me"] is None
+
+
+# --- Define a test to check the ETag of a post depends on who is asking, and caches are told so.
+# --- A Vary header on both responses and a 200 for a user holding another user's ETag are expected to pass the test:
+def test_voted_by_me_etag(authorised_client, test_posts):
+    authorised_client.post("/vote/", json = {"post_id": 1, "dir": 1})
+    
+    res = authorised_client.get("/post/1")
+    not_modified = authorised_client.get("/post/1", headers = {"If-None-Match": res.headers["ETag"]})
+    anonymous = authorised_client.get("/post/1", headers = {"If-None-Match": res.headers["ETag"], "authorization": ""})
+    
+    assert res.headers["Vary"] == not_modified.headers["Vary"] == "Authorization"
+    assert not_modified.status_code == 304
+    assert anonymous.status_code == 200
+    assert anonymous.json()["voted_by_me"] is None
+
+
+# --- Define a test to check that the fast serialisation path sends the same bytes and headers as the normal path.
+# --- Identical responses for the list, my posts and a single post (with non-ASCII and newlines) are expected to pass:
+def test_fast_serialization_matches(authorised_client, test_posts, session, monkeypatch):
+    session.add(models.Post(title = "Ünïcode ✓", content = "Line one\nLine \"two\" — 日本", owner_id = test_posts[0].owner_id))
+    session.commit()
+    
+    paths = [("/post/", {"limit": 2}), ("/post/my-posts", {"limit": 2}), ("/post/1", {})]
+    
+    monkeypatch.setattr(settings, "fast_serialization", False)
+    normal = [authorised_client.get(path, params = params) for path, params in paths]
+    
+    monkeypatch.setattr(settings, "fast_serialization", True)
+    fast = [authorised_client.get(path, params = params) for path, params in paths]
+    
+    for normal_res, fast_res in zip(normal, fast):
+        assert fast_res.status_code == normal_res.status_code == 200
+        assert fast_res.content == normal_res.content
+        assert fast_res.headers.get("ETag") == normal_res.headers.get("ETag")
+        assert fast_res.headers.get("X-Next-Cursor") == normal_res.headers.get("X-Next-Cursor")
+
+
+# --- Define a test to check that the export streams every post as one JSON object per line, oldest first, and a batch
+# --- at a time. HTTP 200 with all of the posts in id order is expected to pass the test:
+def test_export_posts(authorised_client, test_posts, monkeypatch):
+    monkeypatch.setattr(post_router, "EXPORT_BATCH_SIZE", 2)
+    
+    res = authorised_client.get("/post/export")
+    
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    
+    assert [line["id"] for line in lines] == sorted(post.id for post in test_posts)
+    assert lines[0]["title"] == "One" and lines[0]["votes"] == 0
+    assert set(lines[0]) == {"id", "title", "content", "published", "created_at", "owner_id", "votes"}
+
+
+# --- Define a test to check that the export can be narrowed down by owner and by the time the posts were created.
+# --- Only the matching posts are expected to pass the test:
+def test_export_posts_filtered(authorised_client, test_posts, session):
+    session.query(models.Post).filter(models.Post.id == test_posts[0].id)\
+           .update({models.Post.created_at: datetime(2020, 1, 1, tzinfo = timezone.utc)})
+    session.commit()
+    
+    def exported(**params):
+        return [json.loads(line)["id"] for line in authorised_client.get("/post/export", params = params).text.splitlines()]
+    
+    assert exported(owner_id = test_posts[0].owner_id) == [1, 2, 3]
+    assert exported(owner_id = 100) == []
+    assert exported(created_before = "2021-01-01T00:00:00Z") == [1]
+    assert exported(created_after = "2021-01-01T00:00:00Z") == [2, 3]
+
+
+# --- Define a test to check that an unauthorised user can't export the posts.
+# --- HTTP 401 is expected to pass the test:
+def test_export_posts_unauthorised(fastapi_client, test_posts):
+    assert fastapi_client.get("/post/export").status_code == 401
+
+
+# --- Give the test posts votes and ages and refresh the rankings. Post Two has the most votes but is three days old,
+# --- so it is top but not hot:
+@fixture
+def ranked_posts(test_posts, session):
+    now = datetime.now(timezone.utc)
+    for post, votes, age in zip(test_posts, [0, 5, 2], [timedelta(0), timedelta(days = 3), timedelta(0)]):
+        session.query(models.Post).filter(models.Post.id == post.id)\
+               .update({models.Post.vote_count: votes, models.Post.created_at: now - age})
+    session.commit()
+    
+    db = TestingSessionLocal()
+    try:
+        assert asyncio.run(refresh_rankings(ThreadpoolSession(db)))
+    finally:
+        db.close()
+    
+    return test_posts
+
+
+def titles(res) -> list:
+    return [post["Post"]["title"] for post in res.json()]
+
+
+# --- Define a test to check the posts can be sorted by their hot score and by their votes.
+# --- The ranked orders, with the live vote counts, are expected to pass the test:
+def test_get_all_posts_sorted(authorised_client, ranked_posts):
+    hot = authorised_client.get("/post/", params = {"sort": "hot"})
+    top = authorised_client.get("/post/", params = {"sort": "top"})
+    
+    assert hot.status_code == 200
+    assert titles(hot) == ["Three", "One", "Two"]
+    assert titles(top) == ["Two", "Three", "One"]
+    assert [post["votes"] for post in top.json()] == [5, 2, 0]
+    assert titles(authorised_client.get("/post/", params = {"sort": "top", "search": "Content"})) == ["Two", "Three", "One"]
+
+
+# --- Define a test to check a new post only joins the ranked sorts once the rankings have been refreshed.
+# --- The post missing from the hot sort, then ranked first after the refresh, is expected to pass the test:
+def test_get_all_posts_sorted_after_refresh(authorised_client, ranked_posts):
+    authorised_client.post("/post/", json = {"title": "Four", "content": "Content for Four."})
+    
+    assert titles(authorised_client.get("/post/", params = {"sort": "hot"})) == ["Three", "One", "Two"]
+    assert titles(authorised_client.get("/post/"))[0] == "Four"
+    
+    db = TestingSessionLocal()
+    try:
+        asyncio.run(refresh_rankings(ThreadpoolSession(db)))
+    finally:
+        db.close()
+    
+    assert titles(authorised_client.get("/post/", params = {"sort": "hot"})) == ["Three", "Four", "One", "Two"]
+
+
+# --- Define a test to check the ranked sorts can be paged through with the cursor.
+# --- Every post returned once, in ranked order, is expected to pass the test:
+@mark.parametrize("sort, expected", [("hot", ["Three", "One", "Two"]), ("top", ["Two", "Three", "One"])])
+def test_get_all_posts_sorted_cursor_pages(authorised_client, ranked_posts, sort, expected):
+    first_page = authorised_client.get("/post/", params = {"sort": sort, "limit": 2})
+    second_page = authorised_client.get("/post/", params = {"sort": sort, "limit": 2,
+                                                             "cursor": first_page.headers["X-Next-Cursor"]})
+    
+    assert titles(first_page) + titles(second_page) == expected
+    assert "X-Next-Cursor" not in second_page.headers
+
+
+# --- Define a test to check an unknown sort is rejected.
+# --- HTTP 422 is expected to pass the test:
+def test_get_all_posts_invalid_sort(authorised_client, test_posts):
+    assert authorised_client.get("/post/", params = {"sort": "best"}).status_code == 422
@@ -0,0 +1,106 @@
+# --- Import the required modules:
+from app.config import settings
+from app.database import Base, database_url
+from app.models import models
+from app.replicas import Replica, replicas
+from pytest import fixture
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+from tests.conftest import engine
+import asyncio
+
+
+# --- A second database on the same server stands in for a replica. It holds different posts to the primary, so the
+# --- tests can tell where each read came from:
+REPLICA_DATABASE = f"{settings.database_name}_replica"
+
+
+@fixture
+def replica_url(test_user):
+    with engine.connect().execution_options(isolation_level = "AUTOCOMMIT") as connection:
+        if not connection.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                                  {"name": REPLICA_DATABASE}).scalar():
+            connection.execute(text(f'CREATE DATABASE "{REPLICA_DATABASE}"'))
+
+    url = make_url(database_url()).set(database = REPLICA_DATABASE).render_as_string(hide_password = False)
+    replica_engine = create_engine(url, poolclass = NullPool)
+
+    Base.metadata.drop_all(bind = replica_engine)
+    Base.metadata.create_all(bind = replica_engine)
+    with replica_engine.begin() as connection:
+        connection.execute(models.User.__table__.insert(), {"id": test_user["id"], "email": test_user["email"],
+                                                            "password": "password"})
+        connection.execute(models.Post.__table__.insert(), {"id": 1, "title": "From the replica", "content": "Replica.",
+                                                            "owner_id": test_user["id"]})
+
+    return url
+
+
+# --- Use the replica database as the only replica, through connections that aren't pooled as each test request runs
+# --- in its own event loop:
+@fixture
+def replica(replica_url, monkeypatch):
+    replica = Replica(replica_url, poolclass = NullPool)
+
+    monkeypatch.setattr(replicas, "_replicas", [replica])
+    monkeypatch.setattr(replicas, "writes", {})
+
+    return replica
+
+
+def post_title(client, id: int = 1) -> str:
+    return client.get(f"/post/{id}").json()["Post"]["title"]
+
+
+# --- Define a test to check the reads only go to a replica once its health check has passed.
+# --- The post from the primary, then the post and user from the replica, are expected to pass the test:
+def test_reads_use_healthy_replica(authorised_client, test_posts, replica, test_user):
+    assert post_title(authorised_client) == "One"
+
+    asyncio.run(replicas.check())
+
+    assert replica.healthy
+    assert post_title(authorised_client) == "From the replica"
+    assert [post["Post"]["title"] for post in authorised_client.get("/post/").json()] == ["From the replica"]
+    assert authorised_client.get(f"/user/{test_user['id']}").status_code == 200
+
+
+# --- Define a test to check a client that has just changed something reads from the primary until the replica is
+# --- known to have caught up with the change.
+# --- The primary after the change and the replica after the next health check are expected to pass the test:
+def test_read_your_writes(authorised_client, test_posts, replica):
+    asyncio.run(replicas.check())
+
+    res = authorised_client.post("/post/", json = {"title": "New", "content": "New post."})
+
+    assert res.status_code == 201
+    assert post_title(authorised_client, res.json()["id"]) == "New"
+    assert post_title(authorised_client) == "One"
+
+    # --- Other clients aren't held back by the change:
+    assert replicas.pick("Bearer another-token") is replica
+
+    asyncio.run(replicas.check())
+
+    assert post_title(authorised_client) == "From the replica"
+
+
+# --- Define a test to check replicas that are unreachable or too far behind are left out, and the healthy ones take
+# --- turns. The primary for an unhealthy replica and alternating healthy replicas are expected to pass the test:
+def test_replica_health(authorised_client, test_posts, replica, replica_url, monkeypatch):
+    unreachable = Replica(make_url(replica_url).set(port = 1).render_as_string(hide_password = False),
+                          poolclass = NullPool)
+    second = Replica(replica_url, poolclass = NullPool)
+    monkeypatch.setattr(replicas, "_replicas", [unreachable, replica, second])
+
+    asyncio.run(replicas.check())
+
+    assert [candidate.healthy for candidate in replicas.replicas] == [False, True, True]
+    assert {replicas.pick(), replicas.pick()} == {replica, second}
+
+    monkeypatch.setattr(settings, "replica_max_lag_seconds", -1)
+    asyncio.run(replicas.check())
+
+    assert replicas.pick() is None
+    assert post_title(authorised_client) == "One"
@@ -1,6 +1,9 @@
 # --- Import the required modules:
 from app.main import app
 from fastapi.testclient import TestClient
+import os
+import subprocess
+import sys
 
 
 # --- Create the client to interact with the app:
@@ -31,4 +34,22 @@ def test_root_greeting():
     expected_greeting = "This is not the endpoint you are looking for!"
     
     assert res_greeting ==  expected_greeting, \
-           f"The returned greeting is: {res_greeting}.\nIt must be: {expected_greeting}."
\ No newline at end of file
+           f"The returned greeting is: {res_greeting}.\nIt must be: {expected_greeting}."
+
+# --- Define a test to check importing the app doesn't create the database engine, and the app still starts and
+# --- answers while the database is unreachable. It runs in a new interpreter, as this one has already made engines.
+# --- The engine only being created by the startup hook is expected to pass the test:
+def test_startup_without_database():
+    script = "\n".join(["import sys",
+                        "import app.database, app.main",
+                        "from fastapi.testclient import TestClient",
+                        "assert not app.database._engines and 'psycopg2' not in sys.modules",
+                        "with TestClient(app.main.create_app()) as client:",
+                        "    assert client.get('/').status_code == 200",
+                        "assert 'engine' in app.database._engines"])
+    
+    result = subprocess.run([sys.executable, "-c", script], capture_output = True, text = True,
+                            env = {**os.environ, "DATABASE_HOSTNAME": "127.0.0.1", "DATABASE_PORT": "1",
+                                   "DATABASE_ASYNC": "false"})
+    
+    assert result.returncode == 0, result.stderr
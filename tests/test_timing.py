@@ -0,0 +1,29 @@
+# --- Import the required modules:
+from app.config import settings
+import logging
+import re
+
+
+SERVER_TIMING = re.compile(r'db;dur=(?P<db>[\d.]+);desc="(?P<statements>\d+) statements", total;dur=(?P<total>[\d.]+)')
+
+
+# --- Define a test to check the Server-Timing header is only sent when it is switched on.
+# --- No header is expected to pass the test:
+def test_server_timing_off(authorised_client, test_posts):
+    res = authorised_client.get("/post/")
+    
+    assert "Server-Timing" not in res.headers
+
+
+# --- Define a test to check the statements run by a request are counted, timed and logged.
+# --- One statement for the list of posts and two for my posts (including the user lookup) are expected to pass the test:
+def test_server_timing(authorised_client, test_posts, monkeypatch, caplog):
+    monkeypatch.setattr(settings, "server_timing", True)
+    
+    with caplog.at_level(logging.INFO, logger = "app.timing"):
+        timings = [SERVER_TIMING.fullmatch(authorised_client.get(path).headers["Server-Timing"])
+                   for path in ("/post/", "/post/my-posts")]
+    
+    assert [int(timing["statements"]) for timing in timings] == [1, 2]
+    assert all(0 < float(timing["db"]) <= float(timing["total"]) for timing in timings)
+    assert "GET /post/my-posts 200: 2 statements" in caplog.text
@@ -1,6 +1,14 @@
 # --- Import the required modules:
+from app.auth import hash_pwd
+from app.auth.user_cache import UserCache, user_cache
+from passlib.context import CryptContext
+from app.models import models
 from app.schemas import UserCreateResponse, Token
+from datetime import datetime, timedelta, timezone
 from app.config import settings
+from app.main import create_app
+from app.manage import purge_refresh_tokens
+from fastapi.testclient import TestClient
 from jose import jwt
 from pytest import mark
 
@@ -57,4 +65,192 @@ def test_login_failure(test_user, fastapi_client, email, password, status_code):
                         })
     
     assert res.status_code == status_code
-    # assert res.json().get("detail") == "Invalid Credentials. Please Try Again."
\ No newline at end of file
+    # assert res.json().get("detail") == "Invalid Credentials. Please Try Again."
+
+
+# --- Define a test to check that the claims auth mode authenticates from the token alone.
+# --- The users row is deleted after login, so HTTP 404 (rather than 401) from GET /user/{id} is expected to pass:
+def test_claims_auth_skips_user_lookup(fastapi_client, test_user, session, monkeypatch):
+    monkeypatch.setattr(settings, "auth_mode", "claims")
+    res = fastapi_client.post("/login", 
+                              data={"username": test_user["email"], 
+                                    "password": test_user["password"]
+                                    })
+    headers = {"authorization": f"Bearer {res.json()['access_token']}"}
+    
+    session.query(models.User).delete()
+    session.commit()
+    
+    res = fastapi_client.get(f"/user/{test_user['id']}", headers = headers)
+    
+    assert res.status_code == 404
+
+
+# --- Define a test to check that a token without the email claim is authenticated through the user cache.
+# --- HTTP 200, then 404 while the deleted user is still cached, then 401 are expected to pass the test:
+def test_claims_auth_user_cache(authorised_client, test_user, session, monkeypatch):
+    monkeypatch.setattr(settings, "auth_mode", "claims")
+    user_cache.clear()
+    url = f"/user/{test_user['id']}"
+    
+    assert authorised_client.get(url).status_code == 200
+    
+    session.query(models.User).delete()
+    session.commit()
+    
+    assert authorised_client.get(url).status_code == 404
+    
+    user_cache.clear()
+    
+    assert authorised_client.get(url).status_code == 401
+
+
+# --- Define a test to check that the user cache drops the least recently used and expired entries:
+def test_user_cache_bounds():
+    cache = UserCache(max_size = 2, ttl = 60)
+    cache.set(1, "one")
+    cache.set(2, "two")
+    cache.get(1)
+    cache.set(3, "three")
+    
+    assert (cache.get(1), cache.get(2), cache.get(3)) == ("one", None, "three")
+    
+    cache.ttl = -1
+    cache.set(4, "four")
+    
+    assert cache.get(4) is None
+
+
+
+# --- Define a test to check that requests needing a password hash are turned away when too many are queued.
+# --- HTTP 503 is expected to pass the test:
+def test_password_hash_queue_limit(fastapi_client, monkeypatch):
+    monkeypatch.setattr(settings, "password_hash_queue_limit", 0)
+    res = fastapi_client.post("/user/", 
+                              json={"email": email, 
+                                    "password": password
+                                    })
+    
+    assert res.headers["Retry-After"] == "1"
+    assert res.status_code == 503
+
+
+# --- Define a test to check that the password hashing processes aren't forked from the threaded worker, and are started
+# --- when the application starts. A forkserver (or spawn) pool with its processes running is expected to pass the test:
+def test_password_hash_processes(monkeypatch):
+    monkeypatch.setattr(settings, "password_hash_workers", 2)
+    hash_pwd.shutdown_executor()
+    
+    hash_pwd.start_executor()
+    executor = hash_pwd.get_executor()
+    
+    assert executor._mp_context.get_start_method() in ("forkserver", "spawn")
+    assert executor.submit(hash_pwd.verify_password_hash, password, hash_pwd.hash_pwd(password)).result(timeout = 30)
+    assert len(executor._processes) == 2
+    
+    hash_pwd.shutdown_executor()
+
+
+# --- Define a test to check that the application only starts serving once the password hashing processes have started.
+# --- The processes running as soon as the startup hook returns, and stopped at shutdown, are expected to pass the test:
+def test_password_hash_processes_started_at_startup(monkeypatch):
+    monkeypatch.setattr(settings, "password_hash_workers", 2)
+    hash_pwd.shutdown_executor()
+    
+    with TestClient(create_app()):
+        assert len(hash_pwd.get_executor()._processes) == 2
+    
+    assert hash_pwd._executor is None
+
+
+# --- Define a test to check that a hash made with an old bcrypt cost is upgraded when the user logs in.
+# --- The stored hash using the current cost is expected to pass the test:
+def test_login_upgrades_password_hash(fastapi_client, test_user, session):
+    old_hash = CryptContext(schemes = ["bcrypt"], bcrypt__rounds = 4).hash(test_user["password"])
+    session.query(models.User).update({models.User.password: old_hash})
+    session.commit()
+    
+    res = fastapi_client.post("/login", 
+                              data={"username": test_user["email"], 
+                                    "password": test_user["password"]
+                                    })
+    
+    session.expire_all()
+    new_hash = session.query(models.User.password).scalar()
+    
+    assert new_hash.startswith(f"$2b${settings.bcrypt_rounds:02d}$")
+    assert res.status_code == 200
+
+
+
+# --- Define a function that logs the test user in and returns the token response:
+def login(fastapi_client, test_user):
+    res = fastapi_client.post("/login", 
+                              data={"username": test_user["email"], 
+                                    "password": test_user["password"]
+                                    })
+    return res.json()
+
+
+# --- Define a test to check that a refresh token from login gets a new, working access token.
+# --- HTTP 200 from /token/refresh and from an authenticated request are expected to pass the test:
+def test_refresh_access_token(fastapi_client, test_user):
+    refresh_token = login(fastapi_client, test_user)["refresh_token"]
+    
+    res = fastapi_client.post("/token/refresh", json = {"refresh_token": refresh_token})
+    headers = {"authorization": f"Bearer {Token(**res.json()).access_token}"}
+    
+    assert fastapi_client.get(f"/user/{test_user['id']}", headers = headers).status_code == 200
+    assert res.status_code == 200
+
+
+# --- Define a test to check that an unknown refresh token is rejected.
+# --- HTTP 401 is expected to pass the test:
+def test_refresh_access_token_invalid(fastapi_client, test_user):
+    res = fastapi_client.post("/token/refresh", json = {"refresh_token": "not-a-refresh-token"})
+    
+    assert res.status_code == 401
+
+
+# --- Define a test to check that revoking a users refresh tokens stops all of them working.
+# --- HTTP 204 from the revoke, followed by 401 for both refresh tokens are expected to pass the test:
+def test_revoke_refresh_tokens(fastapi_client, test_user):
+    first = login(fastapi_client, test_user)
+    second = login(fastapi_client, test_user)
+    
+    res = fastapi_client.post("/token/revoke-all", 
+                              headers = {"authorization": f"Bearer {second['access_token']}"})
+    
+    assert res.status_code == 204
+    for tokens in (first, second):
+        assert fastapi_client.post("/token/refresh", 
+                                   json = {"refresh_token": tokens["refresh_token"]}).status_code == 401
+
+
+# --- Define a test to check that the expired and revoked refresh tokens are purged, and the usable ones are kept.
+# --- Two tokens deleted and the remaining token still working are expected to pass the test:
+def test_purge_refresh_tokens(fastapi_client, test_user, session):
+    revoked = login(fastapi_client, test_user)
+    fastapi_client.post("/token/revoke-all", headers = {"authorization": f"Bearer {revoked['access_token']}"})
+    
+    expired = login(fastapi_client, test_user)
+    session.query(models.RefreshToken)\
+           .filter(models.RefreshToken.revoked_at == None)\
+           .update({models.RefreshToken.expires_at: datetime.now(timezone.utc) - timedelta(minutes = 1)})
+    session.commit()
+    
+    current = login(fastapi_client, test_user)
+    
+    assert purge_refresh_tokens(session) == 2
+    assert session.query(models.RefreshToken).count() == 1
+    assert fastapi_client.post("/token/refresh", json = {"refresh_token": current["refresh_token"]}).status_code == 200
+    assert fastapi_client.post("/token/refresh", json = {"refresh_token": expired["refresh_token"]}).status_code == 401
+
+
+# --- Define a test to check that a user isn't sent again when the client already has it.
+# --- HTTP 304 is expected to pass the test:
+def test_get_user_etag(authorised_client, test_user):
+    url = f"/user/{test_user['id']}"
+    etag = authorised_client.get(url).headers["ETag"]
+    
+    assert authorised_client.get(url, headers = {"If-None-Match": etag}).status_code == 304
@@ -1,5 +1,17 @@
-from pytest import mark
+from app.auth.oauth2 import create_access_token
+from app.config import settings
+from app.database import get_db
+from app.main import app
+from app.manage import find_vote_count_drift, repair_vote_count_drift
+from app.models import models
+from app.vote_buffer import vote_buffer
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi.testclient import TestClient
+from pytest import fixture, mark
 from time import sleep
+import asyncio
+import threading
 
 post_id = 1
 
@@ -31,6 +43,33 @@ def test_vote_post_not_exist_authorised_user(authorised_client, test_posts, test
     assert vote_post.status_code == 404
     
 
+# --- Define a test to check that a vote from a user deleted since their token was issued is rejected as unauthorised.
+# --- The claims auth mode doesn't look the user up, so the votes foreign key catches it. HTTP 401 is expected to pass:
+def test_vote_deleted_user(fastapi_client, test_posts, monkeypatch):
+    monkeypatch.setattr(settings, "auth_mode", "claims")
+    token = create_access_token({"user_id": 1000, "email": "deleted@sam.sam"})
+    
+    vote_post = fastapi_client.post("/vote/", json = {"post_id": post_id, "dir": 1},
+                                    headers = {"authorization": f"Bearer {token}"})
+    
+    assert vote_post.status_code == 401
+    assert vote_post.json()["detail"] == "Invalid Credentials"
+
+
+# --- Define a test to check that posts from a user deleted since their token was issued are rejected the same way.
+# --- The posts foreign key catches it. HTTP 401 is expected to pass the test:
+@mark.parametrize("url, body", [("/post/", {"title": "Gone", "content": "Gone."}),
+                                ("/post/batch", [{"title": "Gone", "content": "Gone."}])])
+def test_create_post_deleted_user(fastapi_client, test_posts, monkeypatch, url, body):
+    monkeypatch.setattr(settings, "auth_mode", "claims")
+    token = create_access_token({"user_id": 1000, "email": "deleted@sam.sam"})
+    
+    res = fastapi_client.post(url, json = body, headers = {"authorization": f"Bearer {token}"})
+    
+    assert res.status_code == 401
+    assert res.json()["detail"] == "Invalid Credentials"
+
+
 # --- Define a test to check if an unauthorised user can vote and un-vote a posts.
 # --- HTTP 401 is expected to pass the test:
 def test_vote_post_unauthorised_user(fastapi_client, test_posts, test_user):
@@ -50,4 +89,192 @@ def test_vote_post_not_exist_unauthorised_user(fastapi_client, test_posts, test_
                                                     "post_id": 100,
                                                     "dir": 1})
     
-    assert vote_post.status_code == 401
\ No newline at end of file
+    assert vote_post.status_code == 401
+
+
+# --- Define a test to check that the posts vote count follows the votes being added and removed.
+# --- A count of 1 and then 0 is expected to pass the test:
+def test_vote_updates_post_vote_count(authorised_client, test_posts, test_user):
+    url = "/vote/"
+    
+    authorised_client.post(url, json = {"post_id": post_id, "dir": 1})
+    assert authorised_client.get(f"/post/{post_id}").json()["votes"] == 1
+    
+    authorised_client.post(url, json = {"post_id": post_id, "dir": 0})
+    assert authorised_client.get(f"/post/{post_id}").json()["votes"] == 0
+
+
+# --- Define a test to check that the same vote sent many times at once is only counted once.
+# --- One 201 with the rest 409 (then 404 when removing), no errors and a correct vote count are expected to pass the test:
+def test_concurrent_votes_same_user(concurrent_client, test_posts, session):
+    parallel = 10
+    barrier = threading.Barrier(parallel)
+    
+    def send_vote(direction):
+        client = TestClient(app, raise_server_exceptions = False)
+        client.headers = concurrent_client.headers
+        barrier.wait()
+        return client.post("/vote/", json = {"post_id": post_id, "dir": direction}).status_code
+    
+    with ThreadPoolExecutor(parallel) as executor:
+        added = list(executor.map(send_vote, [1] * parallel))
+    
+    assert sorted(added) == [201] + [409] * (parallel - 1)
+    assert concurrent_client.get(f"/post/{post_id}").json()["votes"] == 1
+    
+    with ThreadPoolExecutor(parallel) as executor:
+        removed = list(executor.map(send_vote, [0] * parallel))
+    
+    assert sorted(removed) == [201] + [404] * (parallel - 1)
+    assert concurrent_client.get(f"/post/{post_id}").json()["votes"] == 0
+    assert find_vote_count_drift(session) == []
+
+
+# --- Define a test to check that a vote count that has drifted from the votes table is found and repaired.
+# --- No drift after the repair is expected to pass the test:
+def test_repair_vote_count_drift(authorised_client, test_posts, session):
+    authorised_client.post("/vote/", json = {"post_id": post_id, "dir": 1})
+    session.query(models.Post).update({models.Post.vote_count: 5}, synchronize_session = False)
+    session.commit()
+    
+    drift = find_vote_count_drift(session)
+    repair_vote_count_drift(session, [row.id for row in drift])
+    
+    assert {row.id: row.actual for row in drift} == {1: 1, 2: 0, 3: 0}
+    assert find_vote_count_drift(session) == []
+
+
+# --- Switch the vote buffer on, writing through the test database, and empty it afterwards:
+@fixture
+def buffered_votes(fastapi_client, monkeypatch):
+    monkeypatch.setattr(settings, "vote_buffer", True)
+    monkeypatch.setattr(vote_buffer, "session_factory", asynccontextmanager(app.dependency_overrides[get_db]))
+    monkeypatch.setattr(vote_buffer, "max_size", 1000)
+    
+    yield vote_buffer
+    
+    vote_buffer.pending.clear()
+    vote_buffer.flushing.clear()
+
+
+# --- Define a test to check that buffered votes get the same responses as votes written straight away.
+# --- HTTP 201, 409, 201, 404 and 201, with nothing written until the flush, are expected to pass the test:
+def test_buffered_vote_responses(authorised_client, test_posts, buffered_votes, session):
+    url = "/vote/"
+    vote_actions = [(1, 201, "vote added successfully."),
+                    (1, 409, f"User has already voted on post {post_id}."),
+                    (0, 201, "vote removed successfully."),
+                    (0, 404, "vote does not exist."),
+                    (1, 201, "vote added successfully.")]
+    
+    for direction, status_code, detail in vote_actions:
+        res = authorised_client.post(url, json = {"post_id": post_id, "dir": direction})
+        
+        assert res.status_code == status_code
+        assert res.json()["detail"] == detail
+    
+    assert authorised_client.post(url, json = {"post_id": 100, "dir": 1}).status_code == 404
+    
+    # --- The toggles collapse to a single vote waiting to be written:
+    assert len(buffered_votes) == 1
+    assert session.query(models.Vote).count() == 0
+    
+    assert asyncio.run(buffered_votes.flush()) == 1
+    assert authorised_client.get(f"/post/{post_id}").json()["votes"] == 1
+    
+    # --- Once written, the state comes from the database:
+    assert authorised_client.post(url, json = {"post_id": post_id, "dir": 1}).status_code == 409
+    assert authorised_client.post(url, json = {"post_id": post_id, "dir": 0}).status_code == 201
+    
+    asyncio.run(buffered_votes.flush())
+    
+    assert authorised_client.get(f"/post/{post_id}").json()["votes"] == 0
+
+
+# --- Define a test to check that the buffer is written once it is full, and when it is closed.
+# --- The votes and vote counts in the database are expected to pass the test:
+def test_buffered_votes_flush(authorised_client, test_posts, buffered_votes, session):
+    buffered_votes.max_size = 2
+    
+    for post in test_posts:
+        authorised_client.post("/vote/", json = {"post_id": post.id, "dir": 1})
+    
+    assert session.query(models.Vote).count() == 2
+    assert len(buffered_votes) == 1
+    
+    asyncio.run(buffered_votes.close())
+    
+    assert len(buffered_votes) == 0
+    assert [authorised_client.get(f"/post/{post.id}").json()["votes"] for post in test_posts] == [1, 1, 1]
+    assert find_vote_count_drift(session) == []
+
+
+# --- Define a test to check that closing the buffer while the background flush is part way through writing still
+# --- writes the votes. The vote in the database, without close hanging, is expected to pass the test:
+def test_buffered_votes_close_during_flush(authorised_client, test_posts, buffered_votes, session, monkeypatch):
+    write = buffered_votes.write
+    writing = []
+    
+    # --- The first write never finishes, so close has to cancel it:
+    async def slow_write(db, votes):
+        writing.append(dict(votes))
+        if len(writing) == 1:
+            await asyncio.sleep(3600)
+        await write(db, votes)
+    
+    monkeypatch.setattr(buffered_votes, "write", slow_write)
+    monkeypatch.setattr(buffered_votes, "flush_seconds", 0.01)
+    
+    authorised_client.post("/vote/", json = {"post_id": post_id, "dir": 1})
+    
+    async def close_while_writing():
+        buffered_votes.start()
+        while not writing:
+            await asyncio.sleep(0.01)
+        await asyncio.wait_for(buffered_votes.close(), timeout = 5)
+    
+    asyncio.run(close_while_writing())
+    
+    assert len(writing) == 2
+    assert not buffered_votes.pending and not buffered_votes.flushing
+    assert session.query(models.Vote).count() == 1
+    assert authorised_client.get(f"/post/{post_id}").json()["votes"] == 1
+
+
+# --- Define a test to check that a buffered vote by a deleted user is refused as it would be if it was written straight
+# --- away. HTTP 401, with only the vote of the remaining user buffered and written, is expected to pass the test:
+def test_buffered_vote_deleted_user(authorised_client, test_posts, buffered_votes, session, monkeypatch):
+    monkeypatch.setattr(settings, "auth_mode", "claims")
+    token = create_access_token({"user_id": 1000, "email": "deleted@sam.sam"})
+    
+    authorised_client.post("/vote/", json = {"post_id": post_id, "dir": 1})
+    res = authorised_client.post("/vote/", json = {"post_id": post_id, "dir": 1}, 
+                                 headers = {"authorization": f"Bearer {token}"})
+    
+    assert res.status_code == 401
+    assert res.json()["detail"] == "Invalid Credentials"
+    assert len(buffered_votes) == 1
+    assert asyncio.run(buffered_votes.flush()) == 1
+    assert session.query(models.Vote).count() == 1
+    assert authorised_client.get(f"/post/{post_id}").json()["votes"] == 1
+
+
+# --- Define a test to check that a buffered vote by a user deleted before the flush is dropped without holding back
+# --- the other votes. The vote of the remaining user only is expected to pass the test:
+def test_buffered_vote_user_deleted_before_flush(authorised_client, test_posts, buffered_votes, session):
+    other = models.User(email = "other@sam.sam", password = "password")
+    session.add(other)
+    session.commit()
+    other_token = create_access_token({"user_id": other.id})
+    
+    authorised_client.post("/vote/", json = {"post_id": post_id, "dir": 1})
+    authorised_client.post("/vote/", json = {"post_id": post_id, "dir": 1}, 
+                           headers = {"authorization": f"Bearer {other_token}"})
+    
+    session.delete(other)
+    session.commit()
+    
+    assert len(buffered_votes) == 2
+    assert asyncio.run(buffered_votes.flush()) == 2
+    assert session.query(models.Vote).count() == 1
+    assert authorised_client.get(f"/post/{post_id}").json()["votes"] == 1